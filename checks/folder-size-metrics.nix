@@ -0,0 +1,38 @@
+{ lib, ... }:
+{
+  perSystem =
+    { pkgs, ... }:
+    let
+      src = ../packages/folder-size-metrics/src;
+      python = pkgs.python3.withPackages (pythonPackages: [ pythonPackages.prometheus-client ]);
+    in
+    {
+      checks = lib.optionalAttrs pkgs.stdenv.hostPlatform.isLinux {
+        # Every in-process scanner (threaded walker, single thread, and a second
+        # scan from the subtree cache) must report the same totals as
+        # `du -x -B1` on a tree with hard links across subdirectories, sparse
+        # files and a bind mount of another file system, which they must skip.
+        folder-size-metrics-vm = pkgs.testers.nixosTest {
+          name = "folder-size-metrics-vm";
+
+          nodes.machine = {
+            environment.systemPackages = [ python ];
+          };
+
+          testScript = ''
+            machine.wait_for_unit("multi-user.target")
+            machine.succeed(
+                "mkdir -p /var/lib/fsm-check/mounts/bind /run/fsm-bind-source",
+                "head -c 8M /dev/urandom > /run/fsm-bind-source/data",
+                "mount --bind /run/fsm-bind-source /var/lib/fsm-check/mounts/bind",
+                "test $(stat -c %d /var/lib/fsm-check) != $(stat -c %d /var/lib/fsm-check/mounts/bind)",
+            )
+            output = machine.succeed(
+                "${python}/bin/python3 ${src}/benchmark.py --self-test /var/lib/fsm-check --depth 2 2>&1"
+            )
+            assert "self-test passed" in output, output
+          '';
+        };
+      };
+    };
+}
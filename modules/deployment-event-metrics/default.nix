@@ -19,16 +19,25 @@
         mkEnableOption
         mkIf
         mkOption
+        optional
         types
         ;
 
       args = [
         "--port ${toString cfg.port}"
         "--bind-addresses ${escapeShellArg (builtins.concatStringsSep "," cfg.bind-addresses)}"
+        "--max-line-bytes ${toString cfg.max-line-bytes}"
+        "--max-open-deployments ${toString cfg.max-open-deployments}"
       ]
+      ++ optional (cfg.series-ttl != null) "--series-ttl ${toString cfg.series-ttl}"
+      ++ optional (cfg.textfile-dir != null) "--textfile-dir ${escapeShellArg cfg.textfile-dir}"
+      ++ optional (cfg.event-schema != null) "--event-schema ${escapeShellArg cfg.event-schema}"
+      ++ optional (cfg.quarantine-dir != null) "--quarantine-dir ${escapeShellArg cfg.quarantine-dir}"
       ++ map (path: "--event-log ${escapeShellArg path}") cfg.event-log-files
       ++ map (path: "--event-dir ${escapeShellArg path}") cfg.event-dirs
       ++ map (path: "--nginx-log ${escapeShellArg path}") cfg.nginx-log-files
+      ++ map (path: "--desired-state-file ${escapeShellArg path}") cfg.desired-state-files
+      ++ map (path: "--desired-state-dir ${escapeShellArg path}") cfg.desired-state-dirs
       ++ map (target: "--expected-target ${escapeShellArg target}") cfg.expected-targets;
     in
     {
@@ -71,6 +80,95 @@
           description = "Attic nginx JSONL access logs to parse for cache metrics.";
         };
 
+        desired-state-files = mkOption {
+          type = types.listOf types.str;
+          default = [ ];
+          description = ''
+            Desired-state JSON records (see `docs/deployment/desired-state-schema.json`)
+            to compare each target's last successful switch against.
+          '';
+        };
+
+        desired-state-dirs = mkOption {
+          type = types.listOf types.str;
+          default = [ ];
+          description = ''
+            Directories of desired-state `*.json` records. Records are re-read
+            when they change; drift is exported as
+            `mcl_deployment_target_drift_seconds` and
+            `mcl_deployment_drifted_targets`.
+          '';
+        };
+
+        max-line-bytes = mkOption {
+          type = types.ints.positive;
+          default = 1024 * 1024;
+          description = ''
+            Longest JSONL record the exporter will parse. Longer lines are
+            skipped, counted as parse errors for their source file, and reading
+            resumes at the next newline, so a corrupted log cannot exhaust memory.
+          '';
+        };
+
+        max-open-deployments = mkOption {
+          type = types.ints.positive;
+          default = 1024;
+          description = ''
+            Most deployments tracked at once between their first event and
+            `complete` for end-to-end and critical-path latency histograms. Past
+            this the least recently updated deployment is dropped and counted in
+            `mcl_deployment_open_deployments_evicted_total`.
+          '';
+        };
+
+        series-ttl = mkOption {
+          type = types.nullOr types.ints.positive;
+          default = null;
+          example = 7 * 24 * 3600;
+          description = ''
+            Seconds after the latest event touching a deployment series before
+            that series is dropped from the exposition and from memory, so
+            decommissioned targets and ephemeral runners stop being exported.
+            Keep it well above the longest expected deployment phase, or stuck
+            deployments stop being reported. `null` keeps series forever.
+          '';
+        };
+
+        textfile-dir = mkOption {
+          type = types.nullOr types.str;
+          default = null;
+          example = "/var/lib/prometheus-node-exporter-text-files";
+          description = ''
+            When set, no HTTP server is started. Instead the exposition is
+            written atomically to `mcl_deployment_events.prom` in this
+            directory, for node_exporter's textfile collector, whenever the
+            input logs change. `port` and `bind-addresses` are then unused.
+          '';
+        };
+
+        event-schema = mkOption {
+          type = types.nullOr types.path;
+          default = null;
+          description = ''
+            DeploymentEvent JSON Schema that every ingested event is validated
+            against. Invalid events are counted in
+            `mcl_deployment_event_invalid_total` by source and reason. `null`
+            disables validation. The package ships the schema as
+            `share/deployment-event-metrics/event-schema.json`.
+          '';
+        };
+
+        quarantine-dir = mkOption {
+          type = types.nullOr types.str;
+          default = null;
+          example = "/var/lib/deployment-event-metrics/quarantine";
+          description = ''
+            When set, schema-invalid events are written to
+            `<dir>/<log name>.<path hash>.invalid` and left out of the metrics.
+            When unset, they are counted but still aggregated.
+          '';
+        };
+
         expected-targets = mkOption {
           type = types.listOf types.str;
           default = [ ];
@@ -79,7 +177,10 @@
       };
 
       config = mkIf cfg.enable {
-        systemd.tmpfiles.rules = map (path: "d ${path} 0755 root root -") cfg.event-dirs;
+        systemd.tmpfiles.rules =
+          map (path: "d ${path} 0755 root root -") cfg.event-dirs
+          ++ optional (cfg.textfile-dir != null) "d ${cfg.textfile-dir} 0755 root root -"
+          ++ optional (cfg.quarantine-dir != null) "d ${cfg.quarantine-dir} 0750 root root -";
 
         systemd.services.deployment-event-metrics = {
           description = "Prometheus exporter for Metacraft deployment events";
@@ -93,6 +194,9 @@
             ProtectHome = true;
             ProtectSystem = "strict";
             PrivateTmp = true;
+            ReadWritePaths =
+              optional (cfg.textfile-dir != null) cfg.textfile-dir
+              ++ optional (cfg.quarantine-dir != null) cfg.quarantine-dir;
           };
         };
       };
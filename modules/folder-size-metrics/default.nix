@@ -13,6 +13,35 @@
         { config, ... }: config.packages.folder-size-metrics
       );
       inherit (import ../lib.nix { inherit lib; }) toEnvVariables;
+      levelFilters = lib.types.listOf (
+        lib.types.submodule {
+          options = {
+            include = lib.mkOption {
+              type = lib.types.listOf lib.types.str;
+              default = [ "*" ];
+            };
+            exclude = lib.mkOption {
+              type = lib.types.listOf lib.types.str;
+              default = [ ];
+            };
+          };
+        }
+      );
+      scanBackend = lib.types.enum [
+        "scandir"
+        "du"
+        "nix"
+        "quota"
+      ];
+      watchMode = lib.types.enum [
+        "poll"
+        "auto"
+        "fanotify"
+        "inotify"
+      ];
+      usesQuota = lib.elem "quota" (
+        [ cfg.args.scan-backend ] ++ map (job: job.scan-backend) cfg.args.jobs
+      );
     in
     {
       options.services.folder-size-metrics = with lib; {
@@ -30,10 +59,389 @@
             example = "/var/lib";
           };
 
+          jobs = mkOption {
+            type = types.listOf (
+              types.submodule {
+                options = {
+                  path = mkOption { type = types.str; };
+                  interval-sec = mkOption {
+                    type = types.nullOr types.ints.positive;
+                    default = null;
+                  };
+                  scan-backend = mkOption {
+                    type = types.nullOr scanBackend;
+                    default = null;
+                  };
+                  scan-depth = mkOption {
+                    type = types.nullOr types.ints.positive;
+                    default = null;
+                  };
+                  level-filters = mkOption {
+                    type = types.nullOr levelFilters;
+                    default = null;
+                  };
+                  scan-threads = mkOption {
+                    type = types.nullOr types.ints.positive;
+                    default = null;
+                  };
+                  cross-mounts = mkOption {
+                    type = types.nullOr types.bool;
+                    default = null;
+                  };
+                  watch-mode = mkOption {
+                    type = types.nullOr watchMode;
+                    default = null;
+                  };
+                  cache-file = mkOption {
+                    type = types.nullOr types.str;
+                    default = null;
+                  };
+                  stat-rate = mkOption {
+                    type = types.nullOr types.ints.unsigned;
+                    default = null;
+                  };
+                  max-interval-sec = mkOption {
+                    type = types.nullOr types.ints.positive;
+                    default = null;
+                  };
+                  top-k = mkOption {
+                    type = types.nullOr types.ints.unsigned;
+                    default = null;
+                  };
+                  file-stats = mkOption {
+                    type = types.nullOr types.bool;
+                    default = null;
+                  };
+                  owner-stats = mkOption {
+                    type = types.nullOr types.bool;
+                    default = null;
+                  };
+                  scan-timeout-sec = mkOption {
+                    type = types.nullOr types.ints.unsigned;
+                    default = null;
+                  };
+                  du-processes = mkOption {
+                    type = types.nullOr types.ints.positive;
+                    default = null;
+                  };
+                };
+              }
+            );
+            default = [ ];
+            example = [
+              {
+                path = "/var/lib";
+                scan-depth = 2;
+              }
+              {
+                path = "/home";
+                interval-sec = 3600;
+                scan-threads = 4;
+              }
+            ];
+            description = ''
+              Several base paths served from one process and port, each
+              scanned on its own schedule. Settings a job leaves `null` fall
+              back to the options of the same name below. When set,
+              `base-path` is ignored. Scans of paths on the same file system
+              never run at the same time; jobs on different file systems
+              run in parallel. Jobs should not overlap, and at most one may
+              use the `nix` backend.
+            '';
+          };
+
           interval-sec = mkOption {
             type = types.int;
             default = 60;
           };
+
+          max-interval-sec = mkOption {
+            type = types.nullOr types.ints.positive;
+            default = null;
+            description = ''
+              While consecutive scans find no size changes, the interval
+              doubles up to this (by default four times `interval-sec`). The
+              first change resets it to `interval-sec`.
+            '';
+          };
+
+          scan-duty-cycle = mkOption {
+            type = types.numbers.between 1.0e-2 1.0;
+            default = 0.5;
+            description = ''
+              Largest fraction of the time spent scanning. A scan that takes
+              longer than this share of `interval-sec` pushes the next one
+              out instead of starting it back to back.
+            '';
+          };
+
+          scan-timeout-sec = mkOption {
+            type = types.ints.unsigned;
+            default = 0;
+            example = 3600;
+            description = ''
+              Seconds a scan may run, after waiting for its device, before
+              it is cancelled; `0` means no limit. Subdirectories whose
+              subtrees were complete by then are still published, the others
+              keep their previous values, and
+              `folder_size_scan_timeouts_total` is incremented. Unreadable
+              entries never fail a scan; they are skipped and counted in
+              `folder_size_scan_errors_total`, and scan durations are
+              exported as the `folder_size_scan_seconds` histogram.
+            '';
+          };
+
+          stat-rate = mkOption {
+            type = types.ints.unsigned;
+            default = 0;
+            example = 20000;
+            description = ''
+              Stat calls per second a `scandir` scan may make, across all its
+              threads; `0` means unlimited. `du` scans are not throttled.
+            '';
+          };
+
+          scan-backend = mkOption {
+            type = scanBackend;
+            default = "scandir";
+            description = ''
+              How directory sizes are computed: `scandir` walks the tree
+              in-process with a thread pool, `du` forks du(1) every interval.
+              Both report disk usage (allocated blocks), count hard-linked
+              files once, and stay on the file system of `base-path`.
+
+              `nix` is meant for `base-path = "/nix/store"`: it reads the
+              size of each store path from the Nix database in one read-only
+              query instead of walking the store. These are NAR sizes
+              (apparent size of the serialised path), not allocated blocks,
+              and store optimisation hard links are not deduplicated.
+
+              `quota` reads subdirectories of `base-path` that are btrfs
+              subvolumes (quota groups must be enabled), ZFS datasets or XFS
+              directories with their own project ID from the file system's
+              accounting, and walks the others like `scandir`. Such
+              subdirectories report only their own total, not deeper levels.
+              Unless `cross-mounts` is set, btrfs subvolumes and XFS
+              directories on a different file system than `base-path` are
+              skipped like other mount points.
+            '';
+          };
+
+          du-processes = mkOption {
+            type = types.ints.positive;
+            default = 1;
+            example = 8;
+            description = ''
+              With the `du` backend, run one du per immediate subdirectory of
+              `base-path`, this many at a time, instead of a single du over
+              all of it. Sizes are published as each du prints them either
+              way. Hard links shared between subdirectories are then counted
+              in each of them.
+            '';
+          };
+
+          top-k = mkOption {
+            type = types.ints.unsigned;
+            default = 20;
+            description = ''
+              Number of largest files, largest directories (at any depth) and
+              fastest-growing directories the `scandir` walker remembers from
+              each scan. They are exported as the
+              `folder_size_largest_file_bytes`,
+              `folder_size_largest_directory_bytes` and
+              `folder_size_directory_growth_bytes` metrics and as JSON on
+              `/top`. Growth is measured against the previous scan, which
+              keeps every directory's total in memory. `0` disables this.
+            '';
+          };
+
+          file-stats = mkOption {
+            type = types.bool;
+            default = true;
+            description = ''
+              Whether the `scandir` walker also exports, per reported path,
+              file, subdirectory and inode counts (`directory_files`,
+              `directory_subdirectories`, `directory_inodes`) and histograms
+              of file mtime and atime ages (`directory_file_mtime_age_seconds`,
+              `directory_file_atime_age_seconds`, buckets from 1 hour to
+              1 year). They come from the same stat calls as the sizes.
+            '';
+          };
+
+          owner-stats = mkOption {
+            type = types.bool;
+            default = false;
+            description = ''
+              Whether the `scandir` walker also sums disk usage and files
+              below `base-path` by owning user and group, from the same stat
+              calls. Exported as `folder_size_owner_bytes`,
+              `folder_size_owner_files` (label `user`) and
+              `folder_size_group_bytes`, `folder_size_group_files` (label
+              `group`); ids are resolved to names once per scan. With the
+              `quota` backend, subdirectories read from quota accounting are
+              not included.
+            '';
+          };
+
+          owner-top-k = mkOption {
+            type = types.ints.positive;
+            default = 20;
+            description = ''
+              Users and groups exported per base path by `owner-stats`; the
+              rest are summed under `other`.
+            '';
+          };
+
+          growth-window = mkOption {
+            type = types.ints.unsigned;
+            default = 12;
+            description = ''
+              Recent sizes kept per reported path. Their least-squares slope
+              is exported as `directory_growth_bytes_per_second`, and the
+              free space of the path's file system divided by it as
+              `directory_time_to_full_seconds` (`+Inf` when not growing), so
+              fill-up alerts need no `predict_linear` over raw series. `0`
+              disables both.
+            '';
+          };
+
+          scan-depth = mkOption {
+            type = types.ints.positive;
+            default = 1;
+            example = 3;
+            description = ''
+              Report every directory down to this many levels below
+              `base-path`. All levels are computed in the same walk.
+            '';
+          };
+
+          level-filters = mkOption {
+            type = levelFilters;
+            default = [ ];
+            example = [
+              { exclude = [ "tmp" ]; }
+              {
+                include = [ "home/*" ];
+                exclude = [ "*/.cache" ];
+              }
+            ];
+            description = ''
+              Glob filters for the directories reported at each level: the
+              first element applies to level 1, the second to level 2, and so
+              on. Globs match paths relative to `base-path`; levels without an
+              element report every directory. Filtered directories still count
+              towards their parents' sizes.
+            '';
+          };
+
+          scan-threads = mkOption {
+            type = types.nullOr types.ints.positive;
+            default = null;
+            example = 16;
+            description = ''
+              Threads used by the `scandir` backend. Defaults to the number of
+              CPUs plus 4, at most 32.
+            '';
+          };
+
+          cross-mounts = mkOption {
+            type = types.bool;
+            default = false;
+            description = "Whether to descend into file systems mounted below `base-path`.";
+          };
+
+          cache-max-entries = mkOption {
+            type = types.ints.unsigned;
+            default = 1000000;
+            description = ''
+              Directories the `scandir` backend remembers between scans. A
+              directory whose mtime, ctime, size and link count are unchanged
+              is not re-read, so rescanning a mostly static tree costs one
+              `lstat` per directory. `0` disables the cache.
+            '';
+          };
+
+          cache-file = mkOption {
+            type = types.nullOr types.str;
+            default = null;
+            example = "/var/lib/folder-size-metrics/scan-cache.json";
+            description = "File the scan cache is saved to after each scan and loaded from on start.";
+          };
+
+          results-file = mkOption {
+            type = types.nullOr types.str;
+            default = "/var/lib/folder-size-metrics/scan-results.json";
+            description = ''
+              File the sizes of each job's last scan are saved to after every
+              scan. On start they are exported right away, while the first
+              scan runs, with `folder_size_last_scan_timestamp_seconds`
+              telling how old they are; the first scan replaces them and
+              drops paths that no longer exist. `null` disables this.
+            '';
+          };
+
+          watch-mode = mkOption {
+            type = watchMode;
+            default = "poll";
+            description = ''
+              `poll` rescans every `interval-sec`. The other modes scan once,
+              then rescan only the subdirectories that file system change
+              notifications point at, plus a full scan every
+              `verify-interval-sec`. `fanotify` marks the whole file system
+              of `base-path` (Linux 5.9+, root); `inotify` needs one watch per
+              directory, bounded by `fs.inotify.max_user_watches`; `auto`
+              tries fanotify first.
+            '';
+          };
+
+          event-debounce-sec = mkOption {
+            type = types.ints.positive;
+            default = 2;
+            description = ''
+              In event-driven modes, rescan once changes have been quiet for
+              this long (or after ten times this during constant changes).
+            '';
+          };
+
+          verify-interval-sec = mkOption {
+            type = types.ints.positive;
+            default = 900;
+            description = ''
+              Seconds between scans that read every directory regardless of
+              the cache. Files that grow in place do not change their
+              directory's metadata, so this bounds how stale their size can be.
+            '';
+          };
+
+          nix-db = mkOption {
+            type = types.str;
+            default = "/nix/var/nix/db/db.sqlite";
+            description = "Nix database read by the `nix` backend.";
+          };
+
+          nix-top-k = mkOption {
+            type = types.ints.positive;
+            default = 50;
+            description = ''
+              With the `nix` backend, export only the largest this many store
+              paths (and GC root closures) per path; totals cover all paths.
+            '';
+          };
+
+          nix-gc-roots = mkOption {
+            type = types.bool;
+            default = false;
+            description = ''
+              With the `nix` backend, also export the size of what the GC roots
+              under `nix-gc-roots-dir` keep alive, and each root's closure size.
+            '';
+          };
+
+          nix-gc-roots-dir = mkOption {
+            type = types.str;
+            default = "/nix/var/nix/gcroots";
+            description = "Directory searched for GC root symlinks.";
+          };
         };
       };
       config = {
@@ -44,10 +452,22 @@
 
           environment = toEnvVariables cfg.args;
 
-          path = [ package ];
+          path = [
+            package
+          ]
+          ++ lib.optionals usesQuota [
+            pkgs.btrfs-progs
+            pkgs.xfsprogs
+          ]
+          ++ lib.optional (usesQuota && config.boot.zfs.enabled) config.boot.zfs.package;
 
           serviceConfig = {
             ExecStart = "${lib.getExe package}";
+            StateDirectory = "folder-size-metrics";
+            # Only yield to other I/O with a scheduler that honours classes
+            # (BFQ); `none` and mq-deadline ignore it.
+            IOSchedulingClass = lib.mkDefault "idle";
+            Nice = lib.mkDefault 19;
           };
         };
       };
@@ -1,5 +1,8 @@
 { pkgs, lib, ... }:
 
+let
+  eventSchema = ../../docs/deployment/event-schema.json;
+in
 pkgs.python3Packages.buildPythonApplication {
   pname = "deployment-event-metrics";
   version = "unstable";
@@ -10,12 +13,13 @@ pkgs.python3Packages.buildPythonApplication {
   installPhase = ''
     runHook preInstall
     install -Dm755 deployment_event_metrics.py "$out/bin/deployment-event-metrics"
+    install -Dm644 ${eventSchema} "$out/share/deployment-event-metrics/event-schema.json"
     runHook postInstall
   '';
 
   doCheck = true;
   checkPhase = ''
-    python3 deployment_event_metrics.py --self-test
+    python3 deployment_event_metrics.py --self-test --event-schema ${eventSchema}
   '';
 
   meta = {
@@ -4,20 +4,27 @@
 from __future__ import annotations
 
 import argparse
+import ctypes
 import datetime as dt
+import fnmatch
 import glob
+import hashlib
 import http.server
 import json
 import os
 import pathlib
+import re
+import select
 import socketserver
+import struct
 import sys
 import tempfile
 import threading
 import time
-from collections import Counter
-from dataclasses import dataclass
-from typing import Iterator
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Iterator
 
 
 DEFAULT_EVENT_DIR = "/var/log/mcl/deployments"
@@ -28,6 +35,22 @@ DEFAULT_PORT = 9161
 # is served for this many seconds; concurrent scrapes reuse it instead of each
 # re-reading the logs. See ``MetricsHandler``.
 DEFAULT_REFRESH_SECONDS = 15.0
+# Upper bound on a single JSONL record. Real deployment events and nginx access
+# log entries are a few KiB; anything past this is a corrupted or runaway
+# producer and is dropped (and counted as a parse error) instead of buffered.
+DEFAULT_MAX_LINE_BYTES = 1024 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+# In --textfile-dir mode the exposition is rewritten after input files change
+# and then stay quiet for this long, so a burst of appended events costs one
+# render instead of one per line.
+DEFAULT_TEXTFILE_DEBOUNCE_SECONDS = 2.0
+TEXTFILE_NAME = "mcl_deployment_events.prom"
+# Deployments that have started but not yet reached ``complete`` are tracked to
+# derive end-to-end and per-phase critical-path latency. Producers that never
+# emit ``complete`` (crashed controllers, abandoned runs) would grow that state
+# without bound, so the least recently updated open deployment is evicted past
+# this many.
+DEFAULT_MAX_OPEN_DEPLOYMENTS = 1024
 
 
 @dataclass(frozen=True)
@@ -52,11 +75,24 @@ def prom_escape_label(value: object) -> str:
     return text.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
 
 
+def prom_value(value: float | int) -> str:
+    """Exposition text for a sample value or bucket bound, without losing precision.
+
+    Integral values (counts, byte totals, Unix timestamps) are printed as
+    integers; ``{:g}`` would round them to six significant digits.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer() and abs(value) < 2**53:
+        return str(int(value))
+    return repr(float(value))
+
+
 def prom_sample(name: str, labels: dict[str, object], value: float | int) -> str:
     label_text = ",".join(
         f'{key}="{prom_escape_label(labels[key])}"' for key in sorted(labels)
     )
-    return f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}"
+    return f"{name}{{{label_text}}} {prom_value(value)}" if label_text else f"{name} {prom_value(value)}"
 
 
 def metric_key(name: str, labels: dict[str, object]) -> tuple[str, tuple[tuple[str, str], ...]]:
@@ -70,24 +106,112 @@ def event_log_paths(event_logs: list[str], event_dirs: list[str]) -> list[pathli
     return sorted(set(paths))
 
 
-def iter_jsonl(path: pathlib.Path, parse_errors: Counter) -> Iterator[dict]:
+def desired_state_paths(desired_state_files: list[str], desired_state_dirs: list[str]) -> list[pathlib.Path]:
+    paths = [pathlib.Path(path) for path in desired_state_files]
+    for directory in desired_state_dirs:
+        paths.extend(pathlib.Path(p) for p in glob.glob(os.path.join(directory, "*.json")))
+    return sorted(set(paths))
+
+
+@dataclass
+class FileCursor:
+    """Read position in one append-only log file, carried between refreshes."""
+
+    device: int
+    inode: int
+    offset: int = 0
+    discarding: bool = False
+
+
+def iter_bounded_lines(
+    handle: BinaryIO, max_line_bytes: int, cursor: FileCursor | None = None
+) -> Iterator[bytes | None]:
+    """Yield the lines of a binary stream, never buffering more than one bounded line.
+
+    The stream is read in ``READ_CHUNK_BYTES`` chunks. A line longer than
+    ``max_line_bytes`` (for example a multi-gigabyte record with no newline) is
+    discarded as it streams past: ``None`` is yielded once in its place so the
+    caller can count it, and reading resynchronizes at the next newline.
+
+    Without a ``cursor`` a trailing line without a newline is yielded like any
+    other line. With a ``cursor`` reading starts at ``cursor.offset`` and the
+    cursor is advanced past every consumed newline; an unterminated trailing
+    line is most likely still being written, so it is left for the next read.
+    """
+    pending = bytearray()
+    discarding = False
+    position = 0
+    if cursor is not None:
+        handle.seek(cursor.offset)
+        position = cursor.offset
+        discarding = cursor.discarding
+    while True:
+        chunk = handle.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        start = 0
+        while True:
+            newline = chunk.find(b"\n", start)
+            if newline == -1:
+                break
+            skipped = discarding
+            discarding = False
+            line = None
+            if not skipped and len(pending) + (newline - start) <= max_line_bytes:
+                pending += chunk[start:newline]
+                line = bytes(pending)
+            pending.clear()
+            start = newline + 1
+            if cursor is not None:
+                cursor.offset = position + start
+                cursor.discarding = False
+            if not skipped:
+                yield line
+        position += len(chunk)
+        if discarding:
+            continue
+        pending += chunk[start:]
+        if len(pending) > max_line_bytes:
+            pending.clear()
+            discarding = True
+            yield None
+    if cursor is not None:
+        if discarding:
+            cursor.offset = position
+            cursor.discarding = True
+        return
+    if pending and not discarding:
+        yield bytes(pending)
+
+
+def iter_jsonl(
+    path: pathlib.Path,
+    parse_errors: Counter,
+    max_line_bytes: int = DEFAULT_MAX_LINE_BYTES,
+    cursor: FileCursor | None = None,
+) -> Iterator[dict]:
     """Stream dict records from one JSONL file, counting parse errors.
 
     Streaming (one line resident at a time) is what keeps the exporter's memory
     bounded by metric cardinality rather than by the — unbounded, ever-growing —
     size of the deployment/nginx log history. Do NOT accumulate the parsed
     records into a list; the caller folds each record into bounded aggregates.
+    Lines longer than ``max_line_bytes`` are skipped and counted as parse
+    errors, so a single corrupted line cannot balloon the exporter either.
     """
     try:
         if not path.exists():
             return
-        with path.open() as handle:
-            for line in handle:
+        with path.open("rb") as handle:
+            for line in iter_bounded_lines(handle, max_line_bytes, cursor):
+                if line is None:
+                    parse_errors[str(path)] += 1
+                    continue
                 if not line.strip():
                     continue
                 try:
                     record = json.loads(line)
-                except json.JSONDecodeError:
+                except ValueError:
                     parse_errors[str(path)] += 1
                     continue
                 if isinstance(record, dict):
@@ -99,10 +223,61 @@ def iter_jsonl(path: pathlib.Path, parse_errors: Counter) -> Iterator[dict]:
 
 
 def stream_events(
-    event_logs: list[str], event_dirs: list[str], parse_errors: Counter
-) -> Iterator[dict]:
+    event_logs: list[str],
+    event_dirs: list[str],
+    parse_errors: Counter,
+    max_line_bytes: int = DEFAULT_MAX_LINE_BYTES,
+) -> Iterator[tuple[pathlib.Path, dict]]:
     for path in event_log_paths(event_logs, event_dirs):
-        yield from iter_jsonl(path, parse_errors)
+        for event in iter_jsonl(path, parse_errors, max_line_bytes):
+            yield path, event
+
+
+class LogTailer:
+    """Follow a set of append-only JSONL files across refreshes.
+
+    Each ``read`` only parses bytes appended since the previous one. Data that
+    was already folded into aggregates cannot be taken back out, so when a
+    followed file is truncated, replaced or removed, ``rotated`` reports it and
+    the caller rebuilds its aggregates from scratch (``reset`` plus a full
+    ``read``). This keeps the replay semantics of the ``*_total`` metrics: they
+    always describe exactly the retained files.
+    """
+
+    def __init__(self, max_line_bytes: int = DEFAULT_MAX_LINE_BYTES) -> None:
+        self.max_line_bytes = max_line_bytes
+        self.cursors: dict[pathlib.Path, FileCursor] = {}
+
+    def reset(self) -> None:
+        self.cursors.clear()
+
+    def rotated(self, paths: list[pathlib.Path]) -> bool:
+        if not set(self.cursors) <= set(paths):
+            return True
+        for path, cursor in self.cursors.items():
+            try:
+                stat = path.stat()
+            except OSError:
+                return True
+            if (stat.st_dev, stat.st_ino) != (cursor.device, cursor.inode):
+                return True
+            if stat.st_size < cursor.offset:
+                return True
+        return False
+
+    def read(
+        self, paths: list[pathlib.Path], parse_errors: Counter
+    ) -> Iterator[tuple[pathlib.Path, dict]]:
+        for path in paths:
+            cursor = self.cursors.get(path)
+            if cursor is None:
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                cursor = self.cursors[path] = FileCursor(stat.st_dev, stat.st_ino)
+            for record in iter_jsonl(path, parse_errors, self.max_line_bytes, cursor):
+                yield path, record
 
 
 def event_labels(event: dict) -> dict[str, object]:
@@ -135,31 +310,424 @@ def closure_summary(event: dict) -> dict:
     return closure if isinstance(closure, dict) else {}
 
 
-def deployment_metrics(
-    event_logs: list[str],
-    event_dirs: list[str],
-    expected_targets: list[str],
-    now: float,
-) -> dict[tuple[str, tuple[tuple[str, str], ...]], Metric]:
-    metrics: dict[tuple[str, tuple[tuple[str, str], ...]], Metric] = {}
-    parse_errors: Counter = Counter()
-    failure_counts: Counter = Counter()
-    cache_upload_bytes: Counter = Counter()
-    cache_restore_failures: Counter = Counter()
-    last_seen: dict[str, float] = {}
-    last_successful_complete: dict[str, float] = {}
-    last_phase_success: dict[tuple[str, str], float] = {}
-    latest_phase_state: dict[
-        tuple[str, str, str], tuple[float, str, dict[str, object], float | None]
-    ] = {}
-
-    def set_metric(name: str, labels: dict[str, object], value: float | int) -> None:
+def event_system_path(event: dict) -> str | None:
+    store_paths = event.get("storePaths") if isinstance(event.get("storePaths"), dict) else {}
+    system = store_paths.get("system")
+    return system if isinstance(system, str) and system else None
+
+
+EventValidator = Callable[[dict], "str | None"]
+
+DATE_TIME_PATTERN = r"^\d{4}-\d{2}-\d{2}[Tt ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:[Zz]|[+-]\d{2}:\d{2})$"
+SCHEMA_ANNOTATIONS = {"$schema", "$id", "$comment", "title", "description", "examples", "default"}
+JSON_TYPE_CHECKS = {
+    "object": "type({v}) is dict",
+    "array": "type({v}) is list",
+    "string": "type({v}) is str",
+    "integer": "type({v}) is int",
+    "number": "type({v}) in (int, float)",
+    "boolean": "type({v}) is bool",
+    "null": "{v} is None",
+}
+PYTHON_TYPES = {"array": list, "boolean": bool, "integer": int, "object": dict, "string": str}
+
+
+class SchemaCompiler:
+    """Translate a JSON Schema into the source of one specialized validator function.
+
+    Walking the schema dict generically for every event would cost about as
+    much as parsing the event. Instead the schema is compiled once, at startup,
+    into straight-line checks, with enum sets, compiled regexes and allowed
+    property sets bound as constants. Per event this leaves a handful of type
+    checks and set lookups. Only the keywords our schemas use are supported;
+    anything else fails compilation rather than being silently ignored.
+
+    The generated function returns ``None`` for a valid event, or a reason of
+    the form ``<property path>:<keyword>`` (e.g. ``target.transport:enum``).
+    Reasons are bounded by the size of the schema, so they are safe to use as
+    metric labels.
+    """
+
+    SUPPORTED = {
+        "type",
+        "enum",
+        "required",
+        "properties",
+        "additionalProperties",
+        "items",
+        "minLength",
+        "minimum",
+        "pattern",
+        "format",
+    }
+
+    def __init__(self, assert_formats: bool = False) -> None:
+        # JSON Schema 2020-12 treats ``format`` as an annotation unless asked
+        # otherwise. Timestamps are parsed (and tolerated when malformed) during
+        # aggregation anyway, so the regex is opt-in.
+        self.assert_formats = assert_formats
+        self.lines: list[str] = []
+        self.constants: dict[str, object] = {"_MISSING": object()}
+        self.counter = 0
+
+    def compile(self, schema: dict) -> EventValidator:
+        self._node(schema, "v0", "$", 1)
+        self._emit(1, "return None")
+        # Constants are bound as keyword defaults so the body reads them as
+        # fast locals rather than globals.
+        bound = ", ".join(f"{name}={name}" for name in ["type", "len", *self.constants])
+        self.lines.insert(0, f"def validate(v0, *, {bound}):")
+        namespace = dict(self.constants)
+        exec(compile("\n".join(self.lines) + "\n", "<event-schema>", "exec"), namespace)
+        return namespace["validate"]
+
+    def _name(self, prefix: str) -> str:
+        self.counter += 1
+        return f"{prefix}{self.counter}"
+
+    def _constant(self, value: object) -> str:
+        name = self._name("_c")
+        self.constants[name] = value
+        return name
+
+    def _emit(self, depth: int, line: str) -> None:
+        self.lines.append("    " * depth + line)
+
+    def _fail(self, depth: int, path: str, keyword: str) -> None:
+        self._emit(depth, f"return {f'{path}:{keyword}'!r}")
+
+    def _guard(self, types: list[str], applies_to: set[str], var: str, depth: int) -> int:
+        """Open an ``if`` for keywords that only constrain some JSON types, unless ``type`` already ensured one."""
+        if types and set(types) <= applies_to:
+            return depth
+        check = " or ".join(JSON_TYPE_CHECKS[kind].format(v=var) for kind in sorted(applies_to))
+        self._emit(depth, f"if {check}:")
+        return depth + 1
+
+    def _child(self, schema: dict, var: str, path: str, depth: int) -> None:
+        emitted = len(self.lines)
+        self._node(schema, var, path, depth)
+        if len(self.lines) == emitted:
+            self._emit(depth, "pass")
+
+    def _node(self, schema: dict, var: str, path: str, depth: int) -> None:
+        unknown = set(schema) - self.SUPPORTED - SCHEMA_ANNOTATIONS
+        if unknown:
+            raise ValueError(f"{path}: unsupported schema keywords {sorted(unknown)}")
+
+        declared = schema.get("type", [])
+        types = [declared] if isinstance(declared, str) else list(declared)
+        if types:
+            check = " or ".join(JSON_TYPE_CHECKS[kind].format(v=var) for kind in types)
+            self._emit(depth, f"if not ({check}):")
+            self._fail(depth + 1, path, "type")
+
+        if "enum" in schema:
+            values = schema["enum"]
+            pool = frozenset(values) if all(isinstance(value, str) for value in values) else tuple(values)
+            self._emit(depth, f"if {var} not in {self._constant(pool)}:")
+            self._fail(depth + 1, path, "enum")
+
+        if any(keyword in schema for keyword in ("minLength", "pattern")) or (
+            self.assert_formats and "format" in schema
+        ):
+            inner = self._guard(types, {"string"}, var, depth)
+            if "minLength" in schema:
+                self._emit(inner, f"if len({var}) < {int(schema['minLength'])}:")
+                self._fail(inner + 1, path, "minLength")
+            if "pattern" in schema:
+                pattern = self._constant(re.compile(schema["pattern"]))
+                self._emit(inner, f"if not {pattern}.search({var}):")
+                self._fail(inner + 1, path, "pattern")
+            if self.assert_formats and "format" in schema:
+                if schema["format"] != "date-time":
+                    raise ValueError(f"{path}: unsupported format {schema['format']!r}")
+                pattern = self._constant(re.compile(DATE_TIME_PATTERN))
+                self._emit(inner, f"if not {pattern}.match({var}):")
+                self._fail(inner + 1, path, "format")
+
+        if "minimum" in schema:
+            inner = self._guard(types, {"integer", "number"}, var, depth)
+            self._emit(inner, f"if {var} < {schema['minimum']!r}:")
+            self._fail(inner + 1, path, "minimum")
+
+        if any(keyword in schema for keyword in ("required", "properties", "additionalProperties")):
+            inner = self._guard(types, {"object"}, var, depth)
+            properties = schema.get("properties", {})
+            required = schema.get("required", [])
+            if required:
+                # One subset test on the happy path; the per-key checks that
+                # name the missing property only run for invalid events.
+                self._emit(inner, f"if not {self._constant(frozenset(required))}.issubset({var}):")
+                for key in required:
+                    self._emit(inner + 1, f"if {key!r} not in {var}:")
+                    self._fail(inner + 2, self._join(path, key), "required")
+            additional = schema.get("additionalProperties", True)
+            if additional is False:
+                allowed = self._constant(frozenset(properties))
+                self._emit(inner, f"if not {allowed}.issuperset({var}):")
+                self._fail(inner + 1, path, "additionalProperties")
+            elif additional is not True:
+                raise ValueError(f"{path}: only boolean additionalProperties is supported")
+            for key, subschema in properties.items():
+                child = self._name("v")
+                if key in required:
+                    self._emit(inner, f"{child} = {var}[{key!r}]")
+                    self._node(subschema, child, self._join(path, key), inner)
+                    continue
+                self._emit(inner, f"{child} = {var}.get({key!r}, _MISSING)")
+                self._emit(inner, f"if {child} is not _MISSING:")
+                self._child(subschema, child, self._join(path, key), inner + 1)
+
+        if "items" in schema:
+            inner = self._guard(types, {"array"}, var, depth)
+            item_type = schema["items"].get("type")
+            if set(schema["items"]) == {"type"} and item_type in PYTHON_TYPES:
+                # Homogeneous scalar arrays (argv, substituters) are checked in
+                # C rather than with a Python-level loop.
+                allowed = self._constant(frozenset({PYTHON_TYPES[item_type]}))
+                self._emit(inner, f"if not {allowed}.issuperset(map(type, {var})):")
+                self._fail(inner + 1, f"{path}[]", "type")
+                return
+            item = self._name("v")
+            self._emit(inner, f"for {item} in {var}:")
+            self._child(schema["items"], item, f"{path}[]", inner + 1)
+
+    @staticmethod
+    def _join(path: str, key: str) -> str:
+        return key if path == "$" else f"{path}.{key}"
+
+
+def compile_event_schema(path: pathlib.Path) -> EventValidator:
+    return SchemaCompiler().compile(json.loads(path.read_text()))
+
+
+class Quarantine:
+    """Append invalid events to ``<dir>/<source file name>.<path hash>.invalid`` for inspection.
+
+    The hash of the full source path keeps logs with the same name in different
+    directories apart.
+
+    The quarantine mirrors the retained logs: the first write to each file after
+    a (re)build truncates it, so replaying a log does not duplicate entries.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = pathlib.Path(directory)
+        self.started: set[pathlib.Path] = set()
+
+    def reset(self) -> None:
+        self.started.clear()
+
+    def path(self, source: pathlib.Path) -> pathlib.Path:
+        digest = hashlib.sha256(os.fsencode(source)).hexdigest()[:16]
+        return self.directory / f"{source.name}.{digest}.invalid"
+
+    def write(self, source: pathlib.Path, event: dict, reason: str) -> None:
+        path = self.path(source)
+        mode = "a" if path in self.started else "w"
+        self.started.add(path)
+        with path.open(mode) as handle:
+            handle.write(json.dumps({"source": str(source), "reason": reason, "event": event}) + "\n")
+
+
+def screen_event(
+    event: dict,
+    source: pathlib.Path,
+    validator: EventValidator | None,
+    invalid_events: Counter,
+    quarantine: Quarantine | None,
+) -> bool:
+    """Validate one event, counting (and optionally quarantining) it if invalid.
+
+    Returns whether the event should be aggregated: invalid events are still
+    aggregated unless a quarantine is configured.
+    """
+    if validator is None:
+        return True
+    reason = validator(event)
+    if reason is None:
+        return True
+    invalid_events[(str(source), reason)] += 1
+    if quarantine is None:
+        return True
+    quarantine.write(source, event, reason)
+    return False
+
+
+SeriesKey = tuple[str, tuple[tuple[str, str], ...]]
+
+# Histogram families and their bucket upper bounds. Closure transfers range from
+# a few MB/s over a congested uplink to multiple GB/s inside a datacenter;
+# deployments from under a minute to a slow multi-hour fleet rollout.
+THROUGHPUT_BUCKETS = (1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9, 2.5e9, 1e10)
+LATENCY_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 14400)
+HISTOGRAMS = {
+    "mcl_deployment_closure_transfer_bytes_per_second": THROUGHPUT_BUCKETS,
+    "mcl_deployment_end_to_end_seconds": LATENCY_BUCKETS,
+    "mcl_deployment_critical_path_seconds": LATENCY_BUCKETS,
+}
+TRANSFER_PHASES = {"cache-push", "agent-restore"}
+TERMINAL_STATUSES = {"succeeded", "failed", "cancelled", "skipped"}
+
+
+@dataclass
+class OpenDeployment:
+    """What is known about a deployment that has not reached ``complete`` yet."""
+
+    started: float | None = None
+    closure_bytes: int | None = None
+    # phase -> (startedAt, finishedAt) of its latest successful attempt
+    phases: dict[str, tuple[float, float]] = field(default_factory=dict)
+    updated: float = 0.0
+
+
+class DeploymentAggregator:
+    """Bounded deployment-event aggregates, folded in one event at a time.
+
+    The aggregator is carried between refreshes so that a refresh only folds in
+    newly appended events (see ``LogTailer``). Every series remembers when an
+    event last touched it; ``collect`` uses that to expire series of targets
+    that stopped reporting (decommissioned hosts, ephemeral runners), dropping
+    them from both the exposition and memory.
+
+    Deployments that have not completed yet are kept in ``open_deployments``
+    (keyed by deploymentId and target, bounded by ``max_open_deployments``) so
+    that ``complete`` can observe the evaluate-to-complete latency and its
+    per-phase breakdown without re-reading earlier events.
+    """
+
+    def __init__(self, max_open_deployments: int = DEFAULT_MAX_OPEN_DEPLOYMENTS) -> None:
+        self.max_open_deployments = max_open_deployments
+        self.reset()
+
+    def reset(self) -> None:
+        self.parse_errors: Counter = Counter()
+        self.invalid_events: Counter = Counter()
+        # metric key -> (value, latest observation time of a contributing event)
+        self.series: dict[SeriesKey, tuple[float, float]] = {}
+        # histogram key (without "le") -> [observations per bucket (not
+        # cumulative), sum, count, latest observation time]; expanded into
+        # _bucket/_sum/_count series only by ``collect``
+        self.histograms: dict[SeriesKey, list] = {}
+        self.last_seen: dict[str, float] = {}
+        self.latest_phase_state: dict[
+            tuple[str, str, str], tuple[float, str, dict[str, object], float | None]
+        ] = {}
+        self.open_deployments: OrderedDict[tuple[str, str], OpenDeployment] = OrderedDict()
+        self.evicted_deployments = 0
+        # target -> (finishedAt, storePaths.system) of its latest successful switch
+        self.current_systems: dict[str, tuple[float, str]] = {}
+
+    def _set(self, name: str, labels: dict[str, object], value: float, observed: float) -> None:
+        key = metric_key(name, labels)
+        previous = self.series.get(key)
+        seen = observed if previous is None else max(previous[1], observed)
+        self.series[key] = (float(value), seen)
+
+    def _add(self, name: str, labels: dict[str, object], amount: float, observed: float) -> None:
         key = metric_key(name, labels)
-        metrics[key] = Metric(key[0], key[1], float(value))
+        previous = self.series.get(key)
+        if previous is None:
+            self.series[key] = (float(amount), observed)
+        else:
+            self.series[key] = (previous[0] + amount, max(previous[1], observed))
 
-    # Stream events straight into the bounded aggregates above — never hold the
-    # full event history in memory.
-    for event in stream_events(event_logs, event_dirs, parse_errors):
+    def _max(self, name: str, labels: dict[str, object], value: float, observed: float) -> None:
+        key = metric_key(name, labels)
+        previous = self.series.get(key)
+        if previous is None:
+            self.series[key] = (float(value), observed)
+        else:
+            self.series[key] = (max(previous[0], value), max(previous[1], observed))
+
+    def _observe(self, name: str, labels: dict[str, object], value: float, observed: float) -> None:
+        buckets = HISTOGRAMS[name]
+        key = metric_key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(buckets), 0.0, 0, observed]
+        index = bisect_left(buckets, value)
+        if index < len(buckets):
+            histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+        histogram[3] = max(histogram[3], observed)
+
+    def _track_deployment(
+        self,
+        event: dict,
+        labels: dict[str, object],
+        started: float | None,
+        finished: float | None,
+        fresh_at: float,
+    ) -> None:
+        target = str(labels["target"])
+        phase = str(labels["phase"])
+        status = str(labels["status"])
+        key = (str(event.get("deploymentId", "unknown")), target)
+        deployment = self.open_deployments.get(key)
+        if deployment is None:
+            deployment = self.open_deployments[key] = OpenDeployment()
+            if len(self.open_deployments) > self.max_open_deployments:
+                self.open_deployments.popitem(last=False)
+                self.evicted_deployments += 1
+        else:
+            self.open_deployments.move_to_end(key)
+        deployment.updated = max(deployment.updated, fresh_at)
+
+        total_bytes = closure_summary(event).get("totalBytes")
+        if total_bytes is not None:
+            deployment.closure_bytes = int(total_bytes)
+        if phase == "evaluate" and started is not None:
+            deployment.started = started if deployment.started is None else min(deployment.started, started)
+
+        if status != "succeeded" or started is None or finished is None:
+            if phase == "complete" and status in TERMINAL_STATUSES:
+                del self.open_deployments[key]
+            return
+        deployment.phases[phase] = (started, finished)
+
+        common = {"target": target, "controller": labels["controller"], "cache": labels["cache"]}
+        # agent-restore events usually carry no closure summary; reuse the size
+        # reported by an earlier phase of the same deployment.
+        if phase in TRANSFER_PHASES and deployment.closure_bytes and finished > started:
+            self._observe(
+                "mcl_deployment_closure_transfer_bytes_per_second",
+                {**common, "phase": phase},
+                deployment.closure_bytes / (finished - started),
+                                fresh_at,
+            )
+
+        if phase != "complete":
+            return
+        del self.open_deployments[key]
+        if deployment.started is None:
+            # evaluate was never seen (evicted, or logged before the exporter's
+            # history starts): the end-to-end latency would be understated.
+            return
+        total = max(0, finished - deployment.started)
+        self._observe("mcl_deployment_end_to_end_seconds", common, total, fresh_at)
+        busy = 0.0
+        for phase_name, (phase_started, phase_finished) in deployment.phases.items():
+            duration = max(0, phase_finished - phase_started)
+            busy += duration
+            self._observe(
+                "mcl_deployment_critical_path_seconds",
+                {**common, "phase": phase_name},
+                duration,
+                fresh_at,
+            )
+        # Time between phases (queueing, approvals, controller hand-offs).
+        self._observe(
+            "mcl_deployment_critical_path_seconds",
+            {**common, "phase": "idle"},
+            max(0, total - busy),
+            fresh_at,
+        )
+
+    def ingest(self, event: dict, received_at: float) -> None:
+        """Fold one event in. ``received_at`` stands in for events without timestamps."""
         labels = event_labels(event)
         target = str(labels["target"])
         phase = str(labels["phase"])
@@ -167,152 +735,303 @@ def deployment_metrics(
         started = event_started_at(event)
         finished = event_finished_at(event)
         observed = finished if finished is not None else started
+        fresh_at = observed if observed is not None else received_at
 
         if observed is not None:
-            last_seen[target] = max(last_seen.get(target, 0), observed)
+            self.last_seen[target] = max(self.last_seen.get(target, 0), observed)
             deployment_id = str(event.get("deploymentId", "unknown"))
             state_key = (deployment_id, target, phase)
-            previous = latest_phase_state.get(state_key)
+            previous = self.latest_phase_state.get(state_key)
             if previous is None or observed >= previous[0]:
-                latest_phase_state[state_key] = (observed, status, labels, started)
+                self.latest_phase_state[state_key] = (observed, status, labels, started)
 
         if started is not None and finished is not None:
-            set_metric(
+            self._set(
                 "mcl_deployment_phase_duration_seconds",
                 labels,
                 max(0, finished - started),
+                fresh_at,
             )
 
         closure = closure_summary(event)
         if "count" in closure and closure["count"] is not None:
             count_labels = dict(labels)
             count_labels.pop("status", None)
-            set_metric("mcl_deployment_closure_paths", count_labels, int(closure["count"]))
+            self._set("mcl_deployment_closure_paths", count_labels, int(closure["count"]), fresh_at)
         if "totalBytes" in closure and closure["totalBytes"] is not None:
             bytes_labels = dict(labels)
             bytes_labels.pop("status", None)
-            set_metric("mcl_deployment_closure_bytes", bytes_labels, int(closure["totalBytes"]))
+            self._set("mcl_deployment_closure_bytes", bytes_labels, int(closure["totalBytes"]), fresh_at)
 
         if status == "failed":
             error = event.get("error") if isinstance(event.get("error"), dict) else {}
             error_code = error.get("code", "unknown")
-            failure_counts[
-                (
-                    labels["target"],
-                    labels["phase"],
-                    labels["controller"],
-                    labels["transport"],
-                    labels["cache"],
-                    error_code,
-                )
-            ] += 1
+            self._add(
+                "mcl_deployment_phase_failures_total",
+                {
+                    "target": labels["target"],
+                    "phase": labels["phase"],
+                    "controller": labels["controller"],
+                    "transport": labels["transport"],
+                    "cache": labels["cache"],
+                    "error_code": error_code,
+                },
+                1,
+                fresh_at,
+            )
             if phase == "agent-restore":
-                cache_restore_failures[
-                    (
-                        labels["target"],
-                        labels["controller"],
-                        labels["transport"],
-                        labels["cache"],
-                        error_code,
-                    )
-                ] += 1
+                self._add(
+                    "mcl_deployment_cache_restore_failures_total",
+                    {
+                        "target": labels["target"],
+                        "controller": labels["controller"],
+                        "transport": labels["transport"],
+                        "cache": labels["cache"],
+                        "error_code": error_code,
+                    },
+                    1,
+                    fresh_at,
+                )
 
         if phase == "cache-push":
             total_bytes = closure.get("totalBytes")
             if total_bytes is not None:
-                cache_upload_bytes[
-                    (
-                        labels["target"],
-                        labels["controller"],
-                        labels["cache"],
-                        status,
-                    )
-                ] += int(total_bytes)
+                self._add(
+                    "mcl_deployment_cache_upload_bytes_total",
+                    {
+                        "target": labels["target"],
+                        "backend": labels["controller"],
+                        "cache": labels["cache"],
+                        "status": status,
+                    },
+                    int(total_bytes),
+                    fresh_at,
+                )
 
         if status == "succeeded" and finished is not None:
-            last_phase_success[(target, phase)] = max(
-                last_phase_success.get((target, phase), 0), finished
+            self._max(
+                "mcl_deployment_last_phase_success_timestamp_seconds",
+                {"target": target, "phase": phase},
+                finished,
+                fresh_at,
             )
             if phase == "complete":
-                last_successful_complete[target] = max(
-                    last_successful_complete.get(target, 0), finished
+                self._max(
+                    "mcl_deployment_last_successful_timestamp_seconds",
+                    {"target": target},
+                    finished,
+                    fresh_at,
+                )
+            system = event_system_path(event) if phase in {"switch", "complete"} else None
+            if system is not None:
+                current = self.current_systems.get(target)
+                if current is None or finished >= current[0]:
+                    self.current_systems[target] = (finished, system)
+
+        self._track_deployment(event, labels, started, finished, fresh_at)
+
+    def expire(self, cutoff: float) -> None:
+        """Forget every series and target not observed since ``cutoff``.
+
+        ``current_systems`` is kept: a target that switched long ago still
+        runs that system, and it is O(targets) anyway.
+        """
+        self.series = {key: entry for key, entry in self.series.items() if entry[1] >= cutoff}
+        self.histograms = {key: entry for key, entry in self.histograms.items() if entry[3] >= cutoff}
+        self.last_seen = {
+            target: timestamp for target, timestamp in self.last_seen.items() if timestamp >= cutoff
+        }
+        self.latest_phase_state = {
+            key: state for key, state in self.latest_phase_state.items() if state[0] >= cutoff
+        }
+        for key in [key for key, deployment in self.open_deployments.items() if deployment.updated < cutoff]:
+            del self.open_deployments[key]
+
+    def collect(
+        self, expected_targets: list[str], now: float, series_ttl: float = 0.0
+    ) -> dict[SeriesKey, Metric]:
+        if series_ttl > 0:
+            self.expire(now - series_ttl)
+
+        metrics: dict[SeriesKey, Metric] = {}
+
+        def set_metric(name: str, labels: dict[str, object], value: float | int) -> None:
+            key = metric_key(name, labels)
+            metrics[key] = Metric(key[0], key[1], float(value))
+
+        for key, (value, _observed) in self.series.items():
+            metrics[key] = Metric(key[0], key[1], value)
+
+        for (name, label_pairs), (counts, total, count, _observed) in self.histograms.items():
+            labels = dict(label_pairs)
+            cumulative = 0
+            for bound, bucket_count in zip(HISTOGRAMS[name], counts):
+                cumulative += bucket_count
+                set_metric(f"{name}_bucket", {**labels, "le": prom_value(bound)}, cumulative)
+            set_metric(f"{name}_bucket", {**labels, "le": "+Inf"}, count)
+            set_metric(f"{name}_sum", labels, total)
+            set_metric(f"{name}_count", labels, count)
+
+        for source, count in self.parse_errors.items():
+            set_metric("mcl_deployment_event_parse_errors_total", {"source": source}, count)
+
+        for (source, reason), count in self.invalid_events.items():
+            set_metric("mcl_deployment_event_invalid_total", {"source": source, "reason": reason}, count)
+
+        for _state_key, (_observed, status, labels, started) in self.latest_phase_state.items():
+            if status in {"pending", "running"} and started is not None:
+                set_metric(
+                    "mcl_deployment_in_progress_age_seconds",
+                    labels,
+                    max(0, now - started),
                 )
 
-    for source, count in parse_errors.items():
-        set_metric("mcl_deployment_event_parse_errors_total", {"source": source}, count)
+        all_expected = sorted(set(expected_targets))
+        for target in all_expected:
+            set_metric("mcl_deployment_target_expected", {"target": target}, 1)
+            set_metric("mcl_deployment_target_seen", {"target": target}, 1 if target in self.last_seen else 0)
+        for target, timestamp in self.last_seen.items():
+            set_metric("mcl_deployment_target_last_seen_timestamp_seconds", {"target": target}, timestamp)
 
-    for _state_key, (_observed, status, labels, started) in latest_phase_state.items():
-        if status in {"pending", "running"} and started is not None:
-            set_metric(
-                "mcl_deployment_in_progress_age_seconds",
-                labels,
-                max(0, now - started),
-            )
+        set_metric("mcl_deployment_open_deployments", {}, len(self.open_deployments))
+        set_metric("mcl_deployment_open_deployments_evicted_total", {}, self.evicted_deployments)
 
-    for key, count in failure_counts.items():
-        target, phase, controller, transport, cache, error_code = key
-        set_metric(
-            "mcl_deployment_phase_failures_total",
-            {
-                "target": target,
-                "phase": phase,
-                "controller": controller,
-                "transport": transport,
-                "cache": cache,
-                "error_code": error_code,
-            },
-            count,
-        )
+        return metrics
 
-    for key, count in cache_restore_failures.items():
-        target, controller, transport, cache, error_code = key
-        set_metric(
-            "mcl_deployment_cache_restore_failures_total",
-            {
-                "target": target,
-                "controller": controller,
-                "transport": transport,
-                "cache": cache,
-                "error_code": error_code,
-            },
-            count,
-        )
 
-    for key, total_bytes in cache_upload_bytes.items():
-        target, backend, cache, status = key
-        set_metric(
-            "mcl_deployment_cache_upload_bytes_total",
-            {
-                "target": target,
-                "backend": backend,
-                "cache": cache,
-                "status": status,
-            },
-            total_bytes,
-        )
+def deployment_metrics(
+    event_logs: list[str],
+    event_dirs: list[str],
+    expected_targets: list[str],
+    now: float,
+    max_line_bytes: int = DEFAULT_MAX_LINE_BYTES,
+    series_ttl: float = 0.0,
+    validator: EventValidator | None = None,
+    quarantine: Quarantine | None = None,
+    max_open_deployments: int = DEFAULT_MAX_OPEN_DEPLOYMENTS,
+    desired_state: "DesiredStateIndex | None" = None,
+) -> dict[SeriesKey, Metric]:
+    """One-shot replay of the full event history; see ``EventExporter`` for the incremental path."""
+    aggregator = DeploymentAggregator(max_open_deployments)
+    # Stream events straight into the bounded aggregates — never hold the full
+    # event history in memory.
+    for source, event in stream_events(event_logs, event_dirs, aggregator.parse_errors, max_line_bytes):
+        if screen_event(event, source, validator, aggregator.invalid_events, quarantine):
+            aggregator.ingest(event, now)
+    metrics = aggregator.collect(expected_targets, now, series_ttl)
+    if desired_state is not None:
+        desired_state.refresh()
+        metrics.update(desired_state.collect(aggregator.current_systems, now))
+    return metrics
 
-    for target, timestamp in last_successful_complete.items():
-        set_metric(
-            "mcl_deployment_last_successful_timestamp_seconds",
-            {"target": target},
-            timestamp,
-        )
 
-    for (target, phase), timestamp in last_phase_success.items():
-        set_metric(
-            "mcl_deployment_last_phase_success_timestamp_seconds",
-            {"target": target, "phase": phase},
-            timestamp,
-        )
+@dataclass(frozen=True)
+class DesiredState:
+    """The system a target should run, from its latest desired-state record."""
+
+    system_path: str
+    sequence: int
+    # When this state became desired: supersededState.supersededAt, or the
+    # record's mtime for a target's first desired state.
+    since: float
+
+
+def load_desired_state(path: pathlib.Path, mtime: float) -> tuple[str, DesiredState]:
+    """Parse one desired-state record (docs/deployment/desired-state-schema.json) into (target, state)."""
+    record = json.loads(path.read_bytes())
+    if not isinstance(record, dict):
+        raise ValueError("desired-state record is not an object")
+    target = record.get("target") if isinstance(record.get("target"), dict) else {}
+    name = target.get("name")
+    system_path = record.get("desiredSystemPath")
+    if not isinstance(name, str) or not name or not isinstance(system_path, str) or not system_path:
+        raise ValueError("desired-state record lacks target.name or desiredSystemPath")
+    sequence = record.get("sequence")
+    superseded = record.get("supersededState") if isinstance(record.get("supersededState"), dict) else {}
+    since = parse_timestamp(superseded.get("supersededAt"))
+    return name, DesiredState(
+        system_path, sequence if isinstance(sequence, int) else 0, mtime if since is None else since
+    )
 
-    all_expected = sorted(set(expected_targets))
-    for target in all_expected:
-        set_metric("mcl_deployment_target_expected", {"target": target}, 1)
-        set_metric("mcl_deployment_target_seen", {"target": target}, 1 if target in last_seen else 0)
-    for target, timestamp in last_seen.items():
-        set_metric("mcl_deployment_target_last_seen_timestamp_seconds", {"target": target}, timestamp)
 
-    return metrics
+class DesiredStateIndex:
+    """Latest desired system per target, compared against what targets last switched to.
+
+    Records are re-read only when their file's inode, size, or mtime changes,
+    so a refresh costs one ``stat`` per record; ``collect`` is O(targets).
+    """
+
+    def __init__(self, desired_state_files: list[str], desired_state_dirs: list[str]) -> None:
+        self.desired_state_files = desired_state_files
+        self.desired_state_dirs = desired_state_dirs
+        # path -> (inode, size, mtime_ns), and the parsed record or None if unreadable
+        self.records: dict[pathlib.Path, tuple[tuple[int, int, int], tuple[str, DesiredState] | None]] = {}
+        self.by_target: dict[str, DesiredState] = {}
+
+    def paths(self) -> list[pathlib.Path]:
+        return desired_state_paths(self.desired_state_files, self.desired_state_dirs)
+
+    def refresh(self) -> None:
+        paths = self.paths()
+        changed = False
+        for path in self.records.keys() - set(paths):
+            del self.records[path]
+            changed = True
+        for path in paths:
+            try:
+                stat = path.stat()
+            except OSError:
+                changed = self.records.pop(path, None) is not None or changed
+                continue
+            signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            previous = self.records.get(path)
+            if previous is not None and previous[0] == signature:
+                continue
+            try:
+                record = load_desired_state(path, stat.st_mtime)
+            except (OSError, ValueError):
+                record = None
+            self.records[path] = (signature, record)
+            changed = True
+        if not changed:
+            return
+        by_target: dict[str, DesiredState] = {}
+        for _signature, record in self.records.values():
+            if record is None:
+                continue
+            target, state = record
+            if target not in by_target or state.sequence > by_target[target].sequence:
+                by_target[target] = state
+        self.by_target = by_target
+
+    def drifted(self, current_systems: dict[str, tuple[float, str]]) -> list[str]:
+        drifted = []
+        for target, state in self.by_target.items():
+            current = current_systems.get(target)
+            if current is None or current[1] != state.system_path:
+                drifted.append(target)
+        return drifted
+
+    def collect(self, current_systems: dict[str, tuple[float, str]], now: float) -> dict[SeriesKey, Metric]:
+        metrics: dict[SeriesKey, Metric] = {}
+
+        def set_metric(name: str, labels: dict[str, object], value: float | int) -> None:
+            key = metric_key(name, labels)
+            metrics[key] = Metric(key[0], key[1], float(value))
+
+        drifted = set(self.drifted(current_systems))
+        for target, state in self.by_target.items():
+            set_metric("mcl_deployment_target_drifted", {"target": target}, 1 if target in drifted else 0)
+            set_metric(
+                "mcl_deployment_target_drift_seconds",
+                {"target": target},
+                max(0, now - state.since) if target in drifted else 0,
+            )
+        set_metric("mcl_deployment_drifted_targets", {}, len(drifted))
+        for path, (_signature, record) in self.records.items():
+            if record is None:
+                set_metric("mcl_deployment_desired_state_invalid", {"source": str(path)}, 1)
+        return metrics
 
 
 def classify_operation(method: str) -> str:
@@ -324,78 +1043,99 @@ def classify_operation(method: str) -> str:
     return "other"
 
 
-def nginx_metrics(nginx_logs: list[str]) -> dict[tuple[str, tuple[tuple[str, str], ...]], Metric]:
-    metrics: dict[tuple[str, tuple[tuple[str, str], ...]], Metric] = {}
-    parse_errors: Counter = Counter()
-    request_counts: Counter = Counter()
-    byte_counts: Counter = Counter()
-    object_failures: Counter = Counter()
-
-    def set_metric(name: str, labels: dict[str, object], value: float | int) -> None:
-        key = metric_key(name, labels)
-        metrics[key] = Metric(key[0], key[1], float(value))
-
-    # Stream the — potentially enormous, one-line-per-cache-request — Attic
-    # access logs into bounded Counters; never materialize the entries.
-    for path_text in nginx_logs:
-        for entry in iter_jsonl(pathlib.Path(path_text), parse_errors):
-            method = str(entry.get("method", "UNKNOWN"))
-            status = str(entry.get("status", "000"))
-            operation = classify_operation(method)
-            request_counts[(operation, method, status)] += 1
+class NginxAggregator:
+    """Attic nginx access-log aggregates, folded in one entry at a time.
 
-            try:
-                status_int = int(status)
-            except ValueError:
-                status_int = 0
-
-            try:
-                request_length = int(entry.get("request_length") or 0)
-            except (TypeError, ValueError):
-                request_length = 0
-            try:
-                body_bytes_sent = int(entry.get("body_bytes_sent") or 0)
-            except (TypeError, ValueError):
-                body_bytes_sent = 0
-
-            if operation == "upload":
-                byte_counts[(operation, "request", status)] += request_length
-            elif operation == "download":
-                byte_counts[(operation, "response", status)] += body_bytes_sent
-            else:
-                byte_counts[(operation, "response", status)] += body_bytes_sent
+    Like ``DeploymentAggregator`` it is carried between refreshes, so the —
+    potentially enormous, one-line-per-cache-request — access logs are parsed
+    once rather than on every scrape.
+    """
 
-            if operation in {"upload", "download"} and status_int >= 400:
-                object_failures[(operation, method, status)] += 1
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.parse_errors: Counter = Counter()
+        self.request_counts: Counter = Counter()
+        self.byte_counts: Counter = Counter()
+        self.object_failures: Counter = Counter()
+
+    def ingest(self, entry: dict) -> None:
+        method = str(entry.get("method", "UNKNOWN"))
+        status = str(entry.get("status", "000"))
+        operation = classify_operation(method)
+        self.request_counts[(operation, method, status)] += 1
+
+        try:
+            status_int = int(status)
+        except ValueError:
+            status_int = 0
+
+        try:
+            request_length = int(entry.get("request_length") or 0)
+        except (TypeError, ValueError):
+            request_length = 0
+        try:
+            body_bytes_sent = int(entry.get("body_bytes_sent") or 0)
+        except (TypeError, ValueError):
+            body_bytes_sent = 0
+
+        if operation == "upload":
+            self.byte_counts[(operation, "request", status)] += request_length
+        elif operation == "download":
+            self.byte_counts[(operation, "response", status)] += body_bytes_sent
+        else:
+            self.byte_counts[(operation, "response", status)] += body_bytes_sent
+
+        if operation in {"upload", "download"} and status_int >= 400:
+            self.object_failures[(operation, method, status)] += 1
+
+    def collect(self) -> dict[SeriesKey, Metric]:
+        metrics: dict[SeriesKey, Metric] = {}
+
+        def set_metric(name: str, labels: dict[str, object], value: float | int) -> None:
+            key = metric_key(name, labels)
+            metrics[key] = Metric(key[0], key[1], float(value))
+
+        for source, count in self.parse_errors.items():
+            set_metric("mcl_attic_nginx_log_parse_errors_total", {"source": source}, count)
+
+        for key, count in self.request_counts.items():
+            operation, method, status = key
+            set_metric(
+                "mcl_attic_nginx_requests_total",
+                {"operation": operation, "method": method, "status": status},
+                count,
+            )
 
-    for source, count in parse_errors.items():
-        set_metric("mcl_attic_nginx_log_parse_errors_total", {"source": source}, count)
+        for key, total_bytes in self.byte_counts.items():
+            operation, direction, status = key
+            set_metric(
+                "mcl_attic_nginx_bytes_total",
+                {"operation": operation, "direction": direction, "status": status},
+                total_bytes,
+            )
 
-    for key, count in request_counts.items():
-        operation, method, status = key
-        set_metric(
-            "mcl_attic_nginx_requests_total",
-            {"operation": operation, "method": method, "status": status},
-            count,
-        )
+        for key, count in self.object_failures.items():
+            operation, method, status = key
+            set_metric(
+                "mcl_attic_nginx_cache_object_failures_total",
+                {"operation": operation, "method": method, "status": status},
+                count,
+            )
 
-    for key, total_bytes in byte_counts.items():
-        operation, direction, status = key
-        set_metric(
-            "mcl_attic_nginx_bytes_total",
-            {"operation": operation, "direction": direction, "status": status},
-            total_bytes,
-        )
+        return metrics
 
-    for key, count in object_failures.items():
-        operation, method, status = key
-        set_metric(
-            "mcl_attic_nginx_cache_object_failures_total",
-            {"operation": operation, "method": method, "status": status},
-            count,
-        )
 
-    return metrics
+def nginx_metrics(
+    nginx_logs: list[str], max_line_bytes: int = DEFAULT_MAX_LINE_BYTES
+) -> dict[SeriesKey, Metric]:
+    aggregator = NginxAggregator()
+    # Stream the access logs into bounded Counters; never materialize the entries.
+    for path_text in nginx_logs:
+        for entry in iter_jsonl(pathlib.Path(path_text), aggregator.parse_errors, max_line_bytes):
+            aggregator.ingest(entry)
+    return aggregator.collect()
 
 
 HELP_TEXT = {
@@ -412,6 +1152,16 @@ HELP_TEXT = {
     "mcl_deployment_target_seen": "Whether an expected deployment target has been observed in deployment events.",
     "mcl_deployment_target_last_seen_timestamp_seconds": "Unix timestamp for the latest deployment event observed by target.",
     "mcl_deployment_event_parse_errors_total": "Count of JSONL deployment event parse errors by source.",
+    "mcl_deployment_event_invalid_total": "Count of deployment events violating the event schema by source and reason.",
+    "mcl_deployment_closure_transfer_bytes_per_second": "Closure transfer throughput of successful cache-push and agent-restore phases.",
+    "mcl_deployment_end_to_end_seconds": "Latency from evaluate start to complete finish of successful deployments.",
+    "mcl_deployment_critical_path_seconds": "Per-phase breakdown of successful deployment latency; phase=idle is time between phases.",
+    "mcl_deployment_open_deployments": "Deployments observed but not yet completed.",
+    "mcl_deployment_open_deployments_evicted_total": "Open deployments dropped to bound memory before they completed.",
+    "mcl_deployment_target_drifted": "Whether a target's last successful switch differs from its desired system.",
+    "mcl_deployment_target_drift_seconds": "Seconds a drifted target has been behind its desired system.",
+    "mcl_deployment_drifted_targets": "Count of targets whose last successful switch differs from their desired system.",
+    "mcl_deployment_desired_state_invalid": "Desired-state files that could not be parsed, by source.",
     "mcl_attic_nginx_requests_total": "Count of Attic nginx requests by cache operation, method, and status.",
     "mcl_attic_nginx_bytes_total": "Attic nginx byte volume by cache operation, direction, and status.",
     "mcl_attic_nginx_cache_object_failures_total": "Count of failed Attic cache object requests.",
@@ -419,59 +1169,207 @@ HELP_TEXT = {
 }
 
 
+def metric_family(name: str) -> str:
+    """The family a sample belongs to: histogram samples share their base name."""
+    for suffix in ("_bucket", "_count", "_sum"):
+        if name.endswith(suffix) and name[: -len(suffix)] in HISTOGRAMS:
+            return name[: -len(suffix)]
+    return name
+
+
+def sample_order(key: SeriesKey) -> tuple:
+    # Keep each histogram's samples together and its buckets in numeric order.
+    name, labels = key
+    le = dict(labels).get("le")
+    return (
+        metric_family(name),
+        tuple(label for label in labels if label[0] != "le"),
+        name,
+        float(le) if le is not None else 0.0,
+    )
+
+
+def format_metrics(merged: dict[SeriesKey, Metric]) -> str:
+    lines: list[str] = []
+    emitted_help: set[str] = set()
+    for key in sorted(merged, key=sample_order):
+        metric = merged[key]
+        family = metric_family(metric.name)
+        if family not in emitted_help:
+            help_text = HELP_TEXT.get(family, family)
+            lines.append(f"# HELP {family} {help_text}")
+            if family in HISTOGRAMS:
+                lines.append(f"# TYPE {family} histogram")
+            else:
+                lines.append(f"# TYPE {family} gauge" if not family.endswith("_total") else f"# TYPE {family} counter")
+            emitted_help.add(family)
+        labels = {label: value for label, value in metric.labels}
+        lines.append(prom_sample(metric.name, labels, metric.value))
+    return "\n".join(lines) + ("\n" if lines else "")
+
+
 def render_metrics(
     event_logs: list[str],
     event_dirs: list[str],
     nginx_logs: list[str],
     expected_targets: list[str],
     now: float | None = None,
+    max_line_bytes: int = DEFAULT_MAX_LINE_BYTES,
+    series_ttl: float = 0.0,
+    validator: EventValidator | None = None,
+    quarantine: Quarantine | None = None,
+    max_open_deployments: int = DEFAULT_MAX_OPEN_DEPLOYMENTS,
+    desired_state: DesiredStateIndex | None = None,
 ) -> str:
     now = dt.datetime.now(dt.timezone.utc).timestamp() if now is None else now
-    merged = deployment_metrics(event_logs, event_dirs, expected_targets, now)
-    merged.update(nginx_metrics(nginx_logs))
+    merged = deployment_metrics(
+        event_logs,
+        event_dirs,
+        expected_targets,
+        now,
+        max_line_bytes,
+        series_ttl,
+        validator,
+        quarantine,
+        max_open_deployments,
+        desired_state,
+    )
+    merged.update(nginx_metrics(nginx_logs, max_line_bytes))
+    return format_metrics(merged)
 
-    lines: list[str] = []
-    emitted_help: set[str] = set()
-    for key in sorted(merged):
-        metric = merged[key]
-        if metric.name not in emitted_help:
-            help_text = HELP_TEXT.get(metric.name, metric.name)
-            lines.append(f"# HELP {metric.name} {help_text}")
-            lines.append(f"# TYPE {metric.name} gauge" if not metric.name.endswith("_total") else f"# TYPE {metric.name} counter")
-            emitted_help.add(metric.name)
-        labels = {label: value for label, value in metric.labels}
-        lines.append(prom_sample(metric.name, labels, metric.value))
-    return "\n".join(lines) + ("\n" if lines else "")
+
+class EventExporter:
+    """Long-lived exporter state: aggregates plus the log positions feeding them.
+
+    Unlike ``render_metrics``, which replays the whole history, each ``render``
+    only folds in deployment events and nginx entries appended since the
+    previous one.
+    """
+
+    def __init__(
+        self,
+        event_logs: list[str],
+        event_dirs: list[str],
+        nginx_logs: list[str],
+        expected_targets: list[str],
+        max_line_bytes: int = DEFAULT_MAX_LINE_BYTES,
+        series_ttl: float = 0.0,
+        validator: EventValidator | None = None,
+        quarantine: Quarantine | None = None,
+        max_open_deployments: int = DEFAULT_MAX_OPEN_DEPLOYMENTS,
+        desired_state: DesiredStateIndex | None = None,
+    ) -> None:
+        self.event_logs = event_logs
+        self.event_dirs = event_dirs
+        self.nginx_logs = nginx_logs
+        self.expected_targets = expected_targets
+        self.series_ttl = series_ttl
+        self.validator = validator
+        self.quarantine = quarantine
+        self.desired_state = desired_state
+        self.tailer = LogTailer(max_line_bytes)
+        self.aggregator = DeploymentAggregator(max_open_deployments)
+        self.nginx_tailer = LogTailer(max_line_bytes)
+        self.nginx_aggregator = NginxAggregator()
+
+    def refresh(self, now: float) -> None:
+        paths = event_log_paths(self.event_logs, self.event_dirs)
+        if self.tailer.rotated(paths):
+            self.tailer.reset()
+            self.aggregator.reset()
+            if self.quarantine is not None:
+                self.quarantine.reset()
+        for source, event in self.tailer.read(paths, self.aggregator.parse_errors):
+            if screen_event(event, source, self.validator, self.aggregator.invalid_events, self.quarantine):
+                self.aggregator.ingest(event, now)
+
+        nginx_paths = [pathlib.Path(path) for path in self.nginx_logs]
+        if self.nginx_tailer.rotated(nginx_paths):
+            self.nginx_tailer.reset()
+            self.nginx_aggregator.reset()
+        for _source, entry in self.nginx_tailer.read(nginx_paths, self.nginx_aggregator.parse_errors):
+            self.nginx_aggregator.ingest(entry)
+
+        if self.desired_state is not None:
+            self.desired_state.refresh()
+
+    def render(self, now: float | None = None) -> str:
+        now = dt.datetime.now(dt.timezone.utc).timestamp() if now is None else now
+        self.refresh(now)
+        merged = self.aggregator.collect(self.expected_targets, now, self.series_ttl)
+        merged.update(self.nginx_aggregator.collect())
+        if self.desired_state is not None:
+            merged.update(self.desired_state.collect(self.aggregator.current_systems, now))
+        return format_metrics(merged)
+
+    def input_paths(self) -> list[pathlib.Path]:
+        paths = event_log_paths(self.event_logs, self.event_dirs)
+        paths.extend(pathlib.Path(path) for path in self.nginx_logs)
+        if self.desired_state is not None:
+            paths.extend(self.desired_state.paths())
+        return paths
+
+    def watch_targets(self) -> dict[pathlib.Path, set[str]]:
+        """Directories feeding the exporter, with ``fnmatch`` patterns for the file names that matter in each."""
+        targets: dict[pathlib.Path, set[str]] = {}
+        for directory in self.event_dirs:
+            targets.setdefault(pathlib.Path(directory), set()).add("*.jsonl")
+        files = [*self.event_logs, *self.nginx_logs]
+        if self.desired_state is not None:
+            for directory in self.desired_state.desired_state_dirs:
+                targets.setdefault(pathlib.Path(directory), set()).add("*.json")
+            files.extend(self.desired_state.desired_state_files)
+        for path_text in files:
+            path = pathlib.Path(path_text)
+            targets.setdefault(path.parent, set()).add(glob.escape(path.name))
+        return targets
+
+    def next_wakeup(self, now: float, refresh_seconds: float) -> float | None:
+        """When the rendered output changes with no new input, if ever.
+
+        In-progress and drift ages grow with wall-clock time and TTL expiry
+        removes series; both need a re-render even when no log was written.
+        """
+        wakeups: list[float] = []
+        if any(
+            status in {"pending", "running"} and started is not None
+            for _observed, status, _labels, started in self.aggregator.latest_phase_state.values()
+        ):
+            wakeups.append(now + refresh_seconds)
+        elif self.desired_state is not None and self.desired_state.drifted(self.aggregator.current_systems):
+            # Drift age grows with wall-clock time too.
+            wakeups.append(now + refresh_seconds)
+        if self.series_ttl > 0:
+            observed = [entry[1] for entry in self.aggregator.series.values()]
+            observed.extend(entry[3] for entry in self.aggregator.histograms.values())
+            observed.extend(self.aggregator.last_seen.values())
+            observed.extend(state[0] for state in self.aggregator.latest_phase_state.values())
+            if observed:
+                wakeups.append(max(now, min(observed) + self.series_ttl))
+        return min(wakeups) if wakeups else None
 
 
 class MetricsHandler(http.server.BaseHTTPRequestHandler):
-    event_logs: list[str] = []
-    event_dirs: list[str] = []
-    nginx_logs: list[str] = []
-    expected_targets: list[str] = []
+    exporter: EventExporter | None = None
     refresh_seconds: float = DEFAULT_REFRESH_SECONDS
 
-    # A single cached snapshot shared across all handler threads. Rendering the
-    # metrics re-reads the whole log history, so we serialize it behind a lock
-    # and reuse the result for ``refresh_seconds``. Without this, a slow render
-    # (large logs) lets Prometheus scrapes pile up — every concurrent scrape
-    # re-reading the logs at once — which is how the exporter ballooned to
-    # hundreds of GB of RSS.
+    # A single cached snapshot shared across all handler threads. Rendering
+    # mutates the shared exporter state, so we serialize it behind a lock and
+    # reuse the result for ``refresh_seconds``. Without this, a slow render
+    # (large logs, e.g. right after a rotation forces a full replay) lets
+    # Prometheus scrapes pile up — every concurrent scrape re-reading the logs
+    # at once — which is how the exporter ballooned to hundreds of GB of RSS.
     _cache_lock = threading.Lock()
     _cache_text: str | None = None
     _cache_at: float = 0.0
 
     @classmethod
     def cached_metrics(cls) -> str:
+        assert cls.exporter is not None
         with cls._cache_lock:
             now = time.monotonic()
             if cls._cache_text is None or (now - cls._cache_at) >= cls.refresh_seconds:
-                cls._cache_text = render_metrics(
-                    cls.event_logs,
-                    cls.event_dirs,
-                    cls.nginx_logs,
-                    cls.expected_targets,
-                )
+                cls._cache_text = cls.exporter.render()
                 cls._cache_at = now
             return cls._cache_text
 
@@ -495,11 +1393,23 @@ class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     daemon_threads = True
 
 
+def exporter_from_args(args: argparse.Namespace) -> EventExporter:
+    return EventExporter(
+        args.event_log,
+        args.event_dir,
+        args.nginx_log,
+        args.expected_target,
+        max_line_bytes=args.max_line_bytes,
+        series_ttl=args.series_ttl,
+        validator=args.validator,
+        quarantine=args.quarantine,
+        max_open_deployments=args.max_open_deployments,
+        desired_state=args.desired_state,
+    )
+
+
 def serve(args: argparse.Namespace) -> None:
-    MetricsHandler.event_logs = args.event_log
-    MetricsHandler.event_dirs = args.event_dir
-    MetricsHandler.nginx_logs = args.nginx_log
-    MetricsHandler.expected_targets = args.expected_target
+    MetricsHandler.exporter = exporter_from_args(args)
     MetricsHandler.refresh_seconds = args.refresh_interval
 
     servers = []
@@ -516,7 +1426,226 @@ def serve(args: argparse.Namespace) -> None:
             server.shutdown()
 
 
-def self_test() -> None:
+# inotify(7) constants from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+
+class InotifyWatcher:
+    """Block until a watched log changes, using inotify on the containing directories.
+
+    Watching directories rather than files also catches logs that are created
+    or rotated after startup.
+    """
+
+    def __init__(self, targets: dict[pathlib.Path, set[str]]) -> None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.names: dict[int, set[str]] = {}
+        for directory, names in targets.items():
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                print(
+                    f"deployment-event-metrics: not watching {directory}: {os.strerror(errno)}",
+                    file=sys.stderr,
+                )
+                continue
+            self.names[wd] = names
+
+    def _relevant(self, wd: int, mask: int, name: bytes) -> bool:
+        if mask & (IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+            return True
+        text = os.fsdecode(name)
+        return any(fnmatch.fnmatchcase(text, pattern) for pattern in self.names.get(wd, ()))
+
+    def wait(self, timeout: float | None) -> bool:
+        """Wait up to ``timeout`` seconds (forever for ``None``); report whether an input changed."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        changed = False
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                name = buffer[offset : offset + length].rstrip(b"\0")
+                offset += length
+                changed = changed or self._relevant(wd, mask, name)
+
+
+class StatWatcher:
+    """Fallback change detection for hosts without inotify: poll file metadata."""
+
+    def __init__(self, exporter: EventExporter, interval: float) -> None:
+        self.exporter = exporter
+        self.interval = interval
+        self.fingerprint = self._fingerprint()
+
+    def _fingerprint(self) -> tuple:
+        result = []
+        for path in self.exporter.input_paths():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            result.append((str(path), stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return tuple(result)
+
+    def wait(self, timeout: float | None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            step = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if step <= 0:
+                return False
+            time.sleep(step)
+            fingerprint = self._fingerprint()
+            if fingerprint != self.fingerprint:
+                self.fingerprint = fingerprint
+                return True
+
+
+def write_textfile(path: pathlib.Path, text: str) -> None:
+    """Atomically replace ``path`` so node_exporter never reads a partial exposition."""
+    # The temporary name must not end in ``.prom``, or node_exporter may pick
+    # up the half-written file.
+    handle = tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False
+    )
+    try:
+        with handle:
+            handle.write(text)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.chmod(handle.name, 0o644)
+        os.replace(handle.name, path)
+    except BaseException:
+        pathlib.Path(handle.name).unlink(missing_ok=True)
+        raise
+
+
+def serve_textfile(args: argparse.Namespace) -> None:
+    """Keep ``<textfile-dir>/mcl_deployment_events.prom`` current for node_exporter's textfile collector.
+
+    The process sleeps until an input log changes (or until an in-progress age
+    or TTL expiry is due), then renders once the burst of writes settles. An
+    idle host therefore does no periodic work at all.
+    """
+    exporter = exporter_from_args(args)
+    try:
+        watcher: InotifyWatcher | StatWatcher = InotifyWatcher(exporter.watch_targets())
+    except OSError as exc:
+        print(
+            f"deployment-event-metrics: inotify unavailable ({exc}); polling every {args.refresh_interval:g}s",
+            file=sys.stderr,
+        )
+        watcher = StatWatcher(exporter, args.refresh_interval)
+
+    output = pathlib.Path(args.textfile_dir) / TEXTFILE_NAME
+    written: str | None = None
+    while True:
+        now = dt.datetime.now(dt.timezone.utc).timestamp()
+        text = exporter.render(now)
+        if text != written:
+            write_textfile(output, text)
+            written = text
+        wakeup = exporter.next_wakeup(now, args.refresh_interval)
+        timeout = None if wakeup is None else max(0.0, wakeup - dt.datetime.now(dt.timezone.utc).timestamp())
+        if watcher.wait(timeout):
+            # Debounce, but never postpone a render indefinitely under a
+            # continuous stream of writes.
+            settle_until = time.monotonic() + 10 * args.textfile_debounce
+            while time.monotonic() < settle_until and watcher.wait(args.textfile_debounce):
+                pass
+
+
+def benchmark_validation(validator: EventValidator, count: int) -> dict[str, float]:
+    """Time the per-line cost of the compiled validator relative to parsing the line.
+
+    Ingestion is timed for context only: its cost moves with every metric the
+    aggregator gains, so it is no baseline for the validator.
+    """
+    line = json.dumps(
+        {
+            "schemaVersion": 1,
+            "deploymentId": "gh-123456789-abcdef0-app-server-01",
+            "correlationId": "gh-123456789-abcdef0-app-server-01-0123456789abcdfghijklmnpqrsvwxyz",
+            "phase": "cache-push",
+            "target": {"name": "app-server-01", "system": "x86_64-linux", "kind": "server", "transport": "cachix-agent"},
+            "backend": {"cache": "example-private-cache", "controller": "attic", "substituters": ["https://cache.example"]},
+            "storePaths": {
+                "system": "/nix/store/0123456789abcdfghijklmnpqrsvwxyz-nixos-system-app-server-01-25.11",
+                "closure": {"count": 512, "totalBytes": 4294967296, "rootHashes": ["0123456789abcdfghijklmnpqrsvwxyz"]},
+            },
+            "timestamps": {"startedAt": "2026-05-13T09:00:00Z", "finishedAt": "2026-05-13T09:01:00Z"},
+            "command": {"name": "attic push", "argv": ["attic", "push"], "status": "succeeded", "exitCode": 0},
+        }
+    ).encode()
+    if validator(json.loads(line)) is not None:
+        raise AssertionError("benchmark event does not satisfy the schema")
+
+    def parse() -> None:
+        json.loads(line)
+
+    def parse_and_validate() -> None:
+        validator(json.loads(line))
+
+    aggregator = DeploymentAggregator()
+
+    def ingest() -> None:
+        aggregator.ingest(json.loads(line), 0.0)
+
+    # Best of a few rounds, to keep scheduler noise out of the comparison; the
+    # steps take turns so that they all see the same load and CPU frequency.
+    steps: list[Callable[[], None]] = [parse, parse_and_validate, ingest]
+    best = [float("inf")] * len(steps)
+    for _ in range(5):
+        for index, step in enumerate(steps):
+            started = time.perf_counter()
+            for _ in range(count):
+                step()
+            best[index] = min(best[index], time.perf_counter() - started)
+    parse_ns, validate_ns, ingest_ns = (seconds / count * 1e9 for seconds in best)
+    return {
+        "events": count,
+        "parse_ns_per_event": parse_ns,
+        "parse_and_validate_ns_per_event": validate_ns,
+        "validate_ns_per_event": validate_ns - parse_ns,
+        "validation_overhead_vs_parse_percent": (validate_ns - parse_ns) / parse_ns * 100,
+        "parse_and_ingest_ns_per_event": ingest_ns,
+    }
+
+
+def self_test(validator: EventValidator) -> None:
     with tempfile.TemporaryDirectory() as directory:
         root = pathlib.Path(directory)
         event_dir = root / "events"
@@ -749,6 +1878,26 @@ def self_test() -> None:
             + "\n"
         )
 
+        # A runaway producer: an oversized record, a valid record after it that
+        # must still be read, and an oversized record with no trailing newline.
+        runaway_log = event_dir / "runaway.jsonl"
+        runaway_log.write_text(
+            json.dumps({"padding": "x" * 100_000})
+            + "\n"
+            + json.dumps(
+                {
+                    "schemaVersion": 1,
+                    "deploymentId": "dep-5",
+                    "phase": "evaluate",
+                    "target": {"name": "app-server-05"},
+                    "timestamps": {"startedAt": "2026-05-13T09:00:20Z"},
+                    "command": {"status": "running"},
+                }
+            )
+            + "\n"
+            + "{" * 100_000
+        )
+
         output = render_metrics(
             [],
             [str(event_dir)],
@@ -760,6 +1909,8 @@ def self_test() -> None:
                 "app-server-04",
             ],
             now=parse_timestamp("2026-05-13T09:01:00Z"),
+            max_line_bytes=64 * 1024,
+            validator=validator,
         )
         required = [
             'mcl_deployment_phase_duration_seconds{cache="cache",controller="attic",phase="cache-push",status="succeeded",target="app-server-01",transport="cachix-agent"} 5',
@@ -768,6 +1919,11 @@ def self_test() -> None:
             'mcl_deployment_target_seen{target="app-server-02"} 1',
             'mcl_deployment_target_seen{target="app-server-04"} 0',
             'mcl_deployment_in_progress_age_seconds{cache="cache",controller="direct-ssh",phase="switch",status="running",target="app-server-02",transport="direct-ssh"} 50',
+            f'mcl_deployment_event_parse_errors_total{{source="{runaway_log}"}} 2',
+            'mcl_deployment_target_last_seen_timestamp_seconds{target="app-server-05"}',
+            f'mcl_deployment_event_invalid_total{{reason="target.transport:enum",source="{event_log}"}} 4',
+            f'mcl_deployment_event_invalid_total{{reason="storePaths.system:pattern",source="{event_log}"}} 2',
+            f'mcl_deployment_event_invalid_total{{reason="correlationId:required",source="{runaway_log}"}} 1',
             'mcl_attic_nginx_requests_total{method="PUT",operation="upload",status="200"} 1',
             'mcl_attic_nginx_cache_object_failures_total{method="GET",operation="download",status="404"} 1',
         ]
@@ -777,6 +1933,195 @@ def self_test() -> None:
         if 'mcl_deployment_in_progress_age_seconds{cache="cache",controller="direct-ssh",phase="switch",status="running",target="app-server-03",transport="direct-ssh"}' in output:
             raise AssertionError("stale in-progress metric was not cleared:\n" + output)
 
+        # Quarantined events are kept out of the aggregates.
+        quarantine_dir = root / "quarantine"
+        quarantine_dir.mkdir()
+        # A log with the same name in another directory gets its own file.
+        other_log = root / "other" / event_log.name
+        other_log.parent.mkdir()
+        other_log.write_text(event_log.read_text().splitlines()[0] + "\n")
+        quarantine = Quarantine(str(quarantine_dir))
+        output = render_metrics(
+            [str(event_log), str(other_log)],
+            [],
+            [],
+            [],
+            now=parse_timestamp("2026-05-13T09:01:00Z"),
+            validator=validator,
+            quarantine=quarantine,
+        )
+        # Every fixture event above violates the schema somewhere.
+        quarantined = quarantine.path(event_log).read_text().splitlines()
+        if len(quarantined) != 6 or "mcl_deployment_phase_duration_seconds" in output:
+            raise AssertionError("invalid events were not quarantined:\n" + output)
+        if len(quarantine.path(other_log).read_text().splitlines()) != 1:
+            raise AssertionError("logs with the same name share a quarantine file")
+        if json.loads(quarantined[0])["reason"] != "storePaths.system:pattern":
+            raise AssertionError("quarantine entry lacks its rejection reason:\n" + quarantined[0])
+
+        # A completed deployment yields throughput, end-to-end and critical-path
+        # histograms; open deployments past the cap are evicted.
+        def phase_event(deployment_id: str, phase: str, started: str, finished: str, **extra: object) -> dict:
+            return {
+                "deploymentId": deployment_id,
+                "phase": phase,
+                "target": {"name": "app-server-07"},
+                "backend": {"cache": "cache", "controller": "attic"},
+                "timestamps": {"startedAt": f"2026-05-13T10:{started}Z", "finishedAt": f"2026-05-13T10:{finished}Z"},
+                "command": {"status": "succeeded"},
+                **extra,
+            }
+
+        aggregator = DeploymentAggregator(max_open_deployments=2)
+        closure = {"storePaths": {"closure": {"count": 10, "totalBytes": 100_000_000}}}
+        for event in [
+            phase_event("dep-7", "evaluate", "00:00", "01:00"),
+            phase_event("dep-7", "cache-push", "01:00", "01:10", **closure),
+            phase_event("dep-8", "evaluate", "01:00", "01:30"),
+            phase_event("dep-7", "agent-restore", "01:20", "01:30"),
+            phase_event("dep-7", "complete", "01:40", "01:41"),
+            phase_event("dep-9", "evaluate", "02:00", "02:30"),
+            phase_event("dep-10", "evaluate", "03:00", "03:30"),
+        ]:
+            aggregator.ingest(event, 0)
+        output = format_metrics(aggregator.collect([], parse_timestamp("2026-05-13T10:05:00Z")))
+        labels = 'cache="cache",controller="attic"'
+        required = [
+            f'mcl_deployment_end_to_end_seconds_bucket{{{labels},le="60",target="app-server-07"}} 0',
+            f'mcl_deployment_end_to_end_seconds_bucket{{{labels},le="120",target="app-server-07"}} 1',
+            f'mcl_deployment_end_to_end_seconds_sum{{{labels},target="app-server-07"}} 101',
+            f'mcl_deployment_critical_path_seconds_sum{{{labels},phase="evaluate",target="app-server-07"}} 60',
+            f'mcl_deployment_critical_path_seconds_sum{{{labels},phase="idle",target="app-server-07"}} 20',
+            f'mcl_deployment_closure_transfer_bytes_per_second_bucket{{{labels},le="10000000",phase="agent-restore",target="app-server-07"}} 1',
+            f'mcl_deployment_closure_transfer_bytes_per_second_bucket{{{labels},le="5000000",phase="agent-restore",target="app-server-07"}} 0',
+            "# TYPE mcl_deployment_end_to_end_seconds histogram",
+            "mcl_deployment_open_deployments 2",
+            "mcl_deployment_open_deployments_evicted_total 1",
+        ]
+        missing = [line for line in required if line not in output]
+        if missing or list(aggregator.open_deployments) != [("dep-9", "app-server-07"), ("dep-10", "app-server-07")]:
+            raise AssertionError("missing deployment latency metrics:\n" + "\n".join(missing) + "\n\n" + output)
+
+        # The long-lived exporter folds in only appended events, rebuilds when a
+        # log is rewritten, and expires series of targets that went quiet.
+        failures = 'mcl_deployment_phase_failures_total{cache="cache",controller="cachix-deploy",error_code="cache_restore_failed",phase="agent-restore",target="app-server-01",transport="cachix-agent"} 1'
+        exporter = EventExporter([str(event_log)], [], [], [], series_ttl=3600)
+        for _ in range(2):
+            output = exporter.render(now=parse_timestamp("2026-05-13T09:01:00Z"))
+            if failures not in output:
+                raise AssertionError("incremental refresh double-counted events:\n" + output)
+        fixture = event_log.read_text()
+        with event_log.open("a") as handle:
+            handle.write(
+                json.dumps(
+                    {
+                        "schemaVersion": 1,
+                        "deploymentId": "dep-6",
+                        "phase": "evaluate",
+                        "target": {"name": "app-server-06"},
+                        "timestamps": {
+                            "startedAt": "2026-05-13T11:00:00Z",
+                            "finishedAt": "2026-05-13T11:00:30Z",
+                        },
+                        "command": {"status": "succeeded"},
+                    }
+                )
+                + "\n"
+            )
+        output = exporter.render(now=parse_timestamp("2026-05-13T11:30:00Z"))
+        if 'mcl_deployment_target_last_seen_timestamp_seconds{target="app-server-06"}' not in output:
+            raise AssertionError("appended event was not picked up:\n" + output)
+        if 'target="app-server-01"' in output or any(
+            ("target", "app-server-01") in key[1]
+            for key in [*exporter.aggregator.series, *exporter.aggregator.histograms]
+        ):
+            raise AssertionError("series past --series-ttl were not expired:\n" + output)
+        event_log.write_text(fixture)
+        output = exporter.render(now=parse_timestamp("2026-05-13T09:01:00Z"))
+        if failures not in output or "app-server-06" in output:
+            raise AssertionError("rewritten log was not replayed from scratch:\n" + output)
+
+        # Desired state is compared against each target's latest successful
+        # switch; records are re-read when they change.
+        desired_dir = root / "desired"
+        desired_dir.mkdir()
+        switch_log = root / "switch.jsonl"
+
+        def desired_record(target: str, system_path: str, sequence: int, superseded_at: str | None) -> str:
+            superseded = None
+            if superseded_at is not None:
+                superseded = {"deploymentId": "old", "sequence": sequence - 1, "supersededAt": superseded_at}
+            return json.dumps(
+                {
+                    "target": {"name": target},
+                    "desiredSystemPath": system_path,
+                    "sequence": sequence,
+                    "supersededState": superseded,
+                }
+            )
+
+        def switch_event(system_path: str, finished: str) -> str:
+            return json.dumps(
+                {
+                    "deploymentId": "dep-11",
+                    "phase": "switch",
+                    "target": {"name": "app-server-08"},
+                    "storePaths": {"system": system_path},
+                    "timestamps": {"startedAt": "2026-05-13T10:00:00Z", "finishedAt": finished},
+                    "command": {"status": "succeeded"},
+                }
+            ) + "\n"
+
+        switch_log.write_text(switch_event("/nix/store/a-system", "2026-05-13T10:00:10Z"))
+        (desired_dir / "app-server-08.json").write_text(desired_record("app-server-08", "/nix/store/a-system", 1, None))
+        (desired_dir / "app-server-09.json").write_text(
+            desired_record("app-server-09", "/nix/store/b-system", 2, "2026-05-13T09:00:00Z")
+        )
+        (desired_dir / "broken.json").write_text("{")
+        drift_exporter = EventExporter(
+            [str(switch_log)], [], [], [], desired_state=DesiredStateIndex([], [str(desired_dir)])
+        )
+        drift_output = drift_exporter.render(now=parse_timestamp("2026-05-13T10:00:00Z"))
+        required = [
+            'mcl_deployment_target_drifted{target="app-server-08"} 0',
+            'mcl_deployment_target_drifted{target="app-server-09"} 1',
+            'mcl_deployment_target_drift_seconds{target="app-server-09"} 3600',
+            "mcl_deployment_drifted_targets 1",
+            f'mcl_deployment_desired_state_invalid{{source="{desired_dir / "broken.json"}"}} 1',
+        ]
+        (desired_dir / "app-server-08.json").write_text(
+            desired_record("app-server-08", "/nix/store/c-system", 2, "2026-05-13T09:30:00Z")
+        )
+        drift_output += drift_exporter.render(now=parse_timestamp("2026-05-13T10:00:00Z"))
+        required.append('mcl_deployment_target_drift_seconds{target="app-server-08"} 1800')
+        with switch_log.open("a") as handle:
+            handle.write(switch_event("/nix/store/c-system", "2026-05-13T10:00:20Z"))
+        final = drift_exporter.render(now=parse_timestamp("2026-05-13T10:00:30Z"))
+        missing = [line for line in required if line not in drift_output]
+        if missing or 'mcl_deployment_target_drifted{target="app-server-08"} 0' not in final:
+            raise AssertionError("missing drift metrics:\n" + "\n".join(missing) + "\n\n" + drift_output + final)
+        if desired_dir not in drift_exporter.watch_targets():
+            raise AssertionError("desired-state directory is not watched in textfile mode")
+        # A target that switched long ago and still matches its desired state
+        # is not drifted once its series pass --series-ttl.
+        ttl_exporter = EventExporter(
+            [str(switch_log)], [], [], [], series_ttl=3600, desired_state=DesiredStateIndex([], [str(desired_dir)])
+        )
+        week_later = ttl_exporter.render(now=parse_timestamp("2026-05-20T10:00:30Z"))
+        if 'mcl_deployment_target_drifted{target="app-server-08"} 0' not in week_later:
+            raise AssertionError("matching switch older than --series-ttl reported as drift:\n" + week_later)
+
+        now = parse_timestamp("2026-05-13T09:01:00Z")
+        if exporter.next_wakeup(now, 15) != now + 15:
+            raise AssertionError("in-progress deployments must schedule a textfile re-render")
+        textfile_dir = root / "textfile"
+        textfile_dir.mkdir()
+        write_textfile(textfile_dir / TEXTFILE_NAME, output)
+        if [p.name for p in textfile_dir.iterdir()] != [TEXTFILE_NAME]:
+            raise AssertionError("textfile write left temporary files behind")
+        if (textfile_dir / TEXTFILE_NAME).read_text() != output:
+            raise AssertionError("textfile content does not match the rendered exposition")
+
 
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
@@ -789,6 +2134,18 @@ def build_parser() -> argparse.ArgumentParser:
     )
     parser.add_argument("--nginx-log", action="append", default=[], help="Attic nginx JSONL access log to read")
     parser.add_argument("--expected-target", action="append", default=[], help="Target expected to emit deployment events")
+    parser.add_argument(
+        "--desired-state-file",
+        action="append",
+        default=[],
+        help="Desired-state JSON record to compare targets' last successful switch against",
+    )
+    parser.add_argument(
+        "--desired-state-dir",
+        action="append",
+        default=[],
+        help="Directory of desired-state *.json records; re-read when a record changes",
+    )
     parser.add_argument("--port", type=int, default=DEFAULT_PORT)
     parser.add_argument("--bind-addresses", default="127.0.0.1")
     parser.add_argument(
@@ -801,6 +2158,67 @@ def build_parser() -> argparse.ArgumentParser:
             f"(default: {DEFAULT_REFRESH_SECONDS:g})"
         ),
     )
+    parser.add_argument(
+        "--max-line-bytes",
+        type=int,
+        default=DEFAULT_MAX_LINE_BYTES,
+        help=(
+            "Longest JSONL record to parse; longer lines are skipped, counted as "
+            f"parse errors, and reading resumes at the next newline (default: {DEFAULT_MAX_LINE_BYTES})"
+        ),
+    )
+    parser.add_argument(
+        "--series-ttl",
+        type=float,
+        default=0.0,
+        help=(
+            "Drop deployment series whose latest event is older than this many "
+            "seconds, so retired targets leave the exposition (default: 0, never expire)"
+        ),
+    )
+    parser.add_argument(
+        "--max-open-deployments",
+        type=int,
+        default=DEFAULT_MAX_OPEN_DEPLOYMENTS,
+        help=(
+            "Track at most this many deployments that have not completed yet for "
+            f"end-to-end latency; the least recently updated is evicted (default: {DEFAULT_MAX_OPEN_DEPLOYMENTS})"
+        ),
+    )
+    parser.add_argument(
+        "--textfile-dir",
+        help=(
+            "Instead of serving HTTP, write the exposition to "
+            f"DIR/{TEXTFILE_NAME} for node_exporter's textfile collector whenever inputs change"
+        ),
+    )
+    parser.add_argument(
+        "--textfile-debounce",
+        type=float,
+        default=DEFAULT_TEXTFILE_DEBOUNCE_SECONDS,
+        help=(
+            "Seconds the inputs must stay quiet before the textfile is rewritten "
+            f"(default: {DEFAULT_TEXTFILE_DEBOUNCE_SECONDS:g})"
+        ),
+    )
+    parser.add_argument(
+        "--event-schema",
+        type=pathlib.Path,
+        help=(
+            "DeploymentEvent JSON Schema to validate every event against; invalid events are counted "
+            "in mcl_deployment_event_invalid_total (default: no validation)"
+        ),
+    )
+    parser.add_argument(
+        "--quarantine-dir",
+        help="Write schema-invalid events to DIR/<log name>.<path hash>.invalid and leave them out of the metrics",
+    )
+    parser.add_argument(
+        "--benchmark-validation",
+        type=int,
+        metavar="EVENTS",
+        help="Measure JSON parsing with and without schema validation over EVENTS events and exit",
+    )
     parser.add_argument("--once", action="store_true", help="Print one metrics snapshot and exit")
     parser.add_argument("--self-test", action="store_true", help="Run deterministic parser/rendering self-test")
     return parser
@@ -812,9 +2230,41 @@ def main(argv: list[str] | None = None) -> int:
     args.bind_addresses = [part.strip() for part in args.bind_addresses.split(",") if part.strip()]
     if not args.bind_addresses:
         args.bind_addresses = ["127.0.0.1"]
+    if args.max_line_bytes < 1:
+        parser.error("--max-line-bytes must be positive")
+    if args.series_ttl < 0:
+        parser.error("--series-ttl must not be negative")
+    if args.max_open_deployments < 1:
+        parser.error("--max-open-deployments must be positive")
+
+    args.validator = None
+    if args.event_schema is not None:
+        try:
+            args.validator = compile_event_schema(args.event_schema)
+        except (OSError, ValueError) as exc:
+            parser.error(f"cannot compile --event-schema {args.event_schema}: {exc}")
+    args.quarantine = None
+    if args.quarantine_dir:
+        if args.validator is None:
+            parser.error("--quarantine-dir requires --event-schema")
+        if pathlib.Path(args.quarantine_dir).resolve() in {pathlib.Path(d).resolve() for d in args.event_dir}:
+            parser.error("--quarantine-dir must not be one of the --event-dir directories")
+        args.quarantine = Quarantine(args.quarantine_dir)
+    args.desired_state = None
+    if args.desired_state_file or args.desired_state_dir:
+        args.desired_state = DesiredStateIndex(args.desired_state_file, args.desired_state_dir)
+
+    if args.benchmark_validation is not None:
+        if args.validator is None:
+            parser.error("--benchmark-validation requires --event-schema")
+        json.dump(benchmark_validation(args.validator, args.benchmark_validation), sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return 0
 
     if args.self_test:
-        self_test()
+        if args.validator is None:
+            parser.error("--self-test requires --event-schema")
+        self_test(args.validator)
         print("deployment-event-metrics: self-test passed")
         return 0
 
@@ -823,10 +2273,25 @@ def main(argv: list[str] | None = None) -> int:
 
     if args.once:
         sys.stdout.write(
-            render_metrics(args.event_log, args.event_dir, args.nginx_log, args.expected_target)
+            render_metrics(
+                args.event_log,
+                args.event_dir,
+                args.nginx_log,
+                args.expected_target,
+                max_line_bytes=args.max_line_bytes,
+                series_ttl=args.series_ttl,
+                validator=args.validator,
+                quarantine=args.quarantine,
+                max_open_deployments=args.max_open_deployments,
+                desired_state=args.desired_state,
+            )
         )
         return 0
 
+    if args.textfile_dir:
+        serve_textfile(args)
+        return 0
+
     serve(args)
     return 0
 
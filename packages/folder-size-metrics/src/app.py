@@ -1,66 +1,2556 @@
 import subprocess
 import os
+import collections
+import concurrent.futures
+import grp
+import pwd
+import ctypes
+import fcntl
+import fnmatch
+import heapq
+import itertools
+import json
+import queue
+import select
+import signal
+import sqlite3
+import struct
+import tempfile
+import threading
 import time
-from prometheus_client import start_http_server, Gauge
+from http.server import ThreadingHTTPServer
+from bisect import bisect_left
+from stat import S_ISDIR
+from urllib.parse import parse_qs, urlsplit
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import (
+    GaugeMetricFamily, HistogramMetricFamily, REGISTRY)
+from prometheus_client.exposition import MetricsHandler
 
 PORT = int(os.environ["PORT"])
-BASE_PATH = os.environ["BASE_PATH"]
-INTERVAL_SEC = int(os.environ["INTERVAL_SEC"])
+# BASE_PATH and the settings below describe a single job unless JOBS is set.
+BASE_PATH = os.environ.get("BASE_PATH")
+INTERVAL_SEC = int(os.environ.get("INTERVAL_SEC", 60))
+# "scandir" walks the tree in-process; "du" forks du(1) as before; "nix"
+# reads store path sizes from the Nix database instead of the file system;
+# "quota" reads subdirectories that are btrfs subvolumes, ZFS datasets or
+# XFS project quota directories from the file system's own accounting and
+# walks the rest like "scandir".
+SCAN_BACKEND = os.environ.get("SCAN_BACKEND", "scandir")
+SCAN_THREADS = int(os.environ.get(
+    "SCAN_THREADS", min(32, (os.cpu_count() or 1) + 4)))
+CROSS_MOUNTS = os.environ.get("CROSS_MOUNTS", "false") == "true"
+# du processes the du backend runs at once, one per immediate subdirectory
+# when more than 1.
+DU_PROCESSES = int(os.environ.get("DU_PROCESSES", 1))
+# At most this many stat calls per second per job; 0 means unlimited.
+STAT_RATE = int(os.environ.get("STAT_RATE", 0))
+# While scans find nothing changed, the interval doubles up to this
+# (by default four times the job's interval).
+MAX_INTERVAL_SEC = os.environ.get("MAX_INTERVAL_SEC")
+# The walker keeps the TOP_K largest files and directories, and the TOP_K
+# directories that grew most since the previous scan; 0 disables it.
+TOP_K = int(os.environ.get("TOP_K", 20))
+# Also count files, subdirectories and inodes and bucket file ages per
+# reported path, from the same walk.
+FILE_STATS = os.environ.get("FILE_STATS", "true") == "true"
+# Also account usage per file owner and group; past OWNER_TOP_K of each,
+# the rest is reported as "other".
+OWNER_STATS = os.environ.get("OWNER_STATS", "false") == "true"
+OWNER_TOP_K = int(os.environ.get("OWNER_TOP_K", 20))
+# Upper bounds of the file age buckets, in seconds.
+AGE_BUCKETS = (3600, 86400, 7 * 86400, 30 * 86400, 90 * 86400, 365 * 86400)
+# Sizes kept per path to fit its growth rate and time to full; 0 disables.
+GROWTH_WINDOW = int(os.environ.get("GROWTH_WINDOW", 12))
+# Largest fraction of the time a job may spend scanning; slower scans
+# stretch the interval instead of running back to back.
+SCAN_DUTY_CYCLE = float(os.environ.get("SCAN_DUTY_CYCLE", 0.5))
+# Seconds a scan may take, once it has its device, before it is cancelled
+# and only the subtrees it finished are published; 0 means no limit.
+SCAN_TIMEOUT_SEC = int(os.environ.get("SCAN_TIMEOUT_SEC", 0))
+# Directories down to this many levels below BASE_PATH get their own series,
+# all from one walk.
+SCAN_DEPTH = int(os.environ.get("SCAN_DEPTH", 1))
+# [{"include": [globs], "exclude": [globs]}, ...] for levels 1, 2, ...,
+# matched against paths relative to BASE_PATH. Missing levels include all.
+LEVEL_FILTERS = json.loads(os.environ.get("LEVEL_FILTERS", "[]"))
+# Directories remembered between scans; 0 disables the cache.
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 1_000_000))
+# Optional file the cache is persisted to, so restarts start warm.
+CACHE_FILE = os.environ.get("CACHE_FILE")
+# Optional file the sizes of every job's last scan are saved to and served
+# from on start, until the first scan of the new process replaces them.
+RESULTS_FILE = os.environ.get("RESULTS_FILE")
+# Seconds between full scans that read every directory regardless of the
+# cache, bounding how long in-place file growth can go unnoticed.
+VERIFY_INTERVAL_SEC = int(os.environ.get("VERIFY_INTERVAL_SEC", 900))
+# "poll" rescans every INTERVAL_SEC. "fanotify", "inotify" and "auto"
+# (fanotify, falling back to inotify) rescan only the subtrees that
+# changed, EVENT_DEBOUNCE_SEC after changes stop.
+WATCH_MODE = os.environ.get("WATCH_MODE", "poll")
+EVENT_DEBOUNCE_SEC = int(os.environ.get("EVENT_DEBOUNCE_SEC", 2))
+# [{"path": ..., "interval-sec": ..., ...}, ...]: several base paths on their
+# own schedules, with the option names of the NixOS module. Settings a job
+# leaves out (or null) fall back to the ones above.
+JOBS = json.loads(os.environ.get("JOBS", "[]"))
+NIX_DB = os.environ.get("NIX_DB", "/nix/var/nix/db/db.sqlite")
+NIX_GC_ROOTS_DIR = os.environ.get("NIX_GC_ROOTS_DIR", "/nix/var/nix/gcroots")
+# Only the largest store paths (and GC root closures) get their own series.
+NIX_TOP_K = int(os.environ.get("NIX_TOP_K", 50))
+# Also compute what the GC roots keep alive and each root's closure size.
+NIX_GC_ROOTS = os.environ.get("NIX_GC_ROOTS", "false") == "true"
 
 
 # Using du rather than os.path.obtainsize since getsize provides the
 # apparent directory size and du provides the disk size.
-def get_immediate_subdirs_size(BASE_PATH):
+#
+# Returns (sizes, errors, complete). du prints each directory once its
+# subtree is summed, so when it is killed at the `deadline` (a
+# time.monotonic() value) or fails on some entries, the directories it
+# did print are still exact; `errors` counts the entries it could not read.
+# `on_subdir(path, size)` is called for each directory as du prints it.
+#
+# With `processes` > 1, one du per immediate subdirectory runs, that many
+# at a time. Hard links shared between subdirectories are then counted in
+# each of them.
+def get_immediate_subdirs_size(BASE_PATH, cross_mounts=CROSS_MOUNTS,
+                               depth=SCAN_DEPTH, deadline=None,
+                               on_subdir=None, processes=DU_PROCESSES):
+    command = ['du', '--null', '--block-size=1']
+    if not cross_mounts:
+        command.append('--one-file-system')
+    targets = [(BASE_PATH, depth)]
+    if processes > 1:
+        try:
+            base_dev = os.stat(BASE_PATH).st_dev
+            with os.scandir(BASE_PATH) as entries:
+                targets = [
+                    (entry.path, depth - 1) for entry in entries
+                    if entry.is_dir(follow_symlinks=False) and (
+                        cross_mounts or entry.stat(
+                            follow_symlinks=False).st_dev == base_dev)
+                ]
+        except OSError as e:
+            print(f"Error scanning {BASE_PATH}: {e}")
+            return None, 0, False
+    sizes = {}
+
+    def on_size(path, size):
+        if path != BASE_PATH:
+            sizes[path] = size
+            if on_subdir is not None:
+                on_subdir(path, size)
+
+    def run(target):
+        path, max_depth = target
+        return run_du(command + [f'--max-depth={max_depth}', path],
+                      deadline, on_size)
+
     try:
-        result = subprocess.run(
-            ['du', '--max-depth=1', '--block-size=1', BASE_PATH],
-            capture_output=True, text=True, check=True
-        )
-        lines = result.stdout.strip().split('\n')
+        with concurrent.futures.ThreadPoolExecutor(
+                max(1, processes)) as pool:
+            outcomes = list(pool.map(run, targets))
+    except OSError as e:
+        print(f"Error executing du command: {e}")
+        return None, 0, False
+    errors = sum(len(messages) for messages, _complete, _code in outcomes)
+    complete = all(complete for _messages, complete, _code in outcomes)
+    if complete and not sizes and any(code for _m, _c, code in outcomes):
+        for messages, _complete, code in outcomes:
+            if code:
+                print(f"du exited with {code}: {' '.join(messages)}")
+        return None, errors, False
+    return sizes, errors, complete
+
+
+def run_du(command, deadline, on_size):
+    """Run du `command` (with --null), calling `on_size(path, bytes)` for
+    each directory as soon as du prints it, and killing du at `deadline`.
+
+    Returns (error messages, complete, exit code).
+    """
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    messages = []
+
+    def read_errors():
+        messages.extend(
+            line for line in process.stderr.read().decode(
+                errors="replace").splitlines() if line)
+
+    stderr_reader = threading.Thread(target=read_errors, daemon=True)
+    stderr_reader.start()
+    timer = None
+    if deadline is not None:
+        timer = threading.Timer(
+            max(0, deadline - time.monotonic()), process.kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        pending = b""
+        for chunk in iter(lambda: process.stdout.read1(65536), b""):
+            records = (pending + chunk).split(b"\0")
+            # The last record is incomplete until its NUL arrives.
+            pending = records.pop()
+            for record in records:
+                size, tab, path = record.partition(b"\t")
+                if tab:
+                    on_size(os.fsdecode(path), int(size))
+        process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        stderr_reader.join()
+    killed = process.returncode == -signal.SIGKILL
+    return messages, not killed, process.returncode
+
+
+class SubtreeCache:
+    """What a directory held when last read, keyed by its own metadata.
+
+    A directory's mtime and ctime change whenever an entry is added,
+    removed or renamed in it, so while (mtime, ctime, size, nlink) match,
+    its entry list is unchanged and the walker can skip reading it. A file
+    growing in place does not touch its directory, which is why callers
+    must still do a full scan now and then.
+
+    Every scan visits every directory in the same order, which defeats
+    LRU eviction once the tree outgrows the cache. Instead, no new
+    directories are admitted once `max_entries` is reached, and `prune`
+    drops the ones a complete scan no longer visited.
+
+    Each entry also keeps the directory's largest files, its file counts
+    and age buckets, and its usage per owner at the time it was read, so
+    the walker's indexes stay complete without reading the directory
+    again. Ages are as stale as sizes: at most one verification interval.
+    """
+
+    VERSION = 4
+
+    def __init__(self, max_entries, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        # directory -> [key, blocks, links, subdirs, generation, files,
+        #               counts, usage]
+        self.entries = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    def get(self, directory, key):
+        with self.lock:
+            cached = self.entries.get(directory)
+            if cached is None or cached[0] != key:
+                return None
+            cached[4] = self.generation
+            return cached
+
+    def put(self, directory, key, blocks, links, subdirs, files=(),
+            counts=None, usage=None):
+        with self.lock:
+            if (directory in self.entries
+                    or len(self.entries) < self.max_entries):
+                self.entries[directory] = [
+                    key, blocks, links, subdirs, self.generation, files,
+                    counts, usage]
+
+    def invalidate(self, directory):
+        with self.lock:
+            self.entries.pop(directory, None)
+
+    def prune(self):
+        """Forget directories the scan that just finished did not visit."""
+        with self.lock:
+            self.entries = {
+                directory: cached
+                for directory, cached in self.entries.items()
+                if cached[4] == self.generation
+            }
+            self.generation += 1
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") != self.VERSION:
+                return
+            for (directory, key, blocks, links, subdirs, files, counts,
+                 usage) in data["entries"]:
+                self.entries[directory] = [
+                    tuple(key), blocks, [tuple(link) for link in links],
+                    subdirs, self.generation, [tuple(f) for f in files],
+                    counts, usage]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring scan cache {self.path}: {e}")
+            self.entries.clear()
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            entries = [
+                [directory, *cached[:4], *cached[5:]]
+                for directory, cached in self.entries.items()
+            ]
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".scan-cache.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": self.VERSION, "entries": entries}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Could not save scan cache {self.path}: {e}")
+            os.unlink(tmp)
+
+
+class ScanResults:
+    """The sizes each job reported last, saved to `path` after every scan.
+
+    Shared by all jobs; each scan rewrites the whole file, atomically, so
+    a crash leaves the previous version in place.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        # base path -> {"scanned": unix time, "sizes": {path: bytes}}
+        self.jobs = {}
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    def get(self, base_path):
+        with self.lock:
+            return self.jobs.get(base_path)
+
+    def update(self, base_path, sizes, only=None, scanned=None):
+        """Record a scan of `base_path`; a partial scan replaces only the
+        paths below the subdirectories in `only`. Without `scanned`, the
+        time of the previous complete scan is kept.
+        """
+        with self.lock:
+            kept = {}
+            previous = self.jobs.get(base_path)
+            if scanned is None:
+                scanned = time.time() if previous is None else (
+                    previous["scanned"])
+            if only is not None and previous is not None:
+                kept = {
+                    path: size
+                    for path, size in previous["sizes"].items()
+                    if os.path.join(base_path, os.path.relpath(
+                        path, base_path).split(os.sep, 1)[0]) not in only
+                }
+            kept.update(sizes)
+            self.jobs[base_path] = {
+                "scanned": scanned,
+                "sizes": kept,
+            }
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") != self.VERSION:
+                return
+            self.jobs = {
+                base_path: {
+                    "scanned": float(result["scanned"]),
+                    "sizes": dict(result["sizes"]),
+                }
+                for base_path, result in data["jobs"].items()
+            }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring scan results {self.path}: {e}")
+            self.jobs = {}
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".scan-results.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": self.VERSION, "jobs": self.jobs}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Could not save scan results {self.path}: {e}")
+            os.unlink(tmp)
+
+
+class StatBudget:
+    """Token bucket that holds callers to `rate` stat calls per second.
+
+    Calls are paid for after the fact, so the bucket may go into debt;
+    the caller then sleeps it off, which keeps the long-run rate at
+    `rate` however many threads share the bucket.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, count):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            debt = -self.tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+
+class SizeIndex:
+    """The `k` largest files and directories, and the `k` directories
+    that grew most since the previous scan.
+
+    Results are kept per top-level subdirectory and swapped in when a
+    scan of it completes, so a partial rescan replaces only what it
+    walked and readers never see a half-built list. Growth needs every
+    directory's total from the previous scan, about 100 bytes each.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.lock = threading.Lock()
+        # top -> heap of (bytes, path), or {directory: bytes}
+        self.files = {}
+        self.dirs = {}
+        self.totals = {}
+        self.growth = {}
+        self.scanned_at = None
+
+    def begin(self, tops):
+        with self.lock:
+            self.new_files = {top: [] for top in tops}
+            self.new_dirs = {top: [] for top in tops}
+            self.new_totals = {top: {} for top in tops}
+
+    def floor(self, top):
+        """Smallest file size that can still make `top`'s list."""
+        heap = self.new_files.get(top)
+        return heap[0][0] if heap and len(heap) >= self.k else 0
+
+    def add_files(self, top, files):
+        with self.lock:
+            heap = self.new_files[top]
+            for entry in files:
+                if len(heap) < self.k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+    def add_dir(self, top, path, size):
+        with self.lock:
+            self.new_totals[top][path] = size
+            heap = self.new_dirs[top]
+            if len(heap) < self.k:
+                heapq.heappush(heap, (size, path))
+            elif size > heap[0][0]:
+                heapq.heapreplace(heap, (size, path))
+
+    def adjust(self, top, deltas):
+        """Add {directory: bytes} to totals of `top` already added."""
+        with self.lock:
+            totals = self.new_totals.get(top)
+            if totals is None:
+                return
+            for path, delta in deltas.items():
+                if path in totals:
+                    totals[path] += delta
+            heap = heapq.nlargest(self.k, (
+                (size, path) for path, size in totals.items()))
+            heapq.heapify(heap)
+            self.new_dirs[top] = heap
+
+    def end(self, complete, finished=None):
+        """Publish the tops just scanned, or only those `finished` of a
+        cancelled scan; a `complete` scan also drops tops that no longer
+        exist.
+        """
+        with self.lock:
+            if finished is not None:
+                self.new_totals = {
+                    top: totals for top, totals in self.new_totals.items()
+                    if top in finished
+                }
+            if complete:
+                for results in (self.files, self.dirs, self.totals,
+                                self.growth):
+                    for top in results.keys() - self.new_totals.keys():
+                        del results[top]
+            for top, totals in self.new_totals.items():
+                previous = self.totals.get(top)
+                if previous is not None:
+                    self.growth[top] = heapq.nlargest(self.k, (
+                        (size - previous.get(path, 0), path, size)
+                        for path, size in totals.items()
+                        if size > previous.get(path, 0)))
+                self.totals[top] = totals
+                self.files[top] = self.new_files[top]
+                self.dirs[top] = self.new_dirs[top]
+            self.scanned_at = time.time()
+
+    def forget(self, tops):
+        """Drop the published results of `tops`."""
+        with self.lock:
+            for results in (self.files, self.dirs, self.totals, self.growth):
+                for top in tops:
+                    results.pop(top, None)
+
+    def snapshot(self):
+        with self.lock:
+            files = heapq.nlargest(self.k, itertools.chain.from_iterable(
+                self.files.values()))
+            dirs = heapq.nlargest(self.k, itertools.chain.from_iterable(
+                self.dirs.values()))
+            growth = heapq.nlargest(self.k, itertools.chain.from_iterable(
+                self.growth.values()))
+            scanned_at = self.scanned_at
+        return {
+            "scanned_at": scanned_at,
+            "largest_files": [
+                {"path": path, "bytes": size} for size, path in files],
+            "largest_directories": [
+                {"path": path, "bytes": size} for size, path in dirs],
+            "fastest_growing": [
+                {"path": path, "bytes": size, "growth_bytes": growth}
+                for growth, path, size in growth],
+        }
+
+
+# Layout of the per-directory counts vector: totals, then the age
+# buckets (non-cumulative, the last one for older than all bounds).
+FILES, SUBDIRS, INODES, MTIME_SUM, ATIME_SUM = range(5)
+MTIME_BUCKETS = 5
+ATIME_BUCKETS = MTIME_BUCKETS + len(AGE_BUCKETS) + 1
+COUNTS_LEN = ATIME_BUCKETS + len(AGE_BUCKETS) + 1
+
+
+class ScanCancelled(Exception):
+    """Raised out of a directory read when the scan passed its deadline."""
+
+
+class TreeWalker:
+    """Disk usage of each subdirectory down to `depth`, like `du -x -d`.
+
+    Usage is `st_blocks * 512` (what du reports, not the apparent size),
+    files with several hard links are counted once per scan, and mount
+    points are skipped unless `cross_mounts` is set. Every directory is a
+    separate task for a pool of threads, so one huge subtree is still
+    walked in parallel; `os.scandir` and `lstat` release the GIL.
+
+    A file linked from several reported paths is charged to the smallest
+    of them (by top-level subdirectory, then by path), settled once the
+    walk is done, so it stays put from scan to scan whatever order the
+    threads reach it in. du charges it to whichever path it reaches
+    first instead, so totals match du but single paths can differ.
+
+    With a `SubtreeCache`, directories whose metadata is unchanged since
+    they were last read cost one `lstat` per subdirectory instead of one
+    per entry.
+
+    Each task carries the chain of its ancestors down to `depth`, and a
+    directory's usage is added to every one of them, so all levels come
+    from a single walk.
+
+    With a `stat_rate`, the walker makes at most that many stat calls per
+    second across all its threads.
+
+    Every directory's own total is also known once its subtree is done:
+    tasks carry a node linked to their parent's, and a finished node adds
+    its total to the parent. With `top_k`, these and the files seen feed
+    a `SizeIndex`.
+
+    With `file_stats`, each reported path also gets a counts vector (see
+    FILES and the other offsets): files, subdirectories, inodes (hard
+    links once), and how many files fall in each mtime and atime age
+    bucket as of the scan's start.
+
+    With `owner_stats`, `owner_usage` holds {top: {(uid, gid): [blocks,
+    files]}} for every top-level subdirectory, kept across partial scans
+    like `link_owners`.
+
+    A scan given a `deadline` is cancelled when it passes: workers drop
+    their remaining tasks, and only the reported paths whose subtrees
+    were complete by then are returned, with `cancelled` set.
+    """
+
+    def __init__(self, threads=SCAN_THREADS, cross_mounts=CROSS_MOUNTS,
+                 cache=None, depth=SCAN_DEPTH, stat_rate=STAT_RATE,
+                 top_k=TOP_K, file_stats=FILE_STATS, owner_stats=OWNER_STATS):
+        self.threads = threads
+        self.cross_mounts = cross_mounts
+        self.cache = cache
+        self.depth = depth
+        self.budget = StatBudget(stat_rate) if stat_rate > 0 else None
+        self.index = SizeIndex(top_k) if top_k > 0 else None
+        self.file_stats = file_stats
+        self.counts = {}
+        self.owner_stats = owner_stats
+        self.owner_usage = {}
+        self.cancelled = False
+        self.errors = 0
+        self.stats = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.top_count = 0
+        self.remaining = 0
+        # (dev, inode) of multiply-linked files -> subdir they counted for
+        self.link_owners = {}
+
+    def scan(self, base_path, on_subdir=None, verify=False, only=None,
+             deadline=None):
+        """Return {subdir path: bytes} for subdirs down to `self.depth`.
+
+        `on_subdir(path, size)` is called as soon as each subtree is
+        complete, before the rest of the scan finishes. `verify` reads
+        every directory, refreshing the cache instead of trusting it.
+        `only` restricts the scan to the given immediate subdirectories.
+        `deadline` is a `time.monotonic()` value to give up at.
+
+        Sizes passed to `on_subdir` can still move by a hard link's blocks
+        when the links are settled; the returned ones are final.
+        """
+        base_st = os.stat(base_path)
+        self.base_dev = base_st.st_dev
+        self.verify = verify
+        # Entries modified this close to the scan may change again within
+        # the same timestamp tick; don't cache them.
+        self.racy_after_ns = time.time_ns() - 2_000_000_000
+        # A partial scan must not count again a hard link that a subdir it
+        # skips already accounts for.
+        self.link_owners = {} if only is None else {
+            inode: owner for inode, owner in self.link_owners.items()
+            if owner not in only
+        }
+        self.cancelled = False
+        self.errors = 0
+        self.stats = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.totals = {}
+        self.counts = {}
+        self.pending = {}
+        self.finished = set()
+        self.on_subdir = on_subdir
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.tasks = queue.SimpleQueue()
+        self.done = threading.Event()
+        # (dev, inode) -> (owners, directory, node, blocks, uid, gid) of
+        # the directory each link was charged to, and the smallest
+        # (owners, directory, node) it was seen in when that is another.
+        self.link_sites = {}
+        self.link_moves = {}
+
+        _size, children, _counts = self._scan_dir(base_path, base_st)
+        # Keep the owners of skipped subdirs that still exist.
+        present = {path for path, _st in children}
+        previous_usage = self.owner_usage
+        self.owner_usage = {
+            top: usage for top, usage in self.owner_usage.items()
+            if only is not None and top not in only and top in present
+        }
+        if only is not None:
+            children = [child for child in children if child[0] in only]
+        if self.index is not None:
+            self.index.begin([path for path, _st in children])
+        for path, st in children:
+            self.totals[path] = st.st_blocks * 512
+            self.pending[path] = 1
+            if self.file_stats:
+                self.counts[path] = self._own_counts()
+            if self.owner_stats:
+                self.owner_usage[path] = {
+                    (st.st_uid, st.st_gid): [st.st_blocks, 0]}
+        if not children:
+            if self.index is not None:
+                self.index.end(only is None)
+            self.top_count = self.remaining = 0
+            return {}
+        self.top_count = self.remaining = len(children)
+        for path, st in children:
+            # node: [parent node, path, subtree bytes, pending tasks]
+            self.tasks.put(((path,), [None, path, st.st_blocks * 512, 1], st))
+
+        workers = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(max(1, self.threads))
+        ]
+        for worker in workers:
+            worker.start()
+        if not self.done.wait(
+                None if deadline is None else deadline - time.monotonic()):
+            with self.lock:
+                self.cancelled = True
+        for _ in workers:
+            self.tasks.put(None)
+        for worker in workers:
+            worker.join()
+        self._settle_links()
+        if self.cancelled:
+            for path, _st in children:
+                if path not in self.finished:
+                    if path in previous_usage:
+                        self.owner_usage[path] = previous_usage[path]
+                    else:
+                        self.owner_usage.pop(path, None)
+            if self.index is not None:
+                self.index.end(False, self.finished)
+            return {
+                path: size for path, size in self.totals.items()
+                if path in self.finished
+            }
+        if self.cache is not None and only is None:
+            self.cache.prune()
+        if self.index is not None:
+            self.index.end(only is None)
+        return self.totals
+
+    def forget(self, tops):
+        """Drop what earlier scans kept of `tops`, now measured otherwise:
+        their counts, owner usage, hard links and top-K entries.
+        """
+        tops = set(tops)
+        self.counts = {
+            path: counts for path, counts in self.counts.items()
+            if not any(path == top or path.startswith(top + os.sep)
+                       for top in tops)
+        }
+        self.owner_usage = {
+            top: usage for top, usage in self.owner_usage.items()
+            if top not in tops
+        }
+        self.link_owners = {
+            inode: owner for inode, owner in self.link_owners.items()
+            if owner not in tops
+        }
+        if self.index is not None:
+            self.index.forget(tops)
+
+    def progress(self):
+        """Counters of the scan in progress, or of the last one."""
+        return {
+            "directories": self.cache_hits + self.cache_misses,
+            "cached_directories": self.cache_hits,
+            "stat_calls": self.stats,
+            "errors": self.errors,
+            "subdirectories": self.top_count,
+            "subdirectories_done": self.top_count - self.remaining,
+        }
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.cancelled:
+                continue
+            owners, node, st = task
+            size, children, counts = 0, [], None
+            try:
+                size, children, counts = self._scan_dir(
+                    node[1], st, owners, node)
+            except ScanCancelled:
+                pass
+            finally:
+                if not self.cancelled:
+                    self._finish(owners, node, size, children, counts)
+
+    def _finish(self, owners, node, size, children, counts):
+        """Account a read directory to `owners`, its reported ancestors
+        (itself included while within `self.depth`), and queue its subdirs.
+        """
+        tasks = []
+        complete = []
+        with self.lock:
+            if self.cancelled:
+                return
+            # Register the children before releasing this directory's own
+            # pending slot, so no subtree can be seen as complete early.
+            node[2] += size
+            node[3] += len(children) - 1
+            size += sum(st.st_blocks for _p, st in children) * 512
+            if counts is not None:
+                counts[SUBDIRS] += len(children)
+                counts[INODES] += len(children)
+            for owner in owners:
+                self.totals[owner] += size
+                self.pending[owner] += len(children) - 1
+                if counts is not None:
+                    owner_counts = self.counts[owner]
+                    for i, count in enumerate(counts):
+                        owner_counts[i] += count
+            for path, st in children:
+                child_owners = owners
+                if len(owners) < self.depth:
+                    child_owners = owners + (path,)
+                    self.totals[path] = st.st_blocks * 512
+                    self.pending[path] = 1
+                    if self.file_stats:
+                        self.counts[path] = self._own_counts()
+                tasks.append((
+                    child_owners, [node, path, st.st_blocks * 512, 1], st))
+            while node is not None and node[3] == 0:
+                if self.index is not None:
+                    self.index.add_dir(owners[0], node[1], node[2])
+                parent = node[0]
+                if parent is not None:
+                    parent[2] += node[2]
+                    parent[3] -= 1
+                node = parent
+            # Deepest first, so a subdir is reported before its parent.
+            for owner in reversed(owners):
+                if self.pending[owner] == 0:
+                    complete.append(owner)
+            self.finished.update(complete)
+            if owners[0] in complete:
+                self.remaining -= 1
+        for task in tasks:
+            self.tasks.put(task)
+        for owner in complete:
+            if self.on_subdir is not None:
+                self.on_subdir(owner, self.totals[owner])
+        if complete and self.remaining == 0:
+            self.done.set()
+
+    def _scan_dir(self, path, st, owners=(), node=None):
+        """Usage of the non-directory entries in `path`, and its subdirs."""
+        top = owners[0] if owners else None
+        site = (owners, path, node)
+        key = (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_nlink)
+        if self.cache is not None and not self.verify:
+            cached = self.cache.get(path, key)
+            if cached is not None:
+                result = self._reuse(path, cached, top, site)
+                if result is not None:
+                    return result
+
+        blocks = 0
+        links = []
+        subdirs = []
+        children = []
+        files = []
+        counts = [0] * COUNTS_LEN if self.file_stats else None
+        usage = {} if self.owner_stats else None
+        started = self.started
+        stats = 0
+        floor = None
+        if self.index is not None and top is not None:
+            floor = self.index.floor(top) // 512
+        base_dev = None if self.cross_mounts else self.base_dev
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    stats += 1
+                    if not stats & 1023 and self.cancelled:
+                        raise ScanCancelled
+                    try:
+                        entry_st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        self._error()
+                        continue
+                    owned = None
+                    if usage is not None:
+                        owner = (entry_st.st_uid, entry_st.st_gid)
+                        owned = usage.get(owner)
+                        if owned is None:
+                            owned = usage[owner] = [0, 0]
+                    if S_ISDIR(entry_st.st_mode):
+                        subdirs.append(entry.name)
+                        if base_dev is None or entry_st.st_dev == base_dev:
+                            children.append((entry.path, entry_st))
+                            if owned is not None:
+                                owned[0] += entry_st.st_blocks
+                        continue
+                    if floor is not None and entry_st.st_blocks >= floor:
+                        files.append((entry_st.st_blocks, entry.name))
+                    if counts is not None:
+                        # Inline: this runs once per file.
+                        mtime = entry_st.st_mtime
+                        atime = entry_st.st_atime
+                        counts[FILES] += 1
+                        counts[MTIME_SUM] += mtime
+                        counts[ATIME_SUM] += atime
+                        counts[MTIME_BUCKETS + bisect_left(
+                            AGE_BUCKETS, started - mtime)] += 1
+                        counts[ATIME_BUCKETS + bisect_left(
+                            AGE_BUCKETS, started - atime)] += 1
+                    if entry_st.st_nlink == 1:
+                        blocks += entry_st.st_blocks
+                        if owned is not None:
+                            owned[0] += entry_st.st_blocks
+                            owned[1] += 1
+                    else:
+                        links.append((entry_st.st_dev, entry_st.st_ino,
+                                      entry_st.st_blocks, entry_st.st_uid,
+                                      entry_st.st_gid))
+        except OSError:
+            self._error()
+        else:
+            if floor is not None:
+                files = heapq.nlargest(self.index.k, files)
+            if (self.cache is not None and max(
+                    st.st_mtime_ns, st.st_ctime_ns) < self.racy_after_ns):
+                self.cache.put(
+                    path, key, blocks, links, subdirs, files,
+                    None if counts is None else list(counts),
+                    None if usage is None else [
+                        [*owner, *owned] for owner, owned in usage.items()])
+        self._index_files(path, files, top)
+        self._account_owners(top, usage)
+        self._count(miss=True, stats=stats)
+        return self._usage(blocks, links, site, counts), children, counts
+
+    def _reuse(self, path, cached, top, site):
+        (_key, blocks, links, subdirs, _generation, files, counts,
+         usage) = cached
+        if self.file_stats:
+            if counts is None:
+                return None  # Cached before file stats were enabled.
+            counts = list(counts)
+        if self.owner_stats:
+            if usage is None:
+                return None  # Cached before owner stats were enabled.
+            usage = {
+                (uid, gid): [owned_blocks, owned_files]
+                for uid, gid, owned_blocks, owned_files in usage
+            }
+        children = []
+        base_dev = None if self.cross_mounts else self.base_dev
+        for name in subdirs:
+            child = os.path.join(path, name)
+            try:
+                child_st = os.lstat(child)
+            except OSError:
+                # Changed under us despite the unchanged metadata.
+                return None
+            if base_dev is None or child_st.st_dev == base_dev:
+                children.append((child, child_st))
+        self._index_files(path, files, top)
+        self._account_owners(top, usage)
+        self._count(miss=False, stats=len(subdirs))
+        return self._usage(blocks, links, site, counts), children, counts
+
+    def _own_counts(self):
+        """Counts of a reported directory before its contents: its inode."""
+        counts = [0] * COUNTS_LEN
+        counts[INODES] = 1
+        return counts
+
+    def _usage(self, blocks, links, site, counts):
+        """Bytes of a directory's files; adds its inodes to `counts`."""
+        link_blocks, inodes = self._dedupe(links, site)
+        if counts is not None:
+            counts[INODES] += counts[FILES] - len(links) + inodes
+        return (blocks + link_blocks) * 512
+
+    def _index_files(self, path, files, top):
+        if self.index is not None and top is not None and files:
+            self.index.add_files(top, [
+                (file_blocks * 512, os.path.join(path, name))
+                for file_blocks, name in files
+            ])
+
+    def _account_owners(self, top, usage):
+        if not usage or top is None:
+            return
+        with self.lock:
+            top_usage = self.owner_usage[top]
+            for owner, (owned_blocks, owned_files) in usage.items():
+                owned = top_usage.setdefault(owner, [0, 0])
+                owned[0] += owned_blocks
+                owned[1] += owned_files
+
+    def _dedupe(self, links, site):
+        """Blocks and number of the `links` not seen before this scan.
+
+        `site` is (owners, directory, node) of the directory they are in;
+        links already charged elsewhere remember it if it is smaller.
+        """
+        owners = site[0]
+        top = owners[0] if owners else None
+        blocks = 0
+        inodes = 0
+        with self.lock:
+            for dev, ino, link_blocks, uid, gid in links:
+                inode = (dev, ino)
+                if inode not in self.link_owners:
+                    self.link_owners[inode] = top
+                    self.link_sites[inode] = (*site, link_blocks, uid, gid)
+                    blocks += link_blocks
+                    inodes += 1
+                    if self.owner_stats and top is not None:
+                        owned = self.owner_usage[top].setdefault(
+                            (uid, gid), [0, 0])
+                        owned[0] += link_blocks
+                        owned[1] += 1
+                    continue
+                charged = self.link_sites.get(inode)
+                if charged is None:
+                    continue  # Owned by a subdir this partial scan skips.
+                best = self.link_moves.get(inode, charged)
+                if site[:2] < best[:2]:
+                    self.link_moves[inode] = site
+        return blocks, inodes
+
+    def _settle_links(self):
+        """Move each link charged during the walk to the smallest site it
+        was seen in.
+        """
+        deltas = {}
+        for inode, (owners, _path, node) in self.link_moves.items():
+            (old_owners, _old_path, old_node, blocks, uid,
+             gid) = self.link_sites[inode]
+            self._charge(old_owners, old_node, -blocks, -1, uid, gid, deltas)
+            self._charge(owners, node, blocks, 1, uid, gid, deltas)
+            self.link_owners[inode] = owners[0] if owners else None
+        if self.index is not None:
+            for top, top_deltas in deltas.items():
+                self.index.adjust(top, top_deltas)
+        self.link_sites = {}
+        self.link_moves = {}
+
+    def _charge(self, owners, node, blocks, inodes, uid, gid, deltas):
+        """Add a link's `blocks` and `inodes` to every path it counts in;
+        directory totals for the index are collected in `deltas`.
+        """
+        if not owners:
+            return
+        size = blocks * 512
+        for owner in owners:
+            self.totals[owner] += size
+            if self.file_stats:
+                self.counts[owner][INODES] += inodes
+        if self.owner_stats:
+            owned = self.owner_usage[owners[0]].setdefault((uid, gid), [0, 0])
+            owned[0] += blocks
+            owned[1] += inodes
+        top_deltas = deltas.setdefault(owners[0], {})
+        while node is not None:
+            top_deltas[node[1]] = top_deltas.get(node[1], 0) + size
+            node = node[0]
+
+    def _count(self, miss, stats):
+        if self.budget is not None:
+            self.budget.take(stats)
+        with self.lock:
+            self.stats += stats
+            if miss:
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+
+    def _error(self):
+        with self.lock:
+            self.errors += 1
+
+
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = (IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+FAN_CLOEXEC = 0x00000001
+FAN_NONBLOCK = 0x00000002
+FAN_REPORT_DFID_NAME = 0x00000c00
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_FILESYSTEM = 0x00000100
+FAN_MODIFY = 0x00000002
+FAN_MOVED_FROM = 0x00000040
+FAN_MOVED_TO = 0x00000080
+FAN_CREATE = 0x00000100
+FAN_DELETE = 0x00000200
+FAN_Q_OVERFLOW = 0x00004000
+FAN_ONDIR = 0x40000000
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+FANOTIFY_MASK = (FAN_MODIFY | FAN_MOVED_FROM | FAN_MOVED_TO | FAN_CREATE
+                 | FAN_DELETE | FAN_ONDIR)
+FANOTIFY_EVENT = struct.Struct("=IBBHQii")
+AT_FDCWD = -100
+
+
+def libc_call(result):
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+class InotifyTracker:
+    """Entries changed below `base_path`, from one inotify watch per directory.
+
+    New directories are watched as they appear and renamed ones keep
+    their watches. Past fs.inotify.max_user_watches the rest of the tree
+    is left to the verification scans.
+    """
+
+    def __init__(self, base_path, cross_mounts=CROSS_MOUNTS):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc_call(self.libc.inotify_init1(
+            os.O_NONBLOCK | os.O_CLOEXEC))
+        self.base_path = os.path.realpath(base_path)
+        self.base_dev = os.stat(self.base_path).st_dev
+        self.cross_mounts = cross_mounts
+        self.paths = {}
+        self.full = False
+        self.watch_tree(self.base_path)
+
+    def fileno(self):
+        return self.fd
+
+    def watch_tree(self, root):
+        stack = [root]
+        while stack and not self.full:
+            path = stack.pop()
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(path), INOTIFY_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 28:  # ENOSPC
+                    self.full = True
+                    print("inotify watch limit reached; raise "
+                          "fs.inotify.max_user_watches or use fanotify")
+                continue
+            self.paths[wd] = path
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if not entry.is_dir(follow_symlinks=False):
+                            continue
+                        if (self.cross_mounts or entry.stat(
+                                follow_symlinks=False).st_dev
+                                == self.base_dev):
+                            stack.append(entry.path)
+            except OSError:
+                pass
+
+    def rename(self, old, new):
+        prefix = old + os.sep
+        for wd, path in self.paths.items():
+            if path == old:
+                self.paths[wd] = new
+            elif path.startswith(prefix):
+                self.paths[wd] = new + path[len(old):]
+
+    def forget(self, old):
+        prefix = old + os.sep
+        for wd, path in list(self.paths.items()):
+            if path == old or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def read(self):
+        """Return changed (directory, entry name) pairs and whether events
+        were lost.
+        """
+        changed = set()
+        overflow = False
+        moved_from = {}
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(
+                    buffer, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(
+                    buffer[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                directory = self.paths.get(wd)
+                if directory is None:
+                    continue
+                changed.add((directory, name))
+                if not mask & IN_ISDIR:
+                    continue
+                child = os.path.join(directory, name)
+                if mask & IN_MOVED_FROM:
+                    moved_from[cookie] = child
+                elif mask & IN_MOVED_TO and cookie in moved_from:
+                    self.rename(moved_from.pop(cookie), child)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # Its contents may predate the watch.
+                    self.watch_tree(child)
+                    changed.add((child, ""))
+        for old in moved_from.values():
+            self.forget(old)
+        return changed, overflow
+
+
+class FanotifyTracker:
+    """Entries changed below `base_path`, from one fanotify mark.
+
+    The mark covers the whole file system holding `base_path`, so no
+    per-directory watches are needed. Events name the changed entry's
+    parent by file handle, resolved with open_by_handle_at. Needs
+    CAP_SYS_ADMIN and CAP_DAC_READ_SEARCH and Linux 5.9 or later.
+    """
+
+    def __init__(self, base_path):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.fanotify_mark.argtypes = [
+            ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int,
+            ctypes.c_char_p]
+        self.libc.open_by_handle_at.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        self.base_path = os.path.realpath(base_path)
+        self.fd = libc_call(self.libc.fanotify_init(
+            FAN_CLOEXEC | FAN_NONBLOCK | FAN_REPORT_DFID_NAME,
+            os.O_RDONLY))
+        try:
+            libc_call(self.libc.fanotify_mark(
+                self.fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM, FANOTIFY_MASK,
+                AT_FDCWD, os.fsencode(self.base_path)))
+            self.mount_fd = os.open(self.base_path, os.O_RDONLY)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def resolve(self, handle):
+        fd = self.libc.open_by_handle_at(
+            self.mount_fd, ctypes.create_string_buffer(handle, len(handle)),
+            os.O_PATH)
+        if fd < 0:
+            return None  # Deleted since; its parent's event covers it.
+        try:
+            return os.readlink(f"/proc/self/fd/{fd}")
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """Return changed (directory, entry name) pairs and whether events
+        were lost.
+        """
+        entries = set()
+        new_dirs = set()
+        overflow = False
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + FANOTIFY_EVENT.size <= len(buffer):
+                (event_len, _vers, _reserved, metadata_len, mask, fd,
+                 _pid) = FANOTIFY_EVENT.unpack_from(buffer, offset)
+                if fd >= 0:
+                    os.close(fd)
+                if mask & FAN_Q_OVERFLOW:
+                    overflow = True
+                info = offset + metadata_len
+                offset += event_len
+                while info + 4 <= offset:
+                    info_type, _pad, info_len = struct.unpack_from(
+                        "BBH", buffer, info)
+                    if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                        # header, fsid, then struct file_handle and name
+                        start = info + 12
+                        (size,) = struct.unpack_from("I", buffer, start)
+                        handle = buffer[start:start + 8 + size]
+                        name = os.fsdecode(buffer[
+                            start + 8 + size:info + info_len
+                        ].split(b"\0", 1)[0])
+                        entries.add((handle, name))
+                        if mask & FAN_ONDIR and mask & (
+                                FAN_CREATE | FAN_MOVED_TO):
+                            new_dirs.add((handle, name))
+                    info += max(info_len, 4)
+        paths = {handle: self.resolve(handle) for handle, _name in entries}
+        changed = {
+            (paths[handle], name) for handle, name in entries
+            if paths[handle] is not None
+        }
+        for handle, name in new_dirs:
+            if paths[handle] is not None:
+                # A directory moved in brings contents we saw no events for.
+                changed.add((os.path.join(paths[handle], name), ""))
+        base = self.base_path
+        return {
+            (directory, name) for directory, name in changed
+            if directory == base or directory.startswith(base + os.sep)
+        }, overflow
+
+
+def change_tracker(base_path, mode=WATCH_MODE, cross_mounts=CROSS_MOUNTS):
+    if mode in ("auto", "fanotify") and not cross_mounts:
+        try:
+            return FanotifyTracker(base_path)
+        except (OSError, AttributeError) as e:
+            if mode == "fanotify":
+                raise
+            print(f"fanotify unavailable ({e}); using inotify")
+    return InotifyTracker(base_path, cross_mounts)
+
+
+TOP_STORE_PATHS_QUERY = """
+SELECT path, narSize, count(*) OVER (), total(narSize) OVER ()
+FROM ValidPaths ORDER BY narSize DESC LIMIT ?
+"""
+CLOSURE_QUERY = """
+WITH RECURSIVE closure(id) AS (
+    SELECT id FROM ValidPaths WHERE path IN (SELECT path FROM {roots})
+    UNION
+    SELECT reference FROM Refs JOIN closure ON referrer = closure.id
+)
+SELECT count(*), total(narSize) FROM ValidPaths JOIN closure USING (id)
+"""
+
+
+def gc_roots(roots_dir, store_dir):
+    """{root link: store path} for the symlinks under the GC roots directory.
+
+    Like `nix-store --gc --print-roots` without runtime roots (processes
+    holding store paths open), which would need a /proc scan.
+    """
+    roots = {}
+    prefix = store_dir.rstrip(os.sep) + os.sep
+    for directory, subdirs, files in os.walk(roots_dir, followlinks=False):
+        for name in subdirs + files:
+            link = os.path.join(directory, name)
+            if not os.path.islink(link):
+                continue
+            target = os.path.realpath(link)
+            if target.startswith(prefix):
+                store_name = target[len(prefix):].split(os.sep, 1)[0]
+                roots[link] = prefix + store_name
+    return roots
+
+
+def nix_store_sizes(db_path, top_k, store_dir, roots_dir=None):
+    """Store path sizes from the Nix database, opened read-only.
+
+    Returns the `top_k` largest paths by NAR size, aggregate totals, and,
+    with `roots_dir`, the live set and the `top_k` largest root closures.
+    """
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = db.execute(TOP_STORE_PATHS_QUERY, (top_k,)).fetchall()
+        sizes = {path: nar_size for path, nar_size, _count, _total in rows}
+        totals = {"paths": 0, "bytes": 0}
+        if rows:
+            totals = {"paths": rows[0][2], "bytes": int(rows[0][3])}
+        closures = {}
+        if roots_dir is not None:
+            roots = gc_roots(roots_dir, store_dir)
+            db.execute("CREATE TEMP TABLE roots (path TEXT PRIMARY KEY)")
+            db.executemany(
+                "INSERT OR IGNORE INTO roots VALUES (?)",
+                [(path,) for path in roots.values()])
+            live_paths, live_bytes = db.execute(
+                CLOSURE_QUERY.format(roots="temp.roots")).fetchone()
+            totals["live_paths"] = live_paths
+            totals["live_bytes"] = int(live_bytes)
+            db.execute("CREATE TEMP TABLE root (path TEXT)")
+            for link, path in roots.items():
+                db.execute("DELETE FROM root")
+                db.execute("INSERT INTO root VALUES (?)", (path,))
+                _count, closure_bytes = db.execute(
+                    CLOSURE_QUERY.format(roots="temp.root")).fetchone()
+                closures[link] = int(closure_bytes)
+            closures = dict(sorted(
+                closures.items(), key=lambda item: item[1], reverse=True
+            )[:top_k])
+        return sizes, totals, closures
+    finally:
+        db.close()
+
+
+class NixStoreMetrics:
+    """Gauges for the `nix` backend.
+
+    Only the `top_k` largest paths are exported per path; paths that drop
+    out of the top are removed instead of left at their last value
+    (`update_metrics` does this for `directory_size_bytes`).
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.totals = Gauge(
+            'nix_store_size_bytes',
+            'Total NAR size of valid store paths, and of those reachable '
+            'from GC roots (set="live")',
+            ['set'])
+        self.counts = Gauge(
+            'nix_store_paths',
+            'Number of valid store paths, and of those reachable from GC '
+            'roots (set="live")',
+            ['set'])
+        self.closures = Gauge(
+            'nix_store_gc_root_closure_size_bytes',
+            'NAR size of the closure of the largest GC roots',
+            ['root'])
+        self.exported_roots = set()
+
+    def update(self):
+        try:
+            sizes, totals, closures = nix_store_sizes(
+                NIX_DB, NIX_TOP_K, self.store_dir,
+                NIX_GC_ROOTS_DIR if NIX_GC_ROOTS else None)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Error reading the Nix database {NIX_DB}: {e}")
+            return None
+        self.totals.labels(set="all").set(totals["bytes"])
+        self.counts.labels(set="all").set(totals["paths"])
+        if "live_bytes" in totals:
+            self.totals.labels(set="live").set(totals["live_bytes"])
+            self.counts.labels(set="live").set(totals["live_paths"])
+        for root in self.exported_roots - closures.keys():
+            self.closures.remove(root)
+        self.exported_roots = set(closures)
+        for root, size in closures.items():
+            self.closures.labels(root=root).set(size)
+        return sizes
+
+
+BTRFS_SUPER_MAGIC = 0x9123683E
+XFS_SUPER_MAGIC = 0x58465342
+ZFS_SUPER_MAGIC = 0x2FC12FC1
+BTRFS_IOC_INO_LOOKUP = 0xD0009412
+BTRFS_IOC_FS_INFO = 0x8400941F
+BTRFS_FIRST_FREE_OBJECTID = 256
+FS_IOC_FSGETXATTR = 0x801C581F
+
+
+def parse_btrfs_qgroups(output):
+    """{subvolume id: referenced bytes} from `btrfs qgroup show --raw`."""
+    usage = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].startswith("0/"):
+            usage[int(fields[0][2:])] = int(fields[1])
+    return usage
+
+
+def parse_zfs_datasets(output):
+    """{mountpoint: referenced bytes} from `zfs list -H -p`."""
+    usage = {}
+    for line in output.splitlines():
+        mountpoint, referenced = line.split("\t")
+        if mountpoint.startswith("/") and referenced.isdigit():
+            usage[mountpoint] = int(referenced)
+    return usage
+
+
+def parse_xfs_projects(output):
+    """{project id: used bytes} from `xfs_quota -c 'report -p -n -b -N'`."""
+    usage = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].startswith("#"):
+            usage[int(fields[0][1:])] = int(fields[1]) * 1024
+    return usage
+
+
+class QuotaUsage:
+    """Usage the file system already keeps, for the `quota` backend.
+
+    A subdirectory qualifies if it is a btrfs subvolume (with quotas
+    enabled; reports qgroup referenced bytes), a ZFS dataset mount point
+    (`referenced`), or an XFS directory with a project ID no other
+    subdirectory shares (the project's used blocks). These come from the
+    file system's accounting, so they can lag a transaction commit and
+    count compressed or shared extents differently from a walk.
+
+    Unless `cross_mounts` is set, btrfs subvolumes and XFS directories on
+    another file system than the base path are left to the walker, which
+    skips them like any other mount point.
+    """
+
+    def __init__(self, cross_mounts=CROSS_MOUNTS):
+        self.cross_mounts = cross_mounts
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.failed = set()
+
+    def sizes(self, base_path, tops):
+        """{top: bytes} for the `tops` that have usage to read."""
+        # btrfs gives every subvolume its own st_dev; its file system is
+        # the one with the same fsid.
+        base = None
+        if not self.cross_mounts:
+            try:
+                base = self.file_system(base_path, self.fs_magic(base_path))
+            except OSError:
+                return {}
+        subvolumes = {}
+        datasets = []
+        projects = {}
+        for top in tops:
+            try:
+                magic = self.fs_magic(top)
+                if magic == ZFS_SUPER_MAGIC:
+                    datasets.append(top)
+                    continue
+                fs = self.file_system(top, magic)
+                if base is not None and fs != base:
+                    continue
+                if magic == BTRFS_SUPER_MAGIC:
+                    if os.lstat(top).st_ino == BTRFS_FIRST_FREE_OBJECTID:
+                        subvolumes.setdefault(fs, {})[top] = (
+                            self.btrfs_subvolume_id(top))
+                elif magic == XFS_SUPER_MAGIC:
+                    project = self.xfs_project_id(top)
+                    if project:
+                        projects.setdefault((fs, project), []).append(top)
+            except OSError:
+                continue
         sizes = {}
-        for line in lines:
-            parts = line.split('\t')
-            if len(parts) == 2:
-                size, path = parts
-                if path != BASE_PATH:
-                    sizes[path] = int(size)
+        # Subvolume IDs are per file system: one qgroup report each.
+        for fs_subvolumes in subvolumes.values():
+            usage = self.run(
+                "btrfs", ["btrfs", "qgroup", "show", "--raw",
+                          next(iter(fs_subvolumes))],
+                parse_btrfs_qgroups)
+            for top, subvolume in fs_subvolumes.items():
+                if subvolume in usage:
+                    sizes[top] = usage[subvolume]
+        if datasets:
+            usage = self.run(
+                "zfs", ["zfs", "list", "-H", "-p", "-t", "filesystem",
+                        "-o", "mountpoint,referenced"],
+                parse_zfs_datasets)
+            for top in datasets:
+                if os.path.realpath(top) in usage:
+                    sizes[top] = usage[os.path.realpath(top)]
+        reports = {}
+        for (fs, project), shared in projects.items():
+            if len(shared) > 1:
+                continue  # The project's usage is not one directory's.
+            if fs not in reports:
+                reports[fs] = self.run(
+                    "xfs", ["xfs_quota", "-x", "-c", "report -p -n -b -N",
+                            mount_point(shared[0])],
+                    parse_xfs_projects)
+            if project in reports[fs]:
+                sizes[shared[0]] = reports[fs][project]
         return sizes
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing du command: {e}")
+
+    def run(self, kind, command, parse):
+        try:
+            result = subprocess.run(
+                command, capture_output=True, text=True, check=True)
+            return parse(result.stdout)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            if kind not in self.failed:
+                self.failed.add(kind)
+                print(f"Cannot read {kind} usage, walking instead: {e}")
+            return {}
+
+    def file_system(self, path, magic):
+        """What identifies the file system `path` is on."""
+        if magic == BTRFS_SUPER_MAGIC:
+            return magic, self.btrfs_fsid(path)
+        return magic, os.lstat(path).st_dev
+
+    def fs_magic(self, path):
+        buffer = ctypes.create_string_buffer(256)
+        libc_call(self.libc.statfs(os.fsencode(path), buffer))
+        return ctypes.c_ulong.from_buffer(buffer).value & 0xFFFFFFFF
+
+    def btrfs_subvolume_id(self, path):
+        args = bytearray(4096)
+        struct.pack_into("QQ", args, 0, 0, BTRFS_FIRST_FREE_OBJECTID)
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.ioctl(fd, BTRFS_IOC_INO_LOOKUP, args)
+        finally:
+            os.close(fd)
+        return struct.unpack_from("Q", args)[0]
+
+    def btrfs_fsid(self, path):
+        args = bytearray(1024)
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.ioctl(fd, BTRFS_IOC_FS_INFO, args)
+        finally:
+            os.close(fd)
+        return bytes(args[16:32])
+
+    def xfs_project_id(self, path):
+        fsxattr = bytearray(28)
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FSGETXATTR, fsxattr)
+        finally:
+            os.close(fd)
+        return struct.unpack_from("IIII", fsxattr)[3]
+
+
+def mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def scan_with_quotas(BASE_PATH, on_subdir, walker, quotas, verify=False,
+                     only=None, deadline=None):
+    """Read what `quotas` can answer, then walk the other subdirs."""
+    try:
+        with os.scandir(BASE_PATH) as entries:
+            tops = [
+                entry.path for entry in entries
+                if entry.is_dir(follow_symlinks=False)
+            ]
+    except OSError as e:
+        print(f"Error scanning {BASE_PATH}: {e}")
         return None
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+    if only is not None:
+        tops = [top for top in tops if top in only]
+    walker.stats = walker.errors = 0
+    walker.cancelled = False
+    sizes = quotas.sizes(BASE_PATH, tops)
+    for path, size in sizes.items():
+        on_subdir(path, size)
+    if sizes:
+        print(f"Read {len(sizes)} subdirectories from file system quotas")
+        walker.forget(sizes)
+    rest = set(tops) - sizes.keys()
+    if rest:
+        walked = scan_immediate_subdirs_size(
+            BASE_PATH, on_subdir, walker, verify,
+            None if only is None and not sizes else rest, deadline)
+        if walked is None:
+            return None
+        sizes.update(walked)
+    return sizes
+
+
+def exported(base_path, path, filters=LEVEL_FILTERS):
+    """Whether `path` passes the include/exclude globs of its level."""
+    rel = os.path.relpath(path, base_path)
+    level = rel.count(os.sep) + 1
+    if level > len(filters):
+        return True
+    include = filters[level - 1].get("include", ["*"])
+    exclude = filters[level - 1].get("exclude", [])
+    return (any(fnmatch.fnmatchcase(rel, glob) for glob in include)
+            and not any(fnmatch.fnmatchcase(rel, glob) for glob in exclude))
+
+
+def remove_vanished(BASE_PATH, gauge, sizes, only=None):
+    """Drop series below `BASE_PATH` that the scan no longer reported.
+
+    After a partial scan only paths below the rescanned `only` subdirs
+    are candidates; the rest were not looked at. Returns the removed paths.
+    """
+    removed = []
+    for metric in gauge.collect():
+        for sample in metric.samples:
+            path = sample.labels["path"]
+            rel = os.path.relpath(path, BASE_PATH)
+            if path in sizes or rel.split(os.sep, 1)[0] in (".", ".."):
+                continue
+            if only is not None:
+                top = os.path.join(BASE_PATH, rel.split(os.sep, 1)[0])
+                if top not in only:
+                    continue
+            gauge.remove(path)
+            removed.append(path)
+    return removed
+
+
+# Marks an on-demand rescan of a whole job rather than some subdirectories.
+ALL_SUBDIRS = object()
+
+
+class ScanJob:
+    """One base path, scanned on its own schedule with its own settings.
+
+    Jobs should not overlap: a path two jobs report would flip between
+    their values.
+    """
+
+    SETTINGS = {
+        "interval-sec": "interval_sec",
+        "scan-backend": "backend",
+        "scan-depth": "depth",
+        "level-filters": "filters",
+        "scan-threads": "threads",
+        "cross-mounts": "cross_mounts",
+        "watch-mode": "watch_mode",
+        "cache-file": "cache_file",
+        "stat-rate": "stat_rate",
+        "max-interval-sec": "max_interval_sec",
+        "top-k": "top_k",
+        "file-stats": "file_stats",
+        "owner-stats": "owner_stats",
+        "scan-timeout-sec": "timeout_sec",
+        "du-processes": "du_processes",
+    }
+
+    def __init__(self, path, interval_sec=INTERVAL_SEC, backend=SCAN_BACKEND,
+                 depth=SCAN_DEPTH, filters=LEVEL_FILTERS, threads=SCAN_THREADS,
+                 cross_mounts=CROSS_MOUNTS, watch_mode=WATCH_MODE,
+                 cache_file=None, stat_rate=STAT_RATE, max_interval_sec=None,
+                 top_k=TOP_K, file_stats=FILE_STATS, owner_stats=OWNER_STATS,
+                 timeout_sec=SCAN_TIMEOUT_SEC, du_processes=DU_PROCESSES):
+        self.path = path
+        self.interval_sec = interval_sec
+        self.timeout_sec = timeout_sec
+        if max_interval_sec is None:
+            max_interval_sec = int(MAX_INTERVAL_SEC or 4 * interval_sec)
+        self.max_interval_sec = max(interval_sec, max_interval_sec)
+        self.interval = interval_sec
+        self.last_sizes = None
+        self.backend = backend
+        self.du_processes = du_processes
+        self.depth = depth
+        self.filters = filters
+        self.cross_mounts = cross_mounts
+        self.watch_mode = watch_mode
+        cache = None
+        if CACHE_MAX_ENTRIES > 0:
+            cache = SubtreeCache(CACHE_MAX_ENTRIES, cache_file)
+        self.walker = TreeWalker(
+            threads, cross_mounts, cache, depth, stat_rate, top_k,
+            file_stats, owner_stats)
+        self.quotas = (
+            QuotaUsage(cross_mounts) if backend == "quota" else None)
+        # reported path -> (walker counts vector, scan start)
+        self.file_counts = {}
+        # {"user": [(name, bytes, files)], "group": [...]} of the last scan
+        self.owners = None
+        self.forecast = None
+        if GROWTH_WINDOW > 0:
+            self.forecast = GrowthForecast(GROWTH_WINDOW)
+        self.nix_metrics = None
+        self.results = None
+        self.last_verify = time.monotonic()
+        # Scheduling: when the next regular scan is due (never for watched
+        # jobs), and the subdirectories asked for on demand since the last
+        # scan started (ALL_SUBDIRS for everything), whether any of those
+        # requests wants the cache verified, and the directories to drop
+        # from the cache before that scan.
+        self.due = float("inf")
+        self.requested = None
+        self.requested_verify = False
+        self.stale = set()
+        # "idle", "waiting" for the device lock, or "scanning" since
+        # `scan_started` (unix time).
+        self.state = "idle"
+        self.scan_started = None
+        self.last_duration = None
+
+    def status(self):
+        """What /status reports about this job."""
+        status = {
+            "backend": self.backend,
+            "state": self.state,
+            "scan_started": self.scan_started,
+            "last_scan_duration_seconds": self.last_duration,
+            "interval_seconds": self.interval,
+            "next_scan_in_seconds": (
+                None if self.due == float("inf")
+                else max(0.0, self.due - time.monotonic())),
+            "rescan_requested": (
+                "all" if self.requested is ALL_SUBDIRS
+                else None if self.requested is None
+                else sorted(self.requested)),
+        }
+        if self.backend in ("scandir", "quota"):
+            status["progress"] = self.walker.progress()
+        return status
+
+    def subdir(self, path):
+        """The immediate subdirectory of this job's path that `path` is
+        in, ALL_SUBDIRS for the path itself, or None if it is outside.
+        """
+        rel = os.path.relpath(os.path.normpath(path), self.path)
+        top = rel.split(os.sep, 1)[0]
+        if top == "..":
+            return None
+        return ALL_SUBDIRS if top == "." else os.path.join(self.path, top)
+
+    def next_interval(self, duration, sizes):
+        """Seconds from the start of this scan to the start of the next.
+
+        Back off while nothing changes and snap back on the first change;
+        never spend more than SCAN_DUTY_CYCLE of the time scanning.
+        """
+        if sizes is not None and sizes == self.last_sizes:
+            self.interval = min(2 * self.interval, self.max_interval_sec)
+        else:
+            self.interval = self.interval_sec
+        if sizes is not None:
+            self.last_sizes = sizes
+        return max(self.interval, duration / SCAN_DUTY_CYCLE, duration + 1)
+
+    def deadline(self):
+        """When a scan starting now gives up, as a time.monotonic() value."""
+        if not self.timeout_sec:
+            return None
+        return time.monotonic() + self.timeout_sec
+
+    @classmethod
+    def from_config(cls, config):
+        settings = {
+            cls.SETTINGS[key]: value for key, value in config.items()
+            if key in cls.SETTINGS and value is not None
+        }
+        return cls(config["path"], **settings)
+
+    def device(self):
+        """What scans of this job compete for: its file system."""
+        try:
+            return os.stat(self.path).st_dev
+        except OSError:
+            return self.path
+
+
+def load_jobs():
+    if JOBS:
+        return [ScanJob.from_config(config) for config in JOBS]
+    if BASE_PATH is None:
+        raise SystemExit("Set BASE_PATH or JOBS")
+    return [ScanJob(BASE_PATH, cache_file=CACHE_FILE)]
+
+
+device_locks = {}
+device_locks_guard = threading.Lock()
+
+
+def device_lock(device):
+    """Lock held while scanning `device`, so scans of it never overlap."""
+    with device_locks_guard:
+        return device_locks.setdefault(device, threading.Lock())
+
+
+def scan_immediate_subdirs_size(BASE_PATH, on_subdir=None, walker=None,
+                                verify=False, only=None, deadline=None):
+    walker = walker or TreeWalker()
+    try:
+        sizes = walker.scan(BASE_PATH, on_subdir, verify, only, deadline)
+    except OSError as e:
+        print(f"Error scanning {BASE_PATH}: {e}")
         return None
+    if walker.cancelled:
+        print(f"Scan of {BASE_PATH} passed its deadline; keeping the "
+              f"{len(sizes)} paths it finished")
+    if walker.errors:
+        print(f"Skipped {walker.errors} unreadable entries")
+    if walker.cache is not None:
+        print(f"Reused {walker.cache_hits} cached directories, "
+              f"read {walker.cache_misses}")
+        walker.cache.save()
+    return sizes
 
 
-def update_metrics(BASE_PATH, gauge):
-    sizes = get_immediate_subdirs_size(BASE_PATH)
-    if sizes:
+class Metrics:
+    """Directory sizes plus what it costs to measure them, per base path."""
+
+    def __init__(self):
+        self.sizes = Gauge(
+            'directory_size_bytes',
+            'Size of the subdirectories of each base path, down to its scan '
+            'depth, in bytes',
+            ['path']
+        )
+        self.growth_rate = Gauge(
+            'directory_growth_bytes_per_second',
+            'Growth rate of each reported path, fitted over its recent sizes',
+            ['path'])
+        self.time_to_full = Gauge(
+            'directory_time_to_full_seconds',
+            'Seconds until the file system holding each path is full at its '
+            'growth rate; +Inf when it is not growing',
+            ['path'])
+        self.scan_duration = Gauge(
+            'folder_size_scan_duration_seconds',
+            'Duration of the last scan, including waiting for the device',
+            ['base_path'])
+        self.stat_calls = Counter(
+            'folder_size_scan_stat_calls',
+            'stat calls made by scans',
+            ['base_path'])
+        self.skipped_cycles = Counter(
+            'folder_size_scan_skipped_cycles',
+            'Scheduled scans that did not run because the previous scan '
+            'overran the interval',
+            ['base_path'])
+        self.interval = Gauge(
+            'folder_size_scan_interval_seconds',
+            'Current interval between scan starts, after adapting to scan '
+            'cost and change rate',
+            ['base_path'])
+        self.scan_seconds = Histogram(
+            'folder_size_scan_seconds',
+            'Duration of scans, including waiting for the device',
+            ['base_path'],
+            buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200,
+                     21600))
+        self.scan_errors = Counter(
+            'folder_size_scan_errors',
+            'Entries and directories scans could not read (and skipped)',
+            ['base_path'])
+        self.scan_timeouts = Counter(
+            'folder_size_scan_timeouts',
+            'Scans cancelled at their deadline, keeping only the subtrees '
+            'they finished',
+            ['base_path'])
+        self.last_scan = Gauge(
+            'folder_size_last_scan_timestamp_seconds',
+            'Unix time of the last completed scan of each base path; '
+            'predates the process start while serving saved results',
+            ['base_path'])
+
+
+class SizeHistory:
+    """The last `window` (time, size) samples of one path, and the sums a
+    least-squares fit over them needs.
+
+    Samples are stored relative to an origin so the sums stay small; the
+    origin moves to the oldest sample, and the sums are recomputed, each
+    time the ring has turned over, which also sheds rounding drift.
+    """
+
+    def __init__(self, window):
+        self.ring = collections.deque(maxlen=window)
+        self.added = 0
+        self.origin = None
+        self.t = self.y = self.tt = self.ty = 0.0
+
+    def add(self, when, size):
+        if self.origin is None:
+            self.origin = (when, size)
+        if len(self.ring) == self.ring.maxlen:
+            self._account(*self.ring[0], -1)
+        sample = (when - self.origin[0], size - self.origin[1])
+        self.ring.append(sample)
+        self._account(*sample, 1)
+        self.added += 1
+        if self.added % self.ring.maxlen == 0:
+            self._rebase()
+
+    def rate(self):
+        """Bytes per second, or None until two samples are apart in time."""
+        n = len(self.ring)
+        denominator = n * self.tt - self.t * self.t
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * self.ty - self.t * self.y) / denominator
+
+    def _account(self, t, y, sign):
+        self.t += sign * t
+        self.y += sign * y
+        self.tt += sign * t * t
+        self.ty += sign * t * y
+
+    def _rebase(self):
+        t0, y0 = self.ring[0]
+        self.origin = (self.origin[0] + t0, self.origin[1] + y0)
+        samples = [(t - t0, y - y0) for t, y in self.ring]
+        self.ring.clear()
+        self.t = self.y = self.tt = self.ty = 0.0
+        for sample in samples:
+            self.ring.append(sample)
+            self._account(*sample, 1)
+
+
+class GrowthForecast:
+    """Smoothed growth rate and time to full for each reported path.
+
+    The rate is the least-squares slope over the path's last `window`
+    sizes, updated in O(1) per cycle. Time to full divides the free space
+    of the path's file system (statvfs `f_bavail`, what an unprivileged
+    writer can still use) by that rate; it is +Inf for paths that are
+    not growing.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.histories = {}
+
+    def update(self, sizes, when):
+        """Return {path: (bytes per second, seconds to full)} for the
+        paths with enough history.
+        """
+        forecasts = {}
         for path, size in sizes.items():
+            history = self.histories.get(path)
+            if history is None:
+                history = self.histories[path] = SizeHistory(self.window)
+            history.add(when, size)
+            rate = history.rate()
+            if rate is None:
+                continue
+            time_to_full = float("inf")
+            if rate > 0:
+                try:
+                    st = os.statvfs(path)
+                except OSError:
+                    continue
+                time_to_full = st.f_bavail * st.f_frsize / rate
+            forecasts[path] = (rate, time_to_full)
+        return forecasts
+
+    def forget(self, path):
+        self.histories.pop(path, None)
+
+
+class TopPathsCollector:
+    """Each job's `SizeIndex`, at most TOP_K series per family and job."""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def collect(self):
+        families = {
+            "largest_files": GaugeMetricFamily(
+                'folder_size_largest_file_bytes',
+                'Largest files seen by the last scan',
+                labels=['base_path', 'path']),
+            "largest_directories": GaugeMetricFamily(
+                'folder_size_largest_directory_bytes',
+                'Largest directories, at any depth, seen by the last scan',
+                labels=['base_path', 'path']),
+            "fastest_growing": GaugeMetricFamily(
+                'folder_size_directory_growth_bytes',
+                'Growth since the previous scan of the directories that '
+                'grew most',
+                labels=['base_path', 'path']),
+        }
+        for job in self.jobs:
+            if job.walker.index is None:
+                continue
+            snapshot = job.walker.index.snapshot()
+            for key, family in families.items():
+                value = "growth_bytes" if key == "fastest_growing" else "bytes"
+                for entry in snapshot[key]:
+                    family.add_metric([job.path, entry["path"]], entry[value])
+        return families.values()
+
+
+class FileStatsCollector:
+    """File, subdirectory and inode counts and file age histograms of
+    each reported path, from the walker's counts vectors.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def collect(self):
+        files = GaugeMetricFamily(
+            'directory_files',
+            'Non-directory entries below each reported path',
+            labels=['path'])
+        subdirs = GaugeMetricFamily(
+            'directory_subdirectories',
+            'Directories below each reported path',
+            labels=['path'])
+        inodes = GaugeMetricFamily(
+            'directory_inodes',
+            'Inodes used by each reported path, hard-linked files once',
+            labels=['path'])
+        ages = {
+            MTIME_BUCKETS: HistogramMetricFamily(
+                'directory_file_mtime_age_seconds',
+                'Files below each reported path by time since modification',
+                labels=['path']),
+            ATIME_BUCKETS: HistogramMetricFamily(
+                'directory_file_atime_age_seconds',
+                'Files below each reported path by time since last access '
+                '(as recorded under the relatime/noatime mount options)',
+                labels=['path']),
+        }
+        sums = {MTIME_BUCKETS: MTIME_SUM, ATIME_BUCKETS: ATIME_SUM}
+        for job in self.jobs:
+            for path, (counts, scanned) in list(job.file_counts.items()):
+                files.add_metric([path], counts[FILES])
+                subdirs.add_metric([path], counts[SUBDIRS])
+                inodes.add_metric([path], counts[INODES])
+                for offset, family in ages.items():
+                    buckets = list(zip(
+                        [str(bound) for bound in AGE_BUCKETS] + ["+Inf"],
+                        itertools.accumulate(
+                            counts[offset:offset + len(AGE_BUCKETS) + 1])))
+                    family.add_metric(
+                        [path], buckets,
+                        counts[FILES] * scanned - counts[sums[offset]])
+        return [files, subdirs, inodes, *ages.values()]
+
+
+def owner_totals(owner_usage, top_k=OWNER_TOP_K):
+    """Sum the walker's per-top usage by user and by group.
+
+    Names are looked up once per uid and gid per call; ids without a
+    passwd or group entry keep their number. Past the `top_k` largest,
+    owners are folded into "other" to bound the label cardinality.
+    """
+    names = {}
+
+    def name(lookup, number):
+        if (lookup, number) not in names:
+            try:
+                names[(lookup, number)] = lookup(number)[0]
+            except KeyError:
+                names[(lookup, number)] = str(number)
+        return names[(lookup, number)]
+
+    by_user = collections.defaultdict(lambda: [0, 0])
+    by_group = collections.defaultdict(lambda: [0, 0])
+    for usage in list(owner_usage.values()):
+        for (uid, gid), (blocks, files) in list(usage.items()):
+            for totals, key in ((by_user, uid), (by_group, gid)):
+                totals[key][0] += blocks * 512
+                totals[key][1] += files
+    owners = {}
+    for kind, totals, lookup in (("user", by_user, pwd.getpwuid),
+                                 ("group", by_group, grp.getgrgid)):
+        ranked = sorted(totals.items(), key=lambda item: -item[1][0])
+        owners[kind] = [
+            (name(lookup, number), size, files)
+            for number, (size, files) in ranked[:top_k]
+        ]
+        rest = ranked[top_k:]
+        if rest:
+            owners[kind].append((
+                "other", sum(size for _, (size, _) in rest),
+                sum(files for _, (_, files) in rest)))
+    return owners
+
+
+class OwnerUsageCollector:
+    """Disk usage and file counts below each job's base path by file
+    owner and group, from the walker's per-owner accounting.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def collect(self):
+        families = {}
+        for kind in ("user", "group"):
+            prefix = "owner" if kind == "user" else "group"
+            families[kind] = (
+                GaugeMetricFamily(
+                    f'folder_size_{prefix}_bytes',
+                    f'Disk usage below the base path by file {kind}',
+                    labels=['base_path', kind]),
+                GaugeMetricFamily(
+                    f'folder_size_{prefix}_files',
+                    f'Files below the base path by file {kind}',
+                    labels=['base_path', kind]),
+            )
+        for job in self.jobs:
+            if job.owners is None:
+                continue
+            for kind, (size_family, files_family) in families.items():
+                for name, size, files in job.owners[kind]:
+                    size_family.add_metric([job.path, name], size)
+                    files_family.add_metric([job.path, name], files)
+        return [family for pair in families.values() for family in pair]
+
+
+def serve(port, jobs, scheduler):
+    """Metrics on every path, as before, plus as JSON: each job's
+    `SizeIndex` on /top and its scan state and progress on /status.
+    POST /rescan?path=... rescans the subdirectory of a job's path that
+    contains `path` (the whole job for its path itself).
+    """
+    class Handler(MetricsHandler):
+        def do_GET(self):
+            route = urlsplit(self.path).path
+            if route == "/top":
+                self.send_json(200, {
+                    job.path: job.walker.index.snapshot() for job in jobs
+                    if job.walker.index is not None
+                })
+            elif route == "/status":
+                self.send_json(200, {job.path: job.status() for job in jobs})
+            else:
+                super().do_GET()
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if url.path != "/rescan":
+                return self.send_json(404, {"error": "not found"})
+            paths = parse_qs(url.query).get("path")
+            if not paths:
+                return self.send_json(400, {"error": "missing path"})
+            path = paths[0]
+            matches = [
+                (job, job.subdir(path)) for job in jobs
+                if job.subdir(path) is not None
+            ]
+            if not matches:
+                return self.send_json(
+                    404, {"error": f"{path} is not below any scanned path"})
+            # Jobs should not overlap; if they do, the innermost wins.
+            job, subdir = max(matches, key=lambda match: len(match[0].path))
+            coalesced = scheduler.request(job, subdir)
+            self.send_json(202, {
+                "job": job.path,
+                "rescan": job.path if subdir is ALL_SUBDIRS else subdir,
+                "coalesced": coalesced,
+            })
+
+        def send_json(self, status, data):
+            body = json.dumps(data, indent=2).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def update_metrics(job, metrics, verify=False, only=None):
+    job.state = "waiting"
+    try:
+        return scan_job(job, metrics, verify, only)
+    finally:
+        job.state = "idle"
+        job.scan_started = None
+
+
+def scan_job(job, metrics, verify, only):
+    gauge = metrics.sizes
+    start_time = time.monotonic()
+    stats = 0  # du and the Nix database don't tell
+    errors = 0
+    complete = True
+
+    # Publish each subtree as soon as it is summed instead of holding
+    # every result until the slowest subtree finishes.
+    def on_subdir(path, size):
+        if exported(job.path, path, job.filters):
             gauge.labels(path=path).set(size)
-            print(f"`{path}` size is: {size} bytes")
+
+    if job.backend == "nix":
+        job.state, job.scan_started = "scanning", time.time()
+        sizes = job.nix_metrics.update()
+    elif job.backend == "du":
+        with device_lock(job.device()):
+            job.state, job.scan_started = "scanning", time.time()
+            sizes, errors, complete = get_immediate_subdirs_size(
+                job.path, job.cross_mounts, job.depth, job.deadline(),
+                on_subdir, job.du_processes)
     else:
+        with device_lock(job.device()):
+            job.state, job.scan_started = "scanning", time.time()
+            if job.quotas is not None:
+                sizes = scan_with_quotas(
+                    job.path, on_subdir, job.walker, job.quotas, verify,
+                    only, job.deadline())
+            else:
+                sizes = scan_immediate_subdirs_size(
+                    job.path, on_subdir, job.walker, verify, only,
+                    job.deadline())
+            stats = job.walker.stats
+            errors = job.walker.errors
+            complete = not job.walker.cancelled
+    duration = job.last_duration = time.monotonic() - start_time
+    metrics.scan_duration.labels(base_path=job.path).set(duration)
+    metrics.scan_seconds.labels(base_path=job.path).observe(duration)
+    metrics.stat_calls.labels(base_path=job.path).inc(stats)
+    metrics.scan_errors.labels(base_path=job.path).inc(errors)
+    metrics.scan_timeouts.labels(base_path=job.path).inc(not complete)
+    if sizes is None:
         print("Could not determine the sizes of the directory contents.")
+        return None
+    if not complete:
+        # Treat what finished as a partial scan of those subdirectories,
+        # so the series of the others keep their previous values.
+        finished = {
+            path for path in sizes
+            if os.sep not in os.path.relpath(path, job.path)
+        }
+        only = finished if only is None else only & finished
+    sizes = {
+        path: size for path, size in sizes.items()
+        if exported(job.path, path, job.filters)
+    }
+    for path, counts in job.walker.counts.items():
+        if path in sizes:
+            job.file_counts[path] = (counts, job.walker.started)
+    # Subdirectories answered by quotas have a size but were not counted.
+    for path in sizes.keys() - job.walker.counts.keys():
+        job.file_counts.pop(path, None)
+    if job.walker.owner_stats and job.backend in ("scandir", "quota"):
+        job.owners = owner_totals(job.walker.owner_usage)
+    for path in remove_vanished(job.path, gauge, sizes, only):
+        job.file_counts.pop(path, None)
+        if job.forecast is not None:
+            job.forecast.forget(path)
+            for forecast_gauge in (metrics.growth_rate, metrics.time_to_full):
+                try:
+                    forecast_gauge.remove(path)
+                except KeyError:
+                    pass
+    for path, size in sizes.items():
+        gauge.labels(path=path).set(size)
+        print(f"`{path}` size is: {size} bytes")
+    scanned = None
+    if complete:
+        scanned = time.time()
+        metrics.last_scan.labels(base_path=job.path).set(scanned)
+    if job.results is not None:
+        job.results.update(job.path, sizes, only, scanned)
+    if job.forecast is not None:
+        forecasts = job.forecast.update(sizes, time.time())
+        for path, (rate, time_to_full) in forecasts.items():
+            metrics.growth_rate.labels(path=path).set(rate)
+            metrics.time_to_full.labels(path=path).set(time_to_full)
+    return sizes
+
+
+def restore_results(job, metrics, results):
+    """Serve the sizes saved by the previous process until the first scan
+    replaces them.
+    """
+    job.results = results
+    saved = results.get(job.path)
+    if saved is None:
+        return
+    for path, size in saved["sizes"].items():
+        if exported(job.path, path, job.filters):
+            metrics.sizes.labels(path=path).set(size)
+    metrics.last_scan.labels(base_path=job.path).set(saved["scanned"])
+    print(f"Serving sizes of {job.path} saved at {saved['scanned']:.0f}")
+
+
+def watch_changes(job, scheduler, tracker):
+    """Rescan only the subdirectories that change events point at.
+
+    The rescans are requests to the scheduler, so they are merged with
+    /rescan requests and never run alongside another scan of the job.
+    """
+    BASE_PATH = job.path
+    real_base = tracker.base_path
+    scheduler.request(job, ALL_SUBDIRS, verify=False)
+    last_verify = time.monotonic()
+    while True:
+        timeout = last_verify + VERIFY_INTERVAL_SEC - time.monotonic()
+        if not select.select([tracker], [], [], max(0, timeout))[0]:
+            print(f"Verifying metrics for {BASE_PATH}...")
+            scheduler.request(job, ALL_SUBDIRS)
+            last_verify = time.monotonic()
+            continue
+
+        # Wait for the burst of changes to settle, but not forever.
+        changed = set()
+        overflow = False
+        deadline = time.monotonic() + 10 * EVENT_DEBOUNCE_SEC
+        while True:
+            batch, lost = tracker.read()
+            changed |= batch
+            overflow = overflow or lost
+            quiet = min(EVENT_DEBOUNCE_SEC, deadline - time.monotonic())
+            if quiet <= 0 or not select.select([tracker], [], [], quiet)[0]:
+                break
+        if overflow:
+            print("Change events were lost; verifying metrics...")
+            scheduler.request(job, ALL_SUBDIRS)
+            last_verify = time.monotonic()
+            continue
+
+        tops = set()
+        stale = set()
+        for directory, name in changed:
+            rel = os.path.relpath(directory, real_base)
+            stale.add(
+                BASE_PATH if rel == "." else os.path.join(BASE_PATH, rel))
+            top = os.path.normpath(os.path.join(rel, name)).split(os.sep)[0]
+            tops.add(
+                ALL_SUBDIRS if top == "." else os.path.join(BASE_PATH, top))
+        if not tops:
+            continue
+        print(f"Rescanning {len(tops)} changed subdirectories...")
+        for top in tops:
+            scheduler.request(job, top, verify=False, stale=stale)
+
+
+class Scheduler:
+    """Runs each polled job on its (adaptive) interval, and any job on
+    demand.
+
+    A due job gets its own thread, which waits for the lock of the job's
+    device before scanning, so a long scan only holds up jobs on the same
+    file system. A job never runs twice at once: requests that arrive
+    while it is waiting or scanning are merged into one follow-up scan.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        # (due, order, job); entries whose due no longer matches the job's
+        # are stale and skipped, unless the job has a request.
+        self.queue = []
+        self.order = itertools.count()
+        self.ready = threading.Condition()
+        self.running = set()
+
+    def add(self, job, due=None):
+        with self.ready:
+            job.due = time.monotonic() if due is None else due
+            heapq.heappush(self.queue, (job.due, next(self.order), job))
+            self.ready.notify()
+
+    def request(self, job, subdir, verify=True, stale=()):
+        """Rescan `subdir` of `job` (ALL_SUBDIRS for all of it) as soon as
+        possible. Returns whether the request joined one still waiting.
+
+        `verify` reads every directory instead of trusting the cache;
+        `stale` directories are dropped from the cache before the scan
+        (not now, since a scan still running could cache them again).
+        """
+        with self.ready:
+            waiting = job.requested is not None
+            job.requested_verify = job.requested_verify or verify
+            job.stale.update(stale)
+            if subdir is ALL_SUBDIRS or job.requested is ALL_SUBDIRS:
+                job.requested = ALL_SUBDIRS
+            else:
+                job.requested = (job.requested or set()) | {subdir}
+            if not waiting and job not in self.running:
+                heapq.heappush(
+                    self.queue, (time.monotonic(), next(self.order), job))
+                self.ready.notify()
+            return waiting
+
+    def run(self):
+        while True:
+            with self.ready:
+                while True:
+                    timeout = None
+                    if self.queue:
+                        timeout = self.queue[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    self.ready.wait(timeout)
+                due, _order, job = heapq.heappop(self.queue)
+                if job in self.running or (
+                        due != job.due and job.requested is None):
+                    continue
+                self.running.add(job)
+            threading.Thread(
+                target=self.run_job, args=(job,), daemon=True).start()
+
+    def run_job(self, job):
+        with self.ready:
+            only, job.requested = job.requested, None
+            requested_verify, job.requested_verify = (
+                job.requested_verify, False)
+            stale, job.stale = job.stale, set()
+        if job.walker.cache is not None:
+            for directory in stale:
+                job.walker.cache.invalidate(directory)
+        start_time = time.monotonic()
+        regular = start_time >= job.due
+        if regular or only is ALL_SUBDIRS:
+            only = None
+        if regular:
+            print(f"Updating metrics for {job.path}...")
+            verify = start_time - job.last_verify >= VERIFY_INTERVAL_SEC
+        else:
+            # Whoever asked knows something changed, so unless they said
+            # what (as change events do), don't trust the cache.
+            print(f"Rescanning {job.path} on request...")
+            verify = requested_verify
+        if verify and only is None:
+            job.last_verify = start_time
+        sizes = None
+        try:
+            sizes = update_metrics(job, self.metrics, verify, only)
+        finally:
+            duration = time.monotonic() - start_time
+            if regular:
+                self.metrics.skipped_cycles.labels(base_path=job.path).inc(
+                    int(duration // job.interval_sec))
+                interval = job.next_interval(duration, sizes)
+                self.metrics.interval.labels(base_path=job.path).set(
+                    interval)
+                remaining_time = interval - duration
+                print(f"Next scan of {job.path} in {remaining_time:.2f} "
+                      "seconds...")
+                self.add(job, time.monotonic() + remaining_time)
+            elif job.due <= time.monotonic():
+                # The regular scan came due meanwhile and was skipped.
+                self.add(job)
+            with self.ready:
+                self.running.discard(job)
+                if job.requested is not None:
+                    heapq.heappush(
+                        self.queue, (time.monotonic(), next(self.order), job))
+                    self.ready.notify()
+
+
+def watch_or_poll(job, scheduler):
+    try:
+        tracker = change_tracker(job.path, job.watch_mode, job.cross_mounts)
+        watch_changes(job, scheduler, tracker)
+    except OSError as e:
+        print(f"Watching {job.path} failed ({e}); polling it instead")
+        scheduler.add(job)
 
 
 if __name__ == "__main__":
 
-    dir_size_gauge = Gauge(
-        'directory_size_bytes',
-        'Size of immediate subdirectories and files in bytes',
-        ['path']
-    )
+    metrics = Metrics()
+
+    jobs = load_jobs()
+    if sum(job.backend == "nix" for job in jobs) > 1:
+        raise SystemExit("Only one job can use the nix backend")
 
     # Start the Prometheus HTTP server on the specified port
-    start_http_server(PORT)
+    REGISTRY.register(TopPathsCollector(jobs))
+    REGISTRY.register(FileStatsCollector(jobs))
+    REGISTRY.register(OwnerUsageCollector(jobs))
+    results = ScanResults(RESULTS_FILE)
+    for job in jobs:
+        restore_results(job, metrics, results)
+    scheduler = Scheduler(metrics)
+    serve(PORT, jobs, scheduler)
 
     # Continuously update metrics
-    while True:
-        print("Updating metrics...")
-        start_time = time.time()
-        update_metrics(BASE_PATH, dir_size_gauge)
-        end_time = time.time()
-        duration = end_time - start_time
-        remaining_time = max(INTERVAL_SEC - duration, 1)
-        print(f"Sleeping for {remaining_time:.2f} seconds...")
-        time.sleep(remaining_time)
+    for job in jobs:
+        if job.backend == "nix":
+            job.nix_metrics = NixStoreMetrics(job.path)
+        if job.watch_mode == "poll":
+            scheduler.add(job)
+        elif job.backend != "scandir":
+            print(f"WATCH_MODE={job.watch_mode} needs the scandir backend")
+            scheduler.add(job)
+        else:
+            threading.Thread(
+                target=watch_or_poll, args=(job, scheduler),
+                daemon=True).start()
+    scheduler.run()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Benchmark folder-size-metrics scanners on synthetic trees.
+
+Generates reproducible trees (by default on tmpfs, so the page cache and
+disk are out of the picture) shaped to stress one thing each: many
+small files, deep nesting, hard links, sparse files. Every scanner runs
+in a fresh process and is measured for wall time, peak RSS and stat
+calls, and its sizes are checked against `du`. The report is JSON, for
+tracking regressions across commits:
+
+    python3 benchmark.py --files 1000000 --output bench.json
+
+With --self-test DIR it instead checks every scanner's totals against
+`du` on a small tree generated in DIR, and exits non-zero on a mismatch.
+
+Stat calls are counted with strace(1) when it is installed (in a
+separate, untimed run, since tracing slows the scan down); otherwise
+only the walker's own count is reported.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Shapes of the generated trees, for --files files in total.
+TREES = {
+    # Wide and shallow, mostly tiny files.
+    "small-files": {"depth": 3, "fanout": 16},
+    # Long chains of directories with a few files at each level.
+    "deep": {"depth": 64, "fanout": 1},
+    # A third of the files also linked from a different subtree.
+    "hardlinks": {"depth": 3, "fanout": 8, "hardlink_ratio": 0.3},
+    # Files with a large apparent size but few allocated blocks.
+    "sparse": {"depth": 2, "fanout": 8, "sparse_ratio": 0.5},
+}
+
+# TreeWalker does not cache directories changed this close to a scan's
+# start (their ctime cannot be set back), so fresh trees age this long
+# before they are scanned.
+RACY_WINDOW_SEC = 2.5
+
+# Syscalls strace counts as stat calls.
+STAT_SYSCALLS = {
+    "stat", "lstat", "fstat", "stat64", "lstat64", "fstat64",
+    "newfstatat", "fstatat64", "statx",
+}
+
+
+def generate_tree(root, files, depth, fanout, seed, hardlink_ratio=0.0,
+                  sparse_ratio=0.0, tops=8):
+    """Create a tree of about `files` files below `root`.
+
+    `root` gets `tops` subdirectories, each `depth` levels of `fanout`
+    directories deep (for fanout 1, a chain per top). The same arguments
+    always produce the same tree.
+    """
+    rng = random.Random(seed)
+    directories = []
+    for top in range(tops):
+        level = [os.path.join(root, f"top{top:02}")]
+        os.mkdir(level[0])
+        directories += level
+        for _ in range(depth - 1):
+            level = [
+                os.path.join(parent, f"d{child}")
+                for parent in level for child in range(fanout)
+            ]
+            for directory in level:
+                os.mkdir(directory)
+            directories += level
+    stats = {"directories": len(directories), "files": 0, "hardlinks": 0,
+             "sparse_files": 0}
+    created = []
+    chunk = b"x" * 65536
+    for number in range(files):
+        path = os.path.join(rng.choice(directories), f"f{number}")
+        if rng.random() < sparse_ratio:
+            with open(path, "wb") as f:
+                f.seek(rng.randrange(1 << 20, 1 << 30))
+                f.write(chunk[:4096])
+            stats["sparse_files"] += 1
+        else:
+            # Mostly tiny files with a long tail, as in source trees.
+            size = min(int(rng.paretovariate(1.2) * 512), 1 << 24)
+            with open(path, "wb") as f:
+                for offset in range(0, size, len(chunk)):
+                    f.write(chunk[:size - offset])
+        created.append(path)
+        stats["files"] += 1
+    for number in range(int(len(created) * hardlink_ratio)):
+        os.link(rng.choice(created),
+                os.path.join(rng.choice(directories), f"l{number}"))
+        stats["hardlinks"] += 1
+    return stats
+
+
+def run_scanner(name, root, depth):
+    """Run one scanner in this process; called in the child."""
+    os.environ.setdefault("PORT", "0")
+    sys.path.insert(0, APP_DIR)
+    import app
+
+    stat_calls = None
+    cache_hits = cache_misses = None
+    if name == "du":
+        start = time.monotonic()
+        sizes, _errors, _complete = app.get_immediate_subdirs_size(
+            root, False, depth)
+        wall = time.monotonic() - start
+    else:
+        threads = 1 if name == "scandir-1-thread" else app.SCAN_THREADS
+        cache = None
+        if name == "scandir-cached":
+            cache = app.SubtreeCache(app.CACHE_MAX_ENTRIES)
+        walker = app.TreeWalker(threads, False, cache, depth)
+        if cache is not None:
+            walker.scan(root)  # warm the cache, untimed
+        start = time.monotonic()
+        sizes = walker.scan(root)
+        wall = time.monotonic() - start
+        stat_calls = walker.stats
+        cache_hits = walker.cache_hits
+        cache_misses = walker.cache_misses
+        if cache is not None and not cache_hits:
+            sys.exit(f"{name}: the warm scan reused no cached directories")
+    peak = max(resource.getrusage(who).ru_maxrss for who in (
+        resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return {
+        "sizes": sizes,
+        "wall_seconds": wall,
+        "peak_rss_bytes": peak * 1024,
+        "stat_calls": stat_calls,
+        "cache_hits": cache_hits,
+        "cache_misses": cache_misses,
+    }
+
+
+SCANNERS = ["du", "scandir", "scandir-1-thread", "scandir-cached"]
+
+
+def measure(name, root, depth):
+    command = [sys.executable, os.path.abspath(__file__),
+               "--run-scanner", name, "--depth", str(depth), root]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr.strip() or f"{name} failed")
+    return json.loads(result.stdout)
+
+
+def count_stat_calls(name, root, depth):
+    """Stat-family syscalls of one run under strace, or None."""
+    if shutil.which("strace") is None:
+        return None
+    with tempfile.NamedTemporaryFile("r") as trace:
+        subprocess.run(
+            ["strace", "-f", "-c", "-o", trace.name, sys.executable,
+             os.path.abspath(__file__), "--run-scanner", name,
+             "--depth", str(depth), root],
+            capture_output=True, check=True)
+        calls = 0
+        for line in trace:
+            fields = line.split()
+            # % time, seconds, usecs/call, calls, [errors,] syscall
+            if len(fields) >= 5 and fields[-1] in STAT_SYSCALLS:
+                calls += int(fields[3])
+        return calls
+
+
+def compare(sizes, reference, root):
+    """How `sizes` agree with du's.
+
+    Totals must match exactly. Individual paths can differ when hard
+    links span them: du counts a linked file for whichever path it
+    reaches first, the walker for the smallest path it is linked from.
+    """
+    def total(result):
+        return sum(size for path, size in result.items()
+                   if os.path.dirname(path) == root)
+
+    diffs = [abs(sizes.get(path, 0) - size)
+             for path, size in reference.items()]
+    return {
+        "total_bytes": total(sizes),
+        "du_total_bytes": total(reference),
+        "total_matches": total(sizes) == total(reference),
+        "paths": len(reference),
+        "paths_matching": sum(diff == 0 for diff in diffs),
+        "paths_missing": len(reference.keys() - sizes.keys()),
+        "max_path_diff_bytes": max(diffs, default=0),
+    }
+
+
+def benchmark_tree(name, shape, args, scanners):
+    root = tempfile.mkdtemp(prefix=f"fsm-bench-{name}-", dir=args.dir)
+    try:
+        start = time.monotonic()
+        tree = generate_tree(root, args.files, seed=args.seed, **shape)
+        tree["generate_seconds"] = time.monotonic() - start
+        time.sleep(RACY_WINDOW_SEC)
+        reference = measure("du", root, args.depth)["sizes"]
+        results = []
+        for scanner in scanners:
+            runs = [measure(scanner, root, args.depth)
+                    for _ in range(args.repeat)]
+            walls = [run["wall_seconds"] for run in runs]
+            result = {
+                "scanner": scanner,
+                "wall_seconds": walls,
+                "wall_seconds_min": min(walls),
+                "wall_seconds_median": statistics.median(walls),
+                "peak_rss_bytes": max(run["peak_rss_bytes"] for run in runs),
+                "stat_calls": runs[0]["stat_calls"],
+                "cache_hits": runs[0]["cache_hits"],
+                "cache_misses": runs[0]["cache_misses"],
+                "stat_calls_source": (
+                    None if runs[0]["stat_calls"] is None else "walker"),
+                "correctness": compare(runs[0]["sizes"], reference, root),
+            }
+            if args.strace:
+                traced = count_stat_calls(scanner, root, args.depth)
+                if traced is not None:
+                    result["stat_calls"] = traced
+                    result["stat_calls_source"] = "strace"
+            results.append(result)
+            print(f"{name}/{scanner}: {result['wall_seconds_min']:.3f}s",
+                  file=sys.stderr)
+        return {"tree": name, "shape": shape, **tree, "results": results}
+    finally:
+        if not args.keep:
+            shutil.rmtree(root)
+
+
+def self_test(root, depth, seed):
+    """Check that every scanner's totals match du's below `root`.
+
+    A small tree with hard links across top-level subdirectories and
+    sparse files is generated there. Whatever `root` already holds is
+    scanned with it, so a caller can add mount points the scanners
+    must skip the way `du -x` does. scandir-cached fails unless its
+    second scan reuses the cache.
+    """
+    generate_tree(root, 2000, 3, 4, seed, hardlink_ratio=0.3,
+                  sparse_ratio=0.1)
+    time.sleep(RACY_WINDOW_SEC)
+    reference = measure("du", root, depth)["sizes"]
+    failures = []
+    for scanner in SCANNERS:
+        if scanner == "du":
+            continue
+        correctness = compare(
+            measure(scanner, root, depth)["sizes"], reference, root)
+        if not correctness["total_matches"] or correctness["paths_missing"]:
+            failures.append(f"{scanner}: {json.dumps(correctness)}")
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=100000,
+                        help="Files per tree (default: 100000)")
+    parser.add_argument("--tree", action="append", choices=sorted(TREES),
+                        help="Tree shape to run; repeatable (default: all)")
+    parser.add_argument("--scanner", action="append", choices=SCANNERS,
+                        help="Scanner to run; repeatable (default: all)")
+    parser.add_argument("--depth", type=int, default=2,
+                        help="Reported levels, as SCAN_DEPTH (default: 2)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timed runs per scanner (default: 3)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default="/dev/shm",
+                        help="Where trees are generated (default: /dev/shm)")
+    parser.add_argument("--no-strace", dest="strace", action="store_false",
+                        help="Don't count stat calls with strace")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the generated trees")
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--self-test", metavar="DIR",
+                        help="Check each scanner against du on a tree "
+                             "generated in DIR and exit")
+    parser.add_argument("--run-scanner", help=argparse.SUPPRESS)
+    parser.add_argument("root", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scanner:
+        json.dump(run_scanner(args.run_scanner, args.root, args.depth),
+                  sys.stdout)
+        return
+    if args.self_test:
+        self_test(args.self_test, args.depth, args.seed)
+        print("folder-size-metrics: self-test passed")
+        return
+
+    report = {
+        "version": 1,
+        "started": time.time(),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "parameters": {
+            "files": args.files, "depth": args.depth,
+            "repeat": args.repeat, "seed": args.seed, "dir": args.dir,
+        },
+        "trees": [
+            benchmark_tree(name, TREES[name], args,
+                           args.scanner or SCANNERS)
+            for name in args.tree or TREES
+        ],
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
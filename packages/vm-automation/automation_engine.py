@@ -18,15 +18,17 @@ Reference: vendor/vm-research/cua/libs/lume/src/Unattended/*.swift
 
 import argparse
 import asyncio
+import hashlib
 import json
 import os
 import re
 import sys
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import yaml
 from PIL import Image, ImageDraw
@@ -74,6 +76,45 @@ class TextObservation:
         return (x + w // 2, y + h // 2)
 
 
+@dataclass
+class PollStats:
+    """
+    Wall-clock and CPU time spent capturing and recognizing frames.
+
+    CPU time includes the tesseract child processes.
+
+    Attributes:
+        polls: Number of frames captured
+        ocr_runs: Frames Tesseract actually ran on
+        ocr_unchanged: Frames skipped as identical to the previous one
+        ocr_cache_hits: Frames whose OCR result was found in the cache
+        capture_seconds: Wall time spent fetching framebuffers
+        ocr_seconds: Wall time spent in OCR, including fingerprinting
+        cpu_seconds: CPU time (this process and its children) of both
+    """
+    polls: int = 0
+    ocr_runs: int = 0
+    ocr_unchanged: int = 0
+    ocr_cache_hits: int = 0
+    capture_seconds: float = 0.0
+    ocr_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+
+    def summary(self) -> str:
+        """Counts and per-poll averages, for logging"""
+        n = max(self.polls, 1)
+        return (f"{self.polls} polls, OCR ran {self.ocr_runs}, skipped {self.ocr_unchanged} "
+                f"unchanged and {self.ocr_cache_hits} cached; per poll: "
+                f"capture {self.capture_seconds / n * 1000:.0f} ms, "
+                f"OCR {self.ocr_seconds / n * 1000:.0f} ms, CPU {self.cpu_seconds / n * 1000:.0f} ms")
+
+
+def cpu_time() -> float:
+    """CPU time of this process and its waited-for children"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
 class UnattendedSetup:
     """
     Main automation engine that executes YAML-based automation configs.
@@ -116,6 +157,19 @@ class UnattendedSetup:
         self.poll_interval = 1.0  # OCR polling interval in seconds
         self.inter_command_delay = 0.2  # Delay between commands in seconds
 
+        # Capture and OCR cost across the whole run
+        self.poll_stats = PollStats()
+
+        # Change detection: OCR results are kept by a hash of the exact
+        # frame, the last ocr_cache_size of them, so an unchanged screen (or
+        # one toggling between states, like a blinking cursor) is not
+        # recognized again. VNC frames are lossless, so equal pixels mean
+        # equal text; downsampled diffs with a tolerance would miss a single
+        # changed digit.
+        self.ocr_cache_size = 32
+        self.ocr_cache: "OrderedDict[bytes, List[TextObservation]]" = OrderedDict()
+        self.last_frame_key: Optional[bytes] = None
+
         # Debug mode setup
         self.command_index = 0
         if self.debug:
@@ -172,6 +226,7 @@ class UnattendedSetup:
                 await self.run_health_check(self.config['health_check'])
 
             print("Unattended setup completed successfully!")
+            print(f"OCR: {self.poll_stats.summary()}")
 
         except Exception as e:
             print(f"ERROR: Unattended setup failed: {e}", file=sys.stderr)
@@ -410,18 +465,16 @@ class UnattendedSetup:
         """
         deadline = time.time() + timeout
         poll_count = 0
+        frame = None
+        observations = []
 
         while time.time() < deadline:
             poll_count += 1
 
-            # Capture framebuffer
-            screenshot_path = f"/tmp/fb-{os.getpid()}.png"
-            self.vnc.captureScreen(screenshot_path)
+            # Capture framebuffer and run OCR on it, in memory
+            frame, observations, source = self.capture_and_recognize()
 
-            # Run OCR
-            observations = self.recognize_text(screenshot_path)
-
-            print(f"  OCR poll {poll_count}: found {len(observations)} text elements")
+            print(f"  OCR poll {poll_count}: found {len(observations)} text elements ({source})")
 
             # Check if text is present
             if self.find_text(text, observations):
@@ -433,14 +486,67 @@ class UnattendedSetup:
 
         # Timeout - save debug screenshot if enabled
         if self.debug:
-            observations = self.recognize_text(screenshot_path)
+            if frame is None:
+                frame, observations, _ = self.capture_and_recognize()
             self.save_debug_screenshot(
-                screenshot_path, None, text, failed=True, observations=observations
+                frame, None, text, failed=True, observations=observations
             )
 
         raise TimeoutError(f"Text '{text}' not found after {timeout}s")
 
-    def recognize_text(self, image_path: str) -> List[TextObservation]:
+    def capture_frame(self) -> Image.Image:
+        """
+        Fetch the current framebuffer as an in-memory RGB image.
+
+        The image is a copy, so it stays valid while the VNC client keeps
+        updating its own buffer. Nothing is encoded or written to disk.
+        """
+        self.vnc.refreshScreen()
+        return self.vnc.screen.convert('RGB')
+
+    def capture_and_recognize(self) -> Tuple[Image.Image, List[TextObservation], str]:
+        """
+        Capture a frame and return the text on it, accounting both in poll_stats.
+
+        OCR only runs for frames not seen among the last ocr_cache_size
+        distinct ones.
+
+        Returns:
+            The frame, its observations, and where they came from:
+            'ocr', 'unchanged' or 'cached'
+        """
+        stats = self.poll_stats
+        cpu_start = cpu_time()
+        start = time.perf_counter()
+        frame = self.capture_frame()
+        captured = time.perf_counter()
+
+        key = hashlib.blake2b(frame.tobytes(), digest_size=16).digest()
+        if key in self.ocr_cache:
+            if key == self.last_frame_key:
+                source = 'unchanged'
+                stats.ocr_unchanged += 1
+            else:
+                source = 'cached'
+                stats.ocr_cache_hits += 1
+            self.ocr_cache.move_to_end(key)
+            observations = self.ocr_cache[key]
+        else:
+            source = 'ocr'
+            stats.ocr_runs += 1
+            observations = self.recognize_text(frame)
+            self.ocr_cache[key] = observations
+            if len(self.ocr_cache) > self.ocr_cache_size:
+                self.ocr_cache.popitem(last=False)
+        self.last_frame_key = key
+
+        stats.polls += 1
+        stats.capture_seconds += captured - start
+        stats.ocr_seconds += time.perf_counter() - captured
+        stats.cpu_seconds += cpu_time() - cpu_start
+        return frame, observations, source
+
+    def recognize_text(self, image: Union[Image.Image, str]) -> List[TextObservation]:
         """
         Run OCR on an image and return text observations.
 
@@ -448,13 +554,19 @@ class UnattendedSetup:
         Only observations with confidence >= 0.3 (30%) are returned.
 
         Args:
-            image_path: Path to image file
+            image: In-memory image (e.g. from capture_frame) or path to an image file
 
         Returns:
             List of TextObservation objects, sorted top-to-bottom
         """
-        image = Image.open(image_path)
-        width, height = image.size
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        # pytesseract passes images to the tesseract CLI through a temporary
+        # file in the image's format, PNG for a fresh image; uncompressed PPM
+        # skips the zlib compression and decompression.
+        image.format = 'PPM'
 
         # Run Tesseract OCR with bounding boxes
         # Output format: Dict with keys: text, conf, left, top, width, height
@@ -546,12 +658,8 @@ class UnattendedSetup:
         Raises:
             ValueError: If text not found
         """
-        # Capture framebuffer
-        screenshot_path = f"/tmp/fb-{os.getpid()}.png"
-        self.vnc.captureScreen(screenshot_path)
-
-        # Run OCR
-        observations = self.recognize_text(screenshot_path)
+        # Capture framebuffer and run OCR on it, in memory
+        frame, observations, _ = self.capture_and_recognize()
 
         # Find text
         observation = self.find_text(text, observations, index)
@@ -559,7 +667,7 @@ class UnattendedSetup:
             # Save debug screenshot if enabled
             if self.debug:
                 self.save_debug_screenshot(
-                    screenshot_path, None, text, failed=True, observations=observations
+                    frame, None, text, failed=True, observations=observations
                 )
             raise ValueError(f"Text '{text}' not found on screen")
 
@@ -573,7 +681,7 @@ class UnattendedSetup:
         # Save debug screenshot before clicking
         if self.debug:
             self.save_debug_screenshot(
-                screenshot_path, (click_x, click_y), text, failed=False,
+                frame, (click_x, click_y), text, failed=False,
                 observations=observations
             )
 
@@ -581,7 +689,7 @@ class UnattendedSetup:
         self.vnc.mouseMove(click_x, click_y)
         self.vnc.mousePress(1)  # Left button
 
-    def save_debug_screenshot(self, image_path: str, click_point: Optional[Tuple[int, int]],
+    def save_debug_screenshot(self, frame: Image.Image, click_point: Optional[Tuple[int, int]],
         search_text: str, failed: bool,
         observations: List[TextObservation]):
         """
@@ -591,15 +699,17 @@ class UnattendedSetup:
         1. PNG with red crosshair marking the click point
         2. JSON with full OCR tree and metadata
 
+        This is the only place frames are encoded and written to disk.
+
         Args:
-            image_path: Path to source image
+            frame: Captured frame the observations were recognized in
             click_point: (x, y) coordinates of click point (None if failed)
             search_text: The text that was being searched for
             failed: Whether the operation failed
             observations: List of all OCR observations
         """
-        # Load image
-        image = Image.open(image_path).convert('RGB')
+        # Annotate a copy, leaving the frame as captured
+        image = frame.copy()
         draw = ImageDraw.Draw(image)
 
         # Draw red crosshair at click point